@@ -0,0 +1,208 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""Per-request allocation budgets of the networking waffles.
+
+Budgets are the bytes and blocks still allocated when a request, or a
+phase of it, ends, which catches what a request leaves behind in caches and
+stats, and the peak bytes within it, which catches short-lived garbage.
+Peaks are only checked on Python 3.9 and later. Budgets have headroom over
+what the waffles allocate today; a change that crosses one should say why.
+"""
+import mock
+import unittest2
+
+from wafflehaus.nova import alloc_trace
+from wafflehaus.nova.networking import detach_network_check
+from wafflehaus.nova.networking import instance_networks
+from wafflehaus.nova.networking import network_count_check
+from wafflehaus import tests
+
+PUB = '00000000-0000-0000-0000-000000000000'
+PRIV = '11111111-1111-1111-1111-111111111111'
+SERVER = '33333333-3333-3333-3333-333333333333'
+VIF = '44444444-4444-4444-4444-444444444444'
+PRIV_VIF = '55555555-5555-5555-5555-555555555555'
+
+# (bytes, blocks, peak bytes) by kind of request and phase
+BUDGETS = {
+    'boot': {'parse': (2048, 24, 8192), 'policy': (1024, 12, 4096),
+             'total': (2048, 24, 8192)},
+    'attach': {'parse': (1024, 12, 8192), 'lookup': (1024, 12, 4096),
+               'policy': (1024, 12, 4096), 'total': (1024, 12, 8192)},
+    'cached_attach': {'lookup': (1024, 12, 4096),
+                      'total': (2048, 24, 8192)},
+    'detach': {'lookup': (1024, 12, 4096), 'total': (1024, 12, 4096)},
+}
+
+WARMUP = 3
+SAMPLES = 20
+
+
+class FakeContext(object):
+    project_id = '123456'
+
+
+class FakeVIF(dict):
+    def __init__(self, vif_id, net_id):
+        super(FakeVIF, self).__init__(
+            address='fa:16:3e:00:00:01', id=vif_id,
+            network={'id': net_id, 'label': 'net'})
+
+    def fixed_ips(self):
+        return [{'address': '192.168.1.1'}]
+
+
+class FakeInstance(object):
+    uuid = SERVER
+    image_ref = 'image'
+
+
+NW_INFO = [FakeVIF(VIF, PUB), FakeVIF(PRIV_VIF, PRIV)]
+
+
+def fake_get_instance(self, context, server_id):
+    return FakeInstance()
+
+
+def fake_get_nw_info(instance):
+    return NW_INFO
+
+
+def fake_get_context(self, request):
+    return FakeContext()
+
+
+def nova_app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'application/json')])
+    return [b'{}']
+
+
+@unittest2.skipIf(alloc_trace.tracemalloc is None, 'needs tracemalloc')
+class TestAllocationBudgets(tests.TestCase):
+
+    def setUp(self):
+        super(TestAllocationBudgets, self).setUp()
+        nova_path = 'wafflehaus.nova.nova_base.WafflehausNova'
+        for name, fake in (('%s._get_instance' % nova_path,
+                            fake_get_instance),
+                           ('%s._get_context' % nova_path, fake_get_context),
+                           ('nova.compute.utils.get_nw_info_for_instance',
+                            fake_get_nw_info)):
+            patcher = mock.patch(name, fake)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.create_patch(
+            'wafflehaus.nova.networking.instance_networks._shared')
+        instance_networks._shared = None
+        self.conf = {'enabled': 'true', 'networks_max': '3',
+                     'required_nets': PUB, 'optional_nets': PUB}
+        self.attach_url = '/123456/servers/%s/os-virtual-interfacesv2' % (
+            SERVER)
+
+    def _trace(self, waffle, request):
+        """Returns the allocation report of SAMPLES traced requests."""
+        for _ in range(WARMUP):
+            request()
+        waffle.alloc_tracer = alloc_trace.AllocationTracer(1.0)
+        for _ in range(SAMPLES):
+            request()
+        self.assertEqual(SAMPLES, waffle.alloc_tracer.sampled)
+        return waffle.alloc_tracer.report()
+
+    def _assert_within(self, budget, report):
+        for name, (max_bytes, max_blocks, max_peak) in budget.items():
+            phase = report[name]
+            self.assertEqual(SAMPLES, phase['requests'])
+            self.assertLessEqual(phase['mean_bytes'], max_bytes,
+                                 '%s: %s' % (name, phase))
+            self.assertLessEqual(phase['mean_blocks'], max_blocks,
+                                 '%s: %s' % (name, phase))
+            self.assertLessEqual(phase['max_peak_bytes'], max_peak,
+                                 '%s: %s' % (name, phase))
+
+    def test_boot(self):
+        waffle = network_count_check.filter_factory(self.conf)(nova_app)
+        body = ('{"server": {"flavorRef": "1", "networks": '
+                '[{"uuid": "%s"}, {"uuid": "%s"}]}}' % (PUB, PRIV))
+
+        def boot():
+            waffle.__call__.request('/123456/servers', method='POST',
+                                    body=body.encode('utf-8'))
+        report = self._trace(waffle, boot)
+        self._assert_within(BUDGETS['boot'], report['boot'])
+
+    def test_attach(self):
+        waffle = network_count_check.filter_factory(self.conf)(nova_app)
+        body = b'{"virtual_interface": {"network_id": "net"}}'
+
+        def attach():
+            waffle.__call__.request(self.attach_url, method='POST',
+                                    body=body)
+        report = self._trace(waffle, attach)
+        self._assert_within(BUDGETS['attach'], report['attach'])
+
+    def test_cached_attach(self):
+        self.conf['instance_cache_ttl'] = '600'
+        self.conf['networks_max'] = '100'
+        waffle = network_count_check.filter_factory(self.conf)(nova_app)
+        body = b'{"virtual_interface": {"network_id": "net"}}'
+
+        def attach():
+            waffle.__call__.request(self.attach_url, method='POST',
+                                    body=body)
+        report = self._trace(waffle, attach)
+        self._assert_within(BUDGETS['cached_attach'], report['attach'])
+
+    def test_detach(self):
+        waffle = detach_network_check.filter_factory(self.conf)(nova_app)
+
+        def detach():
+            waffle.__call__.request('%s/%s' % (self.attach_url, PRIV_VIF),
+                                    method='DELETE')
+        report = self._trace(waffle, detach)
+        self._assert_within(BUDGETS['detach'], report['detach'])
+
+
+@unittest2.skipIf(alloc_trace.tracemalloc is None, 'needs tracemalloc')
+class TestAllocationTracer(tests.TestCase):
+
+    def test_phases_attributed(self):
+        tracer = alloc_trace.AllocationTracer(1.0)
+        kept = []
+        with tracer.request():
+            alloc_trace.label('test')
+            with alloc_trace.phase('keep'):
+                kept.append([object() for _ in range(100)])
+            with alloc_trace.phase('drop'):
+                [object() for _ in range(100)]
+        report = tracer.report()['test']
+        self.assertTrue(report['keep']['mean_blocks'] >= 100)
+        self.assertTrue(report['drop']['mean_blocks'] < 5)
+        self.assertTrue(report['total']['mean_blocks'] >= 100)
+        self.assertFalse(alloc_trace.tracemalloc.is_tracing())
+
+    def test_one_request_at_a_time(self):
+        tracer = alloc_trace.AllocationTracer(1.0)
+        with tracer.request():
+            with tracer.request() as nested:
+                self.assertIsNone(nested)
+        self.assertEqual(1, tracer.busy)
+        self.assertEqual(1, tracer.sampled)
+
+    def test_unsampled_requests_untraced(self):
+        tracer = alloc_trace.AllocationTracer(0.5, rng=lambda: 0.7)
+        with tracer.request() as trace:
+            self.assertIsNone(trace)
+            self.assertFalse(alloc_trace.tracemalloc.is_tracing())
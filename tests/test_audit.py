@@ -0,0 +1,112 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+import json
+import os
+import shutil
+import tempfile
+
+from wafflehaus.nova import audit
+from wafflehaus.nova.networking import network_count_check
+from wafflehaus import tests
+
+
+class FakeContext(object):
+    project_id = '123456'
+
+
+class TestAuditLog(tests.TestCase):
+
+    def setUp(self):
+        super(TestAuditLog, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'audit.jsonl')
+
+    def _read(self, path=None):
+        with open(path or self.path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_records_written_as_json_lines(self):
+        log = audit.AuditLog(self.path, flush_interval=0.01)
+        self.assertTrue(log.record(action='boot', decision='accept'))
+        self.assertTrue(log.record(action='attach', decision='reject'))
+        log.close()
+
+        records = self._read()
+        self.assertEqual(['boot', 'attach'], [r['action'] for r in records])
+        self.assertTrue('ts' in records[0])
+        self.assertEqual(2, log.stats()['written'])
+
+    def test_full_queue_drops_and_counts(self):
+        self.create_patch('wafflehaus.nova.audit.AuditLog._ensure_writer')
+        log = audit.AuditLog(self.path, queue_size=2)
+        self.assertTrue(log.record(n=1))
+        self.assertTrue(log.record(n=2))
+        self.assertFalse(log.record(n=3))
+        self.assertEqual(1, log.stats()['dropped'])
+        log.close()
+        self.assertEqual([1, 2], [r['n'] for r in self._read()])
+
+    def test_rotates_by_size(self):
+        self.create_patch('wafflehaus.nova.audit.AuditLog._ensure_writer')
+        log = audit.AuditLog(self.path, batch_size=1, max_bytes=10,
+                             backup_count=2)
+        for n in range(3):
+            log.record(n=n)
+        log.close()
+        self.assertEqual(3, log.stats()['rotations'])
+        self.assertEqual([2], [r['n'] for r in self._read(self.path + '.1')])
+        self.assertEqual([1], [r['n'] for r in self._read(self.path + '.2')])
+        self.assertFalse(os.path.exists(self.path + '.3'))
+
+    def test_from_conf_shares_instances(self):
+        self.assertIsNone(audit.AuditLog.from_conf({}))
+        conf = {'audit_log_file': self.path}
+        first = audit.AuditLog.from_conf(conf)
+        self.assertTrue(first is audit.AuditLog.from_conf(conf))
+        first.close()
+
+    def test_pid_resolved_by_writing_process(self):
+        path = os.path.join(self.tmpdir, 'audit.%(pid)s.jsonl')
+        m_getpid = self.create_patch('wafflehaus.nova.audit.os.getpid')
+        m_getpid.return_value = 100
+        log = audit.AuditLog.from_conf({'audit_log_file': path})
+        # Paste loaded the app; nova forks a worker that writes
+        m_getpid.return_value = 101
+        log.record(n=1)
+        log.close()
+        self.assertEqual([1], [r['n'] for r in
+                               self._read(path % {'pid': 101})])
+        self.assertFalse(os.path.exists(path % {'pid': 100}))
+
+    def test_network_count_check_audits_rejected_boot(self):
+        ctx_path = 'wafflehaus.nova.nova_base.WafflehausNova._get_context'
+        m_ctx = self.create_patch(ctx_path)
+        m_ctx.return_value = FakeContext()
+        conf = {'enabled': 'true', 'audit_log_file': self.path,
+                'audit_fsync_interval': '0'}
+
+        result = network_count_check.filter_factory(conf)(self.app)
+        body = '{"server": {"networks":[]}}'
+        result.__call__.request('/123456/servers', method='POST', body=body)
+        result.audit.close()
+
+        records = self._read()
+        self.assertEqual(1, len(records))
+        self.assertEqual('boot', records[0]['action'])
+        self.assertEqual('reject', records[0]['decision'])
+        self.assertEqual('123456', records[0]['project'])
+        self.assertEqual('NetworkCountCheck', records[0]['waffle'])
+        self.assertEqual([], records[0]['networks'])
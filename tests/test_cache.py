@@ -0,0 +1,65 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+from wafflehaus.nova import cache
+from wafflehaus import tests
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTTLCache(tests.TestCase):
+
+    def setUp(self):
+        super(TestTTLCache, self).setUp()
+        self.clock = FakeClock()
+        self.cache = cache.TTLCache('test', 2, 10, clock=self.clock)
+
+    def test_get_and_set(self):
+        self.assertIsNone(self.cache.get('a'))
+        self.cache.set('a', 1)
+        self.assertEqual(1, self.cache.get('a'))
+        stats = self.cache.stats()
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(1, stats['misses'])
+
+    def test_entries_expire(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2, ttl=100)
+        self.clock.now += 10
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(2, self.cache.get('b'))
+        self.assertEqual(1, self.cache.stats()['expirations'])
+        self.assertEqual(1, len(self.cache))
+
+    def test_least_recently_used_evicted(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.cache.get('a')
+        self.cache.set('c', 3)
+        self.assertEqual(2, len(self.cache))
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(1, self.cache.get('a'))
+        self.assertEqual(1, self.cache.stats()['evictions'])
+
+    def test_pop_matching(self):
+        self.cache.set(('p1', 's1'), True)
+        self.cache.set(('p2', 's1'), True)
+        self.assertEqual(2, self.cache.pop_matching(lambda k: k[1] == 's1'))
+        self.assertEqual(0, len(self.cache))
@@ -0,0 +1,172 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+import os
+import shutil
+import struct
+import tempfile
+import time
+
+from wafflehaus.nova.networking import cache_snapshot
+from wafflehaus.nova.networking import instance_networks
+from wafflehaus import tests
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestSnapshotFile(tests.TestCase):
+
+    def setUp(self):
+        super(TestSnapshotFile, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'networks.snap')
+
+    def test_round_trip(self):
+        records = [['p', 's', 2000.0, 900.0, {'vif': 'net'}, [], None]]
+        cache_snapshot.dump(self.path, records, 0.25)
+        snapshot = cache_snapshot.load(self.path)
+        self.assertEqual(records, snapshot.records)
+        self.assertEqual(0.25, snapshot.lookup_seconds)
+        self.assertEqual(['networks.snap'], os.listdir(self.tmpdir))
+
+    def test_missing_file(self):
+        self.assertIsNone(cache_snapshot.load(self.path))
+
+    def _corrupt(self, offset, value):
+        with open(self.path, 'r+b') as f:
+            f.seek(offset)
+            f.write(value)
+
+    def test_corrupt_payload_ignored(self):
+        cache_snapshot.dump(self.path, [['p', 's', 1, 1, {}, [], None]])
+        with open(self.path, 'rb') as f:
+            last = bytearray(f.read())[-1]
+        self._corrupt(os.path.getsize(self.path) - 1,
+                      bytes(bytearray([last ^ 0xff])))
+        self.assertIsNone(cache_snapshot.load(self.path))
+
+    def test_other_format_version_ignored(self):
+        cache_snapshot.dump(self.path, [])
+        self._corrupt(4, struct.pack('>H', 99))
+        self.assertIsNone(cache_snapshot.load(self.path))
+
+    def test_truncated_file_ignored(self):
+        cache_snapshot.dump(self.path, [['p', 's', 1, 1, {}, [], None]])
+        with open(self.path, 'r+b') as f:
+            f.truncate(os.path.getsize(self.path) - 3)
+        self.assertIsNone(cache_snapshot.load(self.path))
+        with open(self.path, 'wb') as f:
+            f.write(b'WHNS')
+        self.assertIsNone(cache_snapshot.load(self.path))
+
+
+class TestInstanceNetworkSnapshots(tests.TestCase):
+
+    def setUp(self):
+        super(TestInstanceNetworkSnapshots, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'networks.snap')
+        self.clock = FakeClock()
+
+    def _cache(self):
+        cache = instance_networks.InstanceNetworkCache(
+            ttl=3600, refresh_interval=300, clock=self.clock)
+        cache.snapshot_path = self.path
+        return cache
+
+    def test_restart_restores_entries(self):
+        cache = self._cache()
+        cache.seed('p', 's1', {'vif1': 'net1'}, lookup_seconds=0.02)
+        cache.seed('p', 's2', {'vif2': 'net2'}, lookup_seconds=0.04)
+        cache.apply_attach('p', 's1', 'net3')
+        self.assertTrue(cache.save_snapshot())
+
+        self.clock.now += 60
+        restarted = self._cache()
+        self.assertEqual(2, restarted.load_snapshot())
+        entry = restarted.get('p', 's1')
+        self.assertEqual(set(['net1', 'net3']), entry.networks())
+        restarted.get('p', 's1')
+        stats = restarted.stats()['snapshot']
+        self.assertEqual(2, stats['restored'])
+        self.assertEqual(1, stats['restored_hits'])
+        self.assertAlmostEqual(30.0, stats['saved_ms'])
+        self.assertAlmostEqual(60.0, stats['refill_ms'])
+
+    def test_expired_and_stale_entries_discarded(self):
+        cache = self._cache()
+        cache.seed('p', 'old', {'vif1': 'net1'})
+        self.clock.now += 150
+        cache.entries.ttl = 100
+        cache.seed('p', 'short', {'vif2': 'net2'})
+        cache.entries.ttl = 3600
+        cache.seed('p', 'new', {'vif3': 'net3'})
+        cache.save_snapshot()
+        self.assertEqual(3, cache.snapshot_stats['saved'])
+
+        self.clock.now += 200
+        restarted = self._cache()
+        self.assertEqual(1, restarted.load_snapshot())
+        self.assertIsNotNone(restarted.get('p', 'new'))
+        self.assertEqual(1, restarted.snapshot_stats['expired'])
+        self.assertEqual(1, restarted.snapshot_stats['stale'])
+
+    def test_unchanged_cache_does_not_write(self):
+        cache = self._cache()
+        self.assertFalse(cache.save_snapshot())
+        self.assertFalse(os.path.exists(self.path))
+        cache.seed('p', 's', {})
+        self.assertTrue(cache.save_snapshot())
+        self.assertFalse(cache.save_snapshot())
+
+    def test_workers_merge_snapshots(self):
+        first = self._cache()
+        second = self._cache()
+        first.seed('p', 's1', {'vif1': 'net1'})
+        second.seed('p', 's2', {'vif2': 'net2'})
+        self.clock.now += 10
+        second.seed('p', 's1', {'vif1': 'net1', 'vif3': 'net3'})
+        second.save_snapshot()
+        first.save_snapshot()
+
+        restarted = self._cache()
+        self.assertEqual(2, restarted.load_snapshot())
+        self.assertEqual(set(['net1', 'net3']),
+                         restarted.get('p', 's1').networks())
+
+    def test_from_conf_loads_snapshot(self):
+        self.create_patch(
+            'wafflehaus.nova.networking.instance_networks._shared')
+        instance_networks._shared = None
+        m_atexit = self.create_patch(
+            'wafflehaus.nova.networking.instance_networks.atexit')
+        cache = self._cache()
+        cache.clock = cache.entries.clock = time.time
+        cache.seed('p', 's', {'vif': 'net'})
+        cache.save_snapshot()
+
+        conf = {'instance_cache_ttl': '600',
+                'instance_cache_snapshot': self.path,
+                'instance_cache_snapshot_interval': '0'}
+        shared = instance_networks.InstanceNetworkCache.from_conf(conf)
+        self.assertIsNotNone(shared.get('p', 's'))
+        m_atexit.register.assert_called_once_with(shared.close)
@@ -0,0 +1,156 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+import mock
+
+from wafflehaus.nova.networking import candidates
+from wafflehaus.nova.networking import detach_network_check
+from wafflehaus.nova.networking import network_count_check
+from wafflehaus.nova.networking import network_policy
+from wafflehaus import tests
+
+PUB = '00000000-0000-0000-0000-000000000000'
+PRIV = '11111111-1111-1111-1111-111111111111'
+GPU = '22222222-2222-2222-2222-222222222222'
+SERVER = '33333333-3333-3333-3333-333333333333'
+VIF = '44444444-4444-4444-4444-444444444444'
+
+
+class FakeContext(object):
+    project_id = '123456'
+
+
+class MockedVIFInfo(dict):
+    def __init__(self, vif_id, net_id):
+        self['address'] = '196.168.1.1'
+        self['id'] = vif_id
+        self['network'] = {'id': net_id, 'label': 'nw_label'}
+
+    def fixed_ips(self):
+        return [{'address': '192.168.1.1'}]
+
+
+def _policy(conf):
+    return network_count_check.NetworkCountConfig(conf).policy
+
+
+class TestCandidatePolicies(tests.TestCase):
+
+    def test_candidate_conf(self):
+        conf = {'networks_max': '2', 'banned_nets': GPU,
+                'candidate_policies': 'strict',
+                'candidate_strict_networks_max': '1'}
+        merged = candidates.candidate_conf(conf, 'strict')
+        self.assertEqual('1', merged['networks_max'])
+        self.assertEqual(GPU, merged['banned_nets'])
+        self.assertNotIn('candidate_policies', merged)
+
+    def test_would_be_decisions(self):
+        conf = {'networks_max': '3', 'candidate_policies': 'strict loose',
+                'candidate_strict_networks_max': '1',
+                'candidate_loose_networks_max': '5'}
+        policies = candidates.CandidatePolicies.from_conf(conf, _policy)
+        policies.evaluate_boot('', [PUB, PRIV])
+        policies.evaluate_boot('Too many', [PUB, PRIV, GPU, 'other'])
+        report = policies.report()
+        self.assertEqual(2, report['requests'])
+        self.assertEqual(1, report['strict']['newly_rejected'])
+        self.assertEqual(2, report['strict']['would_reject'])
+        self.assertEqual({'count': 2}, report['strict']['rules'])
+        self.assertEqual(0, report['loose']['would_reject'])
+        self.assertEqual(1, report['loose']['newly_accepted'])
+
+    def test_sampling(self):
+        policy = network_policy.NetworkPolicy(networks_max=1)
+        draws = [0.9, 0.1]
+        policies = candidates.CandidatePolicies([('one', policy)], 0.5,
+                                                rng=draws.pop)
+        policies.evaluate_boot('', [PUB, PRIV])
+        policies.evaluate_boot('', [PUB, PRIV])
+        report = policies.report()
+        self.assertEqual(2, report['requests'])
+        self.assertEqual(1, report['sampled'])
+        self.assertEqual(1, report['one']['evaluated'])
+
+    def test_no_candidates(self):
+        self.assertIsNone(candidates.CandidatePolicies.from_conf(
+            {'networks_max': '2'}, _policy))
+
+
+class TestReportOnlyFilters(tests.TestCase):
+
+    def setUp(self):
+        super(TestReportOnlyFilters, self).setUp()
+        nova_path = 'wafflehaus.nova.nova_base.WafflehausNova'
+        self.m_ctx = self.create_patch('%s._get_context' % nova_path)
+        self.m_ctx.return_value = FakeContext()
+        self.m_instance = self.create_patch('%s._get_instance' % nova_path)
+        self.m_get_nwinfo = self.create_patch(
+            'nova.compute.utils.get_nw_info_for_instance')
+        self.m_get_nwinfo.return_value = [MockedVIFInfo(VIF, PUB)]
+        self.conf = {'enabled': 'true', 'networks_max': '2',
+                     'required_nets': PUB, 'optional_nets': PUB}
+        self.attach_url = '/123456/servers/%s/os-virtual-interfacesv2' % (
+            SERVER)
+
+    def _boot(self, waffle, *networks):
+        body = '{"server": {"networks": [%s]}}' % ', '.join(
+            '{"uuid": "%s"}' % net for net in networks)
+        return waffle.__call__.request('/123456/servers', method='POST',
+                                       body=body)
+
+    def test_report_only_passes_rejections(self):
+        self.conf['report_only'] = 'true'
+        waffle = network_count_check.filter_factory(self.conf)(self.app)
+        waffle.audit = mock.Mock()
+        self.assertEqual(self.app, self._boot(waffle, PRIV))
+        self.assertEqual(1, waffle._stats()['report_only']['would_reject'])
+        kwargs = waffle.audit.record.call_args[1]
+        self.assertEqual('would_reject', kwargs['decision'])
+
+    def test_candidates_reuse_attach_lookup(self):
+        self.conf.update(candidate_policies='strict',
+                         candidate_strict_networks_max='1')
+        waffle = network_count_check.filter_factory(self.conf)(self.app)
+        body = '{"virtual_interface": {"network_id": "%s"}}'
+        resp = waffle.__call__.request(self.attach_url, method='POST',
+                                       body=body % PRIV)
+        self.assertEqual(self.app, resp)
+        self.m_get_nwinfo.return_value.append(MockedVIFInfo('v2', PRIV))
+        resp = waffle.__call__.request(self.attach_url, method='POST',
+                                       body=body % GPU)
+        self.assertEqual(self.app, resp)
+        # Candidates decide on the networks the active policy looked up
+        self.assertEqual(2, self.m_instance.call_count)
+
+        report = waffle._stats()['candidates']
+        self.assertEqual(2, report['strict']['evaluated'])
+        self.assertEqual(1, report['strict']['newly_rejected'])
+        self.assertEqual(1, report['strict']['would_reject'])
+
+    def test_candidates_see_boots(self):
+        self.conf.update(candidate_policies='gpu',
+                         candidate_gpu_policy_rules='ban %s' % GPU)
+        waffle = network_count_check.filter_factory(self.conf)(self.app)
+        self.assertEqual(self.app, self._boot(waffle, PUB, GPU))
+        report = waffle._stats()['candidates']['gpu']
+        self.assertEqual({'rule1': 1}, report['rules'])
+
+    def test_detach_report_only(self):
+        self.conf['report_only'] = 'true'
+        waffle = detach_network_check.filter_factory(self.conf)(self.app)
+        resp = waffle.__call__.request('%s/%s' % (self.attach_url, VIF),
+                                       method='DELETE')
+        self.assertEqual(self.app, resp)
+        self.assertEqual(1, waffle.would_reject)
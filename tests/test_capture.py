@@ -0,0 +1,181 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+import os
+import shutil
+import tempfile
+
+from wafflehaus.nova import ids
+from wafflehaus.nova.networking import capture
+from wafflehaus.nova.networking import detach_network_check
+from wafflehaus.nova.networking import network_count_check
+from wafflehaus import tests
+
+PUB = '00000000-0000-0000-0000-000000000000'
+PRIV = '11111111-1111-1111-1111-111111111111'
+BANNED = '22222222-2222-2222-2222-222222222222'
+SERVER = '33333333-3333-3333-3333-333333333333'
+VIF = '44444444-4444-4444-4444-444444444444'
+
+
+class FakeContext(object):
+    project_id = '123456'
+
+
+class FakeVIF(dict):
+    def __init__(self, vif_id, net_id):
+        super(FakeVIF, self).__init__(
+            address='fa:16:3e:00:00:01', id=vif_id,
+            network={'id': net_id, 'label': 'net'})
+
+    def fixed_ips(self):
+        return [{'address': '192.168.1.1'}]
+
+
+class TestCaptureRing(tests.TestCase):
+
+    def setUp(self):
+        super(TestCaptureRing, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'capture')
+
+    def test_summaries_read_back(self):
+        traffic = capture.TrafficCapture(self.path, slots=4)
+        traffic.record(capture.ATTACH, capture.REJECT, body_bytes=60,
+                       lookup_seconds=0.0025, server_vifs=3,
+                       project='123456', server=SERVER,
+                       networks=[PUB, 'not-a-uuid'])
+        records = capture.read_captures(traffic._ring.path)
+        self.assertEqual(1, len(records))
+        record = records[0]
+        self.assertEqual(capture.ATTACH, record.kind)
+        self.assertEqual(capture.REJECT, record.decision)
+        self.assertEqual(60, record.body_bytes)
+        self.assertAlmostEqual(0.0025, record.lookup_seconds)
+        self.assertEqual(3, record.server_vifs)
+        self.assertEqual(capture.redact(SERVER), record.server)
+        self.assertEqual(0, record.vif)
+        self.assertEqual(PUB, record.networks[0])
+        self.assertEqual(ids.unpack(capture.redact('not-a-uuid')),
+                         record.networks[1])
+        self.assertFalse(record.truncated)
+
+    def test_newest_kept(self):
+        traffic = capture.TrafficCapture(self.path, slots=3)
+        for body_bytes in range(5):
+            traffic.record(capture.BOOT, capture.ACCEPT,
+                           body_bytes=body_bytes)
+        records = capture.read_captures(traffic._ring.path)
+        self.assertEqual([2, 3, 4], [r.body_bytes for r in records])
+        self.assertEqual([3, 4, 5], [r.sequence for r in records])
+
+    def test_networks_beyond_slot_truncated(self):
+        traffic = capture.TrafficCapture(self.path, slot_bytes=80)
+        traffic.record(capture.BOOT, capture.ACCEPT,
+                       networks=[PUB, PRIV, BANNED])
+        record = capture.read_captures(traffic._ring.path)[0]
+        self.assertEqual([PUB], record.networks)
+        self.assertTrue(record.truncated)
+
+    def test_salted_redaction(self):
+        self.assertNotEqual(capture.redact(SERVER),
+                            capture.redact(SERVER, b'salt'))
+        self.assertEqual(0, capture.redact(None))
+
+    def test_one_file_per_worker(self):
+        traffic = capture.TrafficCapture(self.path + '-%(pid)s')
+        traffic.record(capture.BOOT, capture.ACCEPT)
+        self.assertEqual('%s-%d' % (self.path, os.getpid()),
+                         traffic._ring.path)
+        traffic = capture.TrafficCapture(self.path)
+        traffic.record(capture.BOOT, capture.ACCEPT)
+        self.assertEqual('%s.%d' % (self.path, os.getpid()),
+                         traffic._ring.path)
+
+    def test_sampling(self):
+        traffic = capture.TrafficCapture(self.path, sample_rate=0.5,
+                                         rng=lambda: 0.7)
+        self.assertFalse(traffic.should_sample())
+        traffic.rng = lambda: 0.2
+        self.assertTrue(traffic.should_sample())
+
+
+class TestCapturedChecks(tests.TestCase):
+
+    def setUp(self):
+        super(TestCapturedChecks, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.create_patch('wafflehaus.nova.networking.capture._captures')
+        capture._captures = {}
+        nova_path = 'wafflehaus.nova.nova_base.WafflehausNova'
+        self.m_ctx = self.create_patch('%s._get_context' % nova_path)
+        self.m_ctx.return_value = FakeContext()
+        self.create_patch('%s._get_instance' % nova_path)
+        self.m_get_nwinfo = self.create_patch(
+            'nova.compute.utils.get_nw_info_for_instance')
+        self.m_get_nwinfo.return_value = [FakeVIF(VIF, PUB)]
+        self.conf = {'enabled': 'true', 'banned_nets': BANNED,
+                     'networks_max': '3',
+                     'required_nets': PUB,
+                     'capture_file': os.path.join(self.tmpdir, 'capture'),
+                     'capture_salt': 'salt'}
+        self.url = '/123456/servers/%s/os-virtual-interfacesv2' % SERVER
+
+    def _records(self, waffle):
+        return capture.read_captures(waffle.capture._ring.path)
+
+    def test_boot_and_attach_captured(self):
+        waffle = network_count_check.filter_factory(self.conf)(self.app)
+        body = '{"server": {"networks": [{"uuid": "%s"}]}}' % BANNED
+        waffle.__call__.request('/123456/servers', method='POST', body=body)
+        waffle.__call__.request(
+            self.url, method='POST',
+            body='{"virtual_interface": {"network_id": "%s"}}' % PRIV)
+        boot, attach = self._records(waffle)
+        self.assertEqual(capture.BOOT, boot.kind)
+        self.assertEqual(capture.REJECT, boot.decision)
+        self.assertEqual(len(body), boot.body_bytes)
+        self.assertEqual([BANNED], boot.networks)
+        self.assertEqual(capture.ATTACH, attach.kind)
+        self.assertEqual(capture.ACCEPT, attach.decision)
+        self.assertEqual(1, attach.server_vifs)
+        self.assertEqual(capture.redact(SERVER, b'salt'), attach.server)
+        self.assertEqual(capture.redact('123456', b'salt'), attach.project)
+        self.assertEqual(2, waffle._stats()['capture']['captured'])
+
+    def test_detach_captured(self):
+        waffle = detach_network_check.filter_factory(self.conf)(self.app)
+        waffle.__call__.request('%s/%s' % (self.url, VIF), method='DELETE')
+        record, = self._records(waffle)
+        self.assertEqual(capture.DETACH, record.kind)
+        self.assertEqual(capture.REJECT, record.decision)
+        self.assertEqual(capture.redact(VIF, b'salt'), record.vif)
+        self.assertEqual([PUB], record.networks)
+
+    def test_salt_required(self):
+        del self.conf['capture_salt']
+        self.assertRaises(ValueError,
+                          network_count_check.filter_factory(self.conf),
+                          self.app)
+        self.conf['capture_salt'] = ''
+        self.assertRaises(ValueError,
+                          detach_network_check.filter_factory(self.conf),
+                          self.app)
+
+    def test_disabled_by_default(self):
+        del self.conf['capture_file']
+        waffle = network_count_check.filter_factory(self.conf)(self.app)
+        self.assertIsNone(waffle.capture)
@@ -0,0 +1,263 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import uuid
+
+import mock
+
+from wafflehaus.nova.networking import compliance_scan
+from wafflehaus import tests
+
+PUB = '00000000-0000-0000-0000-000000000000'
+PRIV = '11111111-1111-1111-1111-111111111111'
+BANNED = '22222222-2222-2222-2222-222222222222'
+GPU = '33333333-3333-3333-3333-333333333333'
+
+
+class Interrupted(Exception):
+    pass
+
+
+class FakeCell(object):
+    """A cell database with nova's instance tables, in SQLite."""
+
+    def __init__(self, path):
+        self.url = 'sqlite:///' + path
+        self.db = sqlite3.connect(path)
+        self.db.executescript(
+            'CREATE TABLE instances (id INTEGER PRIMARY KEY, uuid TEXT, '
+            'project_id TEXT, image_ref TEXT, deleted INTEGER);'
+            'CREATE TABLE instance_info_caches (id INTEGER PRIMARY KEY, '
+            'instance_uuid TEXT, network_info TEXT, deleted INTEGER);'
+            'CREATE TABLE instance_extra (id INTEGER PRIMARY KEY, '
+            'instance_uuid TEXT, flavor TEXT);')
+
+    def add(self, project, networks, server=None, deleted=False,
+            flavor=None, network_info=None):
+        server = server or str(uuid.uuid4())
+        if network_info is None:
+            network_info = json.dumps([
+                {'id': str(uuid.uuid4()), 'address': 'fa:16:3e:00:00:01',
+                 'network': {'id': net, 'label': 'net'}}
+                for net in networks])
+        self.db.execute('INSERT INTO instances (uuid, project_id, '
+                        'image_ref, deleted) VALUES (?, ?, ?, ?)',
+                        (server, project, 'image', 1 if deleted else 0))
+        self.db.execute('INSERT INTO instance_info_caches (instance_uuid, '
+                        'network_info, deleted) VALUES (?, ?, 0)',
+                        (server, network_info))
+        if flavor:
+            self.db.execute(
+                'INSERT INTO instance_extra (instance_uuid, flavor) '
+                'VALUES (?, ?)',
+                (server, json.dumps({'cur': {'nova_object.data': {
+                    'flavorid': flavor}}})))
+        self.db.commit()
+        return server
+
+
+def _exit_worker(*args):
+    os._exit(1)
+
+
+class TestComplianceScan(tests.TestCase):
+
+    def setUp(self):
+        super(TestComplianceScan, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.cell1 = FakeCell(os.path.join(self.tmpdir, 'cell1.db'))
+        self.cell2 = FakeCell(os.path.join(self.tmpdir, 'cell2.db'))
+        self.cells = [('cell1', self.cell1.url), ('cell2', self.cell2.url)]
+        self.conf = {'required_nets': PUB, 'banned_nets': BANNED,
+                     'optional_nets': PUB, 'networks_max': '1'}
+        self.checkpoint = os.path.join(self.tmpdir, 'scan.json')
+
+    def _fill(self, count):
+        for i in range(count):
+            cell = self.cell1 if i % 2 else self.cell2
+            networks = [PUB, PRIV] if i % 3 else [PRIV]
+            cell.add('project%d' % (i % 4), networks)
+
+    def _scanner(self, **kwargs):
+        return compliance_scan.ComplianceScanner(self.conf, self.cells,
+                                                 **kwargs)
+
+    @staticmethod
+    def _unordered(report):
+        # Examples are kept in the order batches finish
+        for entry in report['projects'].values():
+            entry['servers'].sort()
+        return report
+
+    def test_uuid_ranges_cover_every_uuid(self):
+        ranges = compliance_scan.uuid_ranges(4)
+        self.assertEqual(4, len(ranges))
+        self.assertEqual(('', '40000000'), ranges[0])
+        self.assertEqual(('c0000000', None), ranges[-1])
+        for server in ('00000000-0000-0000-0000-000000000000',
+                       '3fffffff-ffff-ffff-ffff-ffffffffffff',
+                       '40000000-0000-0000-0000-000000000000',
+                       'ffffffff-ffff-ffff-ffff-ffffffffffff'):
+            matches = [r for r in ranges if r[0] < server and
+                       (r[1] is None or server < r[1])]
+            self.assertEqual(1, len(matches))
+
+    def test_violations_summarized(self):
+        ok = self.cell1.add('p1', [PUB, PRIV])
+        missing = self.cell1.add('p1', [PRIV])
+        banned = self.cell2.add('p2', [PUB, PRIV, BANNED])
+        self.cell2.add('p2', [PUB, PRIV, GPU])
+        self.cell2.add('p3', [PRIV], deleted=True)
+        self.cell2.add('p3', [], network_info='not json')
+        report = self._scanner().run()
+        self.assertEqual(5, report['scanned'])
+        self.assertEqual(1, report['unreadable'])
+        self.assertEqual(3, report['violating'])
+        self.assertEqual({'required': 1, 'banned': 1, 'count': 1},
+                         report['rules'])
+        self.assertEqual({'scanned': 2, 'violating': 1},
+                         report['cells']['cell1'])
+        self.assertEqual([missing], report['projects']['p1']['servers'])
+        self.assertNotIn(ok, report['projects']['p1']['servers'])
+        self.assertEqual(2, report['projects']['p2']['violating'])
+        self.assertIn(banned, report['projects']['p2']['servers'])
+        self.assertNotIn('p3', report['projects'])
+
+    def test_every_instance_scanned_once(self):
+        self._fill(60)
+        report = self._scanner(ranges_per_cell=3, batch_size=4).run()
+        self.assertEqual(60, report['scanned'])
+        self.assertEqual(20, report['violating'])
+        self.assertEqual(20, report['rules']['required'])
+
+    def test_examples_bounded(self):
+        self._fill(60)
+        report = self._scanner(max_examples=2).run()
+        for entry in report['projects'].values():
+            self.assertEqual(2, len(entry['servers']))
+
+    def test_resumes_from_checkpoint(self):
+        self._fill(60)
+        expected = self._scanner().run()
+
+        def interrupt(scanner):
+            if scanner.summary.scanned >= 20:
+                raise Interrupted()
+
+        scanner = self._scanner(ranges_per_cell=2, batch_size=5,
+                                checkpoint=self.checkpoint,
+                                checkpoint_interval=0,
+                                on_progress=interrupt)
+        self.assertRaises(Interrupted, scanner.run)
+        done, total = scanner.progress()
+        self.assertTrue(done < total)
+
+        resumed = self._scanner(ranges_per_cell=2, batch_size=5,
+                                checkpoint=self.checkpoint)
+        self.assertEqual(self._unordered(expected),
+                         self._unordered(resumed.run()))
+        self.assertEqual((4, 4), resumed.progress())
+
+    def test_checkpoint_of_other_policy_refused(self):
+        self._fill(4)
+        self._scanner(checkpoint=self.checkpoint).run()
+        self.conf['networks_max'] = '2'
+        self.assertRaises(ValueError,
+                          self._scanner(checkpoint=self.checkpoint).run)
+
+    def test_instance_facts_from_flavor(self):
+        self.conf = {'networks_max': '5',
+                     'policy_rules': 'gpu: require %s when flavor = g1' % GPU}
+        self.cell1.add('p1', [PRIV], flavor='g1')
+        self.cell1.add('p1', [PRIV], flavor='m1')
+        self.cell1.add('p1', [PRIV, GPU], flavor='g1')
+        report = self._scanner().run()
+        self.assertEqual({'gpu': 1}, report['rules'])
+
+    def test_processes(self):
+        self._fill(40)
+        inline = self._scanner(batch_size=3).run()
+        pooled = self._scanner(batch_size=3, processes=2).run()
+        self.assertEqual(inline['scanned'], pooled['scanned'])
+        self.assertEqual(inline['rules'], pooled['rules'])
+        self.assertEqual(inline['cells'], pooled['cells'])
+
+    def test_pooled_scan_after_inline_keeps_workers(self):
+        self._fill(12)
+        inline = self._scanner(batch_size=3).run()
+        self.assertFalse('connections' in compliance_scan._worker)
+        # A connection another thread of this process still holds
+        self.addCleanup(compliance_scan._worker.clear)
+        compliance_scan._init_worker(self.conf)
+        thread = threading.Thread(target=compliance_scan._connection,
+                                  args=(self.cell1.url,))
+        thread.start()
+        thread.join()
+        pools = []
+        workers = set()
+        new_pool = compliance_scan.multiprocessing.Pool
+
+        def spy(*args):
+            pools.append(new_pool(*args))
+            return pools[-1]
+
+        def on_progress(scanner):
+            workers.add(frozenset(w.pid for w in pools[0]._pool))
+
+        with mock.patch.object(compliance_scan.multiprocessing, 'Pool', spy):
+            pooled = self._scanner(batch_size=3, processes=2,
+                                   batch_timeout=5, checkpoint_interval=0,
+                                   on_progress=on_progress).run()
+        self.assertEqual(inline['scanned'], pooled['scanned'])
+        # Workers dying in their initializer would have been replaced
+        self.assertEqual(1, len(workers))
+
+    def test_dead_worker_fails_its_range(self):
+        self._fill(6)
+        scanner = self._scanner(processes=2, batch_timeout=0.5,
+                                checkpoint=self.checkpoint)
+        with mock.patch.object(compliance_scan, 'scan_batch', _exit_worker):
+            self.assertRaises(RuntimeError, scanner.run)
+        state = compliance_scan.load_checkpoint(self.checkpoint)
+        self.assertEqual([0] * 8, [r['scanned'] for r in state['ranges']])
+        report = self._scanner(checkpoint=self.checkpoint).run()
+        self.assertEqual(6, report['scanned'])
+
+    def test_errors_stop_the_scan(self):
+        self.cells.append(('broken', 'sqlite:///' +
+                           os.path.join(self.tmpdir, 'missing.db')))
+        self.assertRaises(RuntimeError, self._scanner().run)
+
+    def test_cells_from_api_db(self):
+        path = os.path.join(self.tmpdir, 'api.db')
+        db = sqlite3.connect(path)
+        db.execute('CREATE TABLE cell_mappings (id INTEGER PRIMARY KEY, '
+                   'uuid TEXT, name TEXT, database_connection TEXT)')
+        db.executemany('INSERT INTO cell_mappings (uuid, name, '
+                       'database_connection) VALUES (?, ?, ?)',
+                       [(compliance_scan.CELL0_UUID, 'cell0', 'x'),
+                        ('c1', 'cell1', self.cell1.url),
+                        ('c2', None, self.cell2.url)])
+        db.commit()
+        db.close()
+        self.assertEqual(
+            [('cell1', self.cell1.url), ('c2', self.cell2.url)],
+            compliance_scan.cells_from_api_db('sqlite:///' + path))
@@ -0,0 +1,124 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+import json
+import sys
+
+import webob.exc
+
+from wafflehaus.nova.networking import heavy_hitters
+from wafflehaus.nova.networking import network_count_check
+from wafflehaus import tests
+
+
+class FakeContext(object):
+
+    def __init__(self, project_id='123456', is_admin=False):
+        self.project_id = project_id
+        self.is_admin = is_admin
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def _footprint(hitters):
+    sketch = hitters.sketch
+    return (sum(sys.getsizeof(row) for row in sketch.rows) +
+            sys.getsizeof(hitters.top))
+
+
+class TestHeavyHitters(tests.TestCase):
+
+    def test_sketch_never_underestimates(self):
+        sketch = heavy_hitters.CountMinSketch(width=64, depth=3)
+        for i in range(1000):
+            sketch.add(i % 100)
+        for key in range(100):
+            self.assertTrue(sketch.estimate(key) >= 10)
+        self.assertEqual(1000, sketch.total)
+
+    def test_finds_heavy_hitters_in_noise(self):
+        hitters = heavy_hitters.HeavyHitters(k=3, width=1024, depth=4)
+        for i in range(5000):
+            hitters.add('noise-%d' % i)
+            if i % 10 == 0:
+                hitters.add('tenant-a')
+            if i % 20 == 0:
+                hitters.add('tenant-b')
+        top = [key for key, _ in hitters.items()[:2]]
+        self.assertEqual(['tenant-a', 'tenant-b'], top)
+
+    def test_memory_constant_under_distinct_keys(self):
+        hitters = heavy_hitters.HeavyHitters(k=20, width=2048, depth=4)
+        for i in range(10000):
+            hitters.add(i)
+        before = _footprint(hitters)
+        for i in range(10000, 1000000):
+            hitters.add(i)
+        self.assertEqual(before, _footprint(hitters))
+        self.assertEqual(20, len(hitters.top))
+
+    def test_windows_rotate(self):
+        clock = FakeClock()
+        windowed = heavy_hitters.WindowedHeavyHitters(window=60, k=5,
+                                                      clock=clock)
+        windowed.add('a')
+        clock.now += 60
+        windowed.add('b')
+        report = windowed.report()
+        self.assertEqual([('b', 1)], report['top'])
+        self.assertEqual([('a', 1)], report['previous_top'])
+        clock.now += 120
+        report = windowed.report()
+        self.assertEqual([], report['top'])
+        self.assertEqual([], report['previous_top'])
+
+
+class TestRejectionStatsEndpoint(tests.TestCase):
+
+    def setUp(self):
+        super(TestRejectionStatsEndpoint, self).setUp()
+        self.create_patch(
+            'wafflehaus.nova.networking.heavy_hitters._rejection_stats')
+        heavy_hitters._rejection_stats = None
+        ctx_path = 'wafflehaus.nova.nova_base.WafflehausNova._get_context'
+        self.m_ctx = self.create_patch(ctx_path)
+        self.m_ctx.return_value = FakeContext()
+        self.banned = '00000000-0000-0000-0000-000000000000'
+        self.conf = {'enabled': 'true', 'rejection_stats': 'true',
+                     'banned_nets': self.banned,
+                     'stats_path': '/wafflehaus/stats'}
+
+    def test_rejections_reported_to_admins(self):
+        result = network_count_check.filter_factory(self.conf)(self.app)
+        body = '{"server": {"networks":[{"uuid": "%s"}]}}' % self.banned
+        resp = result.__call__.request('/123456/servers', method='POST',
+                                       body=body)
+        self.assertTrue(isinstance(resp, webob.exc.HTTPForbidden))
+
+        resp = result.__call__.request('/wafflehaus/stats', method='GET')
+        self.assertTrue(isinstance(resp, webob.exc.HTTPForbidden))
+
+        self.m_ctx.return_value = FakeContext(is_admin=True)
+        resp = result.__call__.request('/wafflehaus/stats', method='GET')
+        stats = json.loads(resp.body.decode('utf-8'))
+        rejections = stats['rejections']
+        self.assertEqual([['123456', 1]], rejections['project']['top'])
+        self.assertEqual([['banned', 1]], rejections['rule']['top'])
+        self.assertEqual([[self.banned, 1]], rejections['network']['top'])
@@ -0,0 +1,174 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+import threading
+
+from wafflehaus.nova import hedging
+from wafflehaus.nova.networking import detach_network_check
+from wafflehaus.nova import replica
+from wafflehaus import tests
+
+SERVER = '33333333-3333-3333-3333-333333333333'
+
+
+class FakeContext(object):
+    project_id = '123456'
+    is_admin = True
+
+
+class TestHedgedLookups(tests.TestCase):
+
+    def setUp(self):
+        super(TestHedgedLookups, self).setUp()
+        self.hedger = hedging.HedgedLookups(budget=50, burst=2, refresh=10,
+                                            min_delay=0.001)
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+
+    def _learn(self, seconds=0.001):
+        for _ in range(10):
+            self.hedger.latency.add(seconds)
+
+    def _stuck(self):
+        self.release.wait(5)
+        return 'primary'
+
+    def test_percentile(self):
+        window = hedging.LatencyWindow(percentile=90, size=100, refresh=100)
+        for i in range(100):
+            window.add(i / 1000.0)
+        self.assertEqual(0.09, window.value)
+        window.add(5.0)
+        self.assertEqual(0.09, window.value)
+
+    def test_inline_until_latency_known(self):
+        threads = []
+        self.assertIsNone(self.hedger.delay())
+        self.hedger.call(lambda: threads.append(threading.current_thread()))
+        self.assertEqual([threading.current_thread()], threads)
+        self.assertEqual(0, self.hedger.hedged)
+
+    def test_slow_lookup_hedged(self):
+        self._learn()
+        self.assertEqual('hedge',
+                         self.hedger.call(self._stuck, lambda: 'hedge'))
+        self.assertEqual('fast', self.hedger.call(lambda: 'fast'))
+        stats = self.hedger.stats()
+        self.assertEqual(2, stats['lookups'])
+        self.assertEqual(1, stats['hedged'])
+        self.assertEqual(0.5, stats['hedge_rate'])
+        self.assertEqual(1, stats['hedge_wins'])
+        self.assertEqual(1.0, stats['threshold_ms'])
+
+    def test_budget_bounds_hedges(self):
+        self.hedger = hedging.HedgedLookups(budget=10, burst=1, refresh=10,
+                                            min_delay=0.001)
+        self._learn()
+        self.assertEqual('hedge',
+                         self.hedger.call(self._stuck, lambda: 'hedge'))
+        self.release.set()
+        self.assertEqual('primary',
+                         self.hedger.call(self._stuck, lambda: 'hedge'))
+        self.assertEqual(1, self.hedger.hedged)
+        for _ in range(12):
+            self.hedger.call(lambda: None)
+        self.assertTrue(self.hedger.tokens >= 1)
+
+    def test_failed_hedge_does_not_answer(self):
+        self._learn()
+
+        def fail():
+            raise ValueError()
+
+        def slow():
+            self.release.wait(0.05)
+            return 'primary'
+
+        self.assertEqual('primary', self.hedger.call(slow, fail))
+        self.assertEqual(0, self.hedger.hedge_wins)
+        self.assertRaises(ValueError, self.hedger.call, fail)
+
+
+class TestHedgedFilter(tests.TestCase):
+
+    def setUp(self):
+        super(TestHedgedFilter, self).setUp()
+        self.create_patch('wafflehaus.nova.hedging._shared')
+        hedging._shared = None
+        self.create_patch('wafflehaus.nova.replica._shared')
+        replica._shared = None
+        nova_path = 'wafflehaus.nova.nova_base.WafflehausNova'
+        self.m_ctx = self.create_patch('%s._get_context' % nova_path)
+        self.m_ctx.return_value = FakeContext()
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+        self.m_get_instance = self.create_patch('%s._get_instance' %
+                                                nova_path)
+        self.m_get_instance.side_effect = lambda *args: self.release.wait(5)
+        self.m_replica = self.create_patch(
+            '%s._get_instance_from_replica' % nova_path)
+        self.conf = {'enabled': 'true', 'hedge_budget': '5',
+                     'hedge_to_replica': 'true', 'replica_max_lag': '5',
+                     'replica_lag_api': 'tests.test_replica.FakeLag',
+                     'stats_path': '/stats'}
+
+    def _waffle(self):
+        waffle = detach_network_check.filter_factory(self.conf)(self.app)
+        # Measured by the tests, not a worker
+        waffle.replica._pid = replica.os.getpid()
+        for _ in range(100):
+            waffle.hedging.latency.add(0.001)
+        return waffle
+
+    def test_disabled_by_default(self):
+        waffle = detach_network_check.filter_factory(
+            {'enabled': 'true'})(self.app)
+        self.assertIsNone(waffle.hedging)
+
+    def test_hedge_to_replica_needs_lag_bound(self):
+        del self.conf['replica_max_lag']
+        self.assertRaises(ValueError,
+                          detach_network_check.filter_factory(self.conf),
+                          self.app)
+
+    def test_slow_lookup_answered_from_replica(self):
+        waffle = self._waffle()
+        waffle.replica.measure()
+        instance = waffle._lookup_instance(FakeContext(), SERVER)
+        self.assertEqual(self.m_replica.return_value, instance)
+        self.assertEqual(SERVER, self.m_replica.call_args[0][1])
+        resp = waffle.__call__.request('/stats', method='GET')
+        hedged = resp.json_body['hedging']
+        self.assertEqual(1, hedged['hedged'])
+        self.assertEqual(1, hedged['hedge_wins'])
+
+    def test_stale_replica_not_hedged_to(self):
+        waffle = self._waffle()
+        waffle.replica.measure()
+        self.now = waffle.replica.measured_at + 16
+        waffle.replica.clock = lambda: self.now
+        lookups = []
+
+        def get_instance(*args):
+            lookups.append(args)
+            if len(lookups) == 1:
+                self.release.wait(5)
+            return 'primary'
+
+        self.m_get_instance.side_effect = get_instance
+        instance = waffle._lookup_instance(FakeContext(), SERVER)
+        self.assertEqual('primary', instance)
+        self.assertEqual(2, len(lookups))
+        self.assertFalse(self.m_replica.called)
+        self.assertEqual(1, waffle.replica.lagging)
@@ -0,0 +1,58 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+import uuid
+
+from wafflehaus.nova import ids
+from wafflehaus import tests
+
+NET = '3f2b1c4d-5e6f-4a7b-8c9d-0e1f2a3b4c5d'
+
+
+class TestIds(tests.TestCase):
+
+    def test_round_trip(self):
+        packed = ids.pack(NET)
+        self.assertEqual(uuid.UUID(NET).int, packed)
+        self.assertEqual(NET, ids.unpack(packed))
+        self.assertEqual(packed, ids.pack(packed))
+        self.assertEqual(packed, ids.pack(NET.upper()))
+
+    def test_other_values_unchanged(self):
+        for value in ('net1', '123456', NET.replace('-', ''),
+                      NET[:-1] + 'g', NET.replace('-', '+'),
+                      ' ' + NET[1:], None):
+            self.assertEqual(value, ids.pack(value))
+            self.assertEqual(value, ids.unpack(value))
+        self.assertEqual(True, ids.unpack(True))
+
+    def test_networks_interned(self):
+        first = ids.pack_network(NET)
+        second = ids.pack_network(str(uuid.UUID(NET)))
+        self.assertTrue(first is second)
+
+    def test_interning_bounded(self):
+        self.create_patch('wafflehaus.nova.ids._interned', {})
+        self.create_patch('wafflehaus.nova.ids.MAX_INTERNED', 1)
+        ids._interned = {}
+        ids.MAX_INTERNED = 1
+        ids.pack_network(NET)
+        ids.pack_network(str(uuid.uuid4()))
+        self.assertEqual(1, len(ids._interned))
+
+    def test_vifs(self):
+        vif = str(uuid.uuid4())
+        packed = ids.pack_vifs({vif: NET, 'v2': 'n2'})
+        self.assertEqual({ids.pack(vif): ids.pack(NET), 'v2': 'n2'}, packed)
+        self.assertEqual({vif: NET, 'v2': 'n2'}, ids.unpack_vifs(packed))
@@ -0,0 +1,437 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+import json
+
+import webob.exc
+
+from wafflehaus.nova import ids
+from wafflehaus.nova.networking import detach_network_check
+from wafflehaus.nova.networking import instance_networks
+from wafflehaus.nova.networking import network_count_check
+from wafflehaus.nova import notifications
+from wafflehaus import tests
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeContext(object):
+    project_id = '123456'
+
+
+class MockedVIFInfo(dict):
+    def __init__(self, vif_id, net_id):
+        self['address'] = '196.168.1.1'
+        self['id'] = vif_id
+        self['network'] = {'id': net_id, 'label': 'nw_label'}
+
+    def fixed_ips(self):
+        return [{'address': '192.168.1.1'}]
+
+
+class FakeNova(object):
+    """A downstream WSGI app answering with a fixed status."""
+
+    def __init__(self, status='200 OK'):
+        self.status = status
+        self.calls = 0
+
+    def __call__(self, environ, start_response):
+        self.calls += 1
+        start_response(self.status, [('Content-Type', 'application/json')])
+        return [b'{}']
+
+
+class TestInstanceNetworkCache(tests.TestCase):
+
+    def setUp(self):
+        super(TestInstanceNetworkCache, self).setUp()
+        self.clock = FakeClock()
+        self.cache = instance_networks.InstanceNetworkCache(
+            max_entries=10, ttl=3600, refresh_interval=60, clock=self.clock)
+
+    def test_seed_and_incremental_updates(self):
+        self.assertIsNone(self.cache.get('p', 's'))
+        self.cache.seed('p', 's', {'vif1': 'net1'})
+        entry = self.cache.get('p', 's')
+        self.assertEqual(set(['net1']), entry.networks())
+
+        self.assertTrue(self.cache.apply_attach('p', 's', 'net2',
+                                                version=entry.version))
+        self.assertEqual(set(['net1', 'net2']),
+                         self.cache.get('p', 's').networks())
+        self.assertTrue(self.cache.apply_detach('p', 's', 'vif1'))
+        self.assertEqual(set(['net2']), self.cache.get('p', 's').networks())
+
+    def test_stale_version_drops_entry(self):
+        entry = self.cache.seed('p', 's', {'vif1': 'net1'})
+        version = entry.version
+        self.cache.apply_attach('p', 's', 'net2', version=version)
+        self.assertFalse(self.cache.apply_attach('p', 's', 'net3',
+                                                 version=version))
+        self.assertIsNone(self.cache.get('p', 's'))
+        self.assertEqual(1, self.cache.stats()['conflicts'])
+
+    def test_refresh_detects_divergence(self):
+        self.cache.seed('p', 's', {'vif1': 'net1'})
+        self.clock.now += 60
+        self.assertIsNone(self.cache.get('p', 's'))
+        self.cache.seed('p', 's', {'vif1': 'net1'})
+        self.assertEqual(0, self.cache.stats()['divergences'])
+        self.clock.now += 60
+        self.cache.seed('p', 's', {'vif1': 'net1', 'vif2': 'net2'})
+        stats = self.cache.stats()
+        self.assertEqual(1, stats['seeds'])
+        self.assertEqual(2, stats['refreshes'])
+        self.assertEqual(1, stats['divergences'])
+
+    def test_detach_of_unknown_vif_invalidates(self):
+        self.cache.seed('p', 's', {'vif1': 'net1'})
+        self.cache.apply_attach('p', 's', 'net2')
+        self.assertFalse(self.cache.apply_detach('p', 's', 'vif2'))
+        self.assertIsNone(self.cache.get('p', 's'))
+
+    def test_notification_invalidates(self):
+        self.cache.seed('p', 's', {'vif1': 'net1'})
+        self.cache.on_notification('instance.interface_attach.end', None,
+                                   's')
+        self.assertIsNone(self.cache.get('p', 's'))
+
+    def test_prefetch_hits_and_waste(self):
+        self.assertTrue(self.cache.prefetch('p', 's1', {'vif1': 'net1'}))
+        self.assertFalse(self.cache.prefetch('p', 's1', {'vif1': 'net1'}))
+        self.assertTrue(self.cache.prefetch('p', 's2', {'vif2': 'net2'}))
+        self.assertTrue(self.cache.prefetch('p', 's3', {'vif3': 'net3'}))
+        self.cache.get('p', 's1')
+        self.cache.get('p', 's1')
+        self.assertTrue(self.cache.prefetch('p', 's2', {'vif4': 'net2'}))
+        stats = self.cache.stats()['prefetch']
+        self.assertEqual(4, stats['prefetches'])
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(2, stats['waiting'])
+        self.assertEqual(1, stats['wasted'])
+        self.clock.now += 60
+        self.assertEqual(3, self.cache.stats()['prefetch']['wasted'])
+
+    def test_prefetch_keeps_facts(self):
+        self.cache.seed('p', 's', {'vif1': 'net1'}, {'flavor': '1'})
+        self.cache.apply_attach('p', 's', 'net2')
+        self.assertTrue(self.cache.prefetch('p', 's', {'vif1': 'net1',
+                                                       'vif2': 'net2'}))
+        entry = self.cache.get('p', 's')
+        self.assertEqual({'flavor': '1'}, entry.facts)
+        self.assertEqual([], entry.pending)
+
+
+class TestCachedChecks(tests.TestCase):
+
+    def setUp(self):
+        super(TestCachedChecks, self).setUp()
+        self.create_patch(
+            'wafflehaus.nova.networking.instance_networks._shared')
+        instance_networks._shared = None
+        self.create_patch('wafflehaus.nova.notifications.ensure_listening')
+        nova_path = 'wafflehaus.nova.nova_base.WafflehausNova'
+        self.m_ctx = self.create_patch('%s._get_context' % nova_path)
+        self.m_ctx.return_value = FakeContext()
+        self.m_instance = self.create_patch('%s._get_instance' % nova_path)
+        self.m_get_nwinfo = self.create_patch(
+            'nova.compute.utils.get_nw_info_for_instance')
+        self.server = '11111111-1111-1111-1111-111111111111'
+        self.vif = '22222222-2222-2222-2222-222222222222'
+        self.pubnet = '00000000-0000-0000-0000-000000000000'
+        self.m_get_nwinfo.return_value = [MockedVIFInfo(self.vif,
+                                                        self.pubnet)]
+        self.nova = FakeNova()
+        self.conf = {'enabled': 'true', 'networks_max': '3',
+                     'optional_nets': self.pubnet,
+                     'required_nets': self.pubnet,
+                     'instance_cache_ttl': '600'}
+        self.attach_url = '/123456/servers/%s/os-virtual-interfacesv2' % (
+            self.server)
+        self.body = '{"virtual_interface": {"network_id": "%s"}}'
+
+    def _attach(self, waffle, network):
+        return waffle.__call__.request(self.attach_url, method='POST',
+                                       body=self.body % network)
+
+    def test_repeated_attaches_skip_lookup(self):
+        waffle = network_count_check.filter_factory(self.conf)(self.nova)
+        nets = ['33333333-3333-3333-3333-33333333333%d' % i for i in range(4)]
+        for net in nets[:3]:
+            resp = self._attach(waffle, net)
+            self.assertEqual(200, resp.status_int)
+        resp = self._attach(waffle, nets[3])
+        self.assertTrue(isinstance(resp, webob.exc.HTTPForbidden))
+        self.assertEqual(1, self.m_instance.call_count)
+        self.assertEqual(3, self.nova.calls)
+
+    def test_failed_attach_not_applied(self):
+        self.nova.status = '400 Bad Request'
+        waffle = network_count_check.filter_factory(self.conf)(self.nova)
+        self._attach(waffle, '33333333-3333-3333-3333-333333333333')
+        entry = waffle.network_cache.get('123456', self.server)
+        self.assertEqual(set([ids.pack(self.pubnet)]), entry.networks())
+
+    def test_detach_answered_from_cache_and_applied(self):
+        other_vif = '44444444-4444-4444-4444-444444444444'
+        other_net = '55555555-5555-5555-5555-555555555555'
+        self.m_get_nwinfo.return_value = [
+            MockedVIFInfo(self.vif, self.pubnet),
+            MockedVIFInfo(other_vif, other_net)]
+        attached = '33333333-3333-3333-3333-333333333333'
+        count = network_count_check.filter_factory(self.conf)(self.nova)
+        detach = detach_network_check.filter_factory(self.conf)(self.nova)
+        self._attach(count, attached)
+
+        url = '%s/%%s' % self.attach_url
+        resp = detach.__call__.request(url % self.vif, method='DELETE')
+        self.assertTrue(isinstance(resp, webob.exc.HTTPForbidden))
+        resp = detach.__call__.request(url % other_vif, method='DELETE')
+        self.assertEqual(200, resp.status_int)
+        self.assertEqual(1, self.m_instance.call_count)
+        entry = count.network_cache.get('123456', self.server)
+        self.assertEqual(set([ids.pack(self.pubnet), ids.pack(attached)]),
+                         entry.networks())
+
+    def test_detach_of_unlearned_vif_reseeds(self):
+        new_vif = '44444444-4444-4444-4444-444444444444'
+        attached = '33333333-3333-3333-3333-333333333333'
+        count = network_count_check.filter_factory(self.conf)(self.nova)
+        detach = detach_network_check.filter_factory(self.conf)(self.nova)
+        self._attach(count, attached)
+        self.m_get_nwinfo.return_value = [
+            MockedVIFInfo(self.vif, self.pubnet),
+            MockedVIFInfo(new_vif, attached)]
+
+        url = '%s/%%s' % self.attach_url
+        resp = detach.__call__.request(url % new_vif, method='DELETE')
+        self.assertEqual(200, resp.status_int)
+        self.assertEqual(2, self.m_instance.call_count)
+        entry = count.network_cache.get('123456', self.server)
+        self.assertEqual({ids.pack(self.vif): ids.pack(self.pubnet)},
+                         entry.vifs)
+
+    def test_detach_of_vif_unknown_to_warm_entry_reseeds(self):
+        other_vif = '44444444-4444-4444-4444-444444444444'
+        detach = detach_network_check.filter_factory(self.conf)(self.nova)
+        url = '%s/%%s' % self.attach_url
+        resp = detach.__call__.request(url % self.vif, method='DELETE')
+        self.assertTrue(isinstance(resp, webob.exc.HTTPForbidden))
+        entry = detach.network_cache.get('123456', self.server)
+        self.assertEqual([], entry.pending)
+
+        # Attached through another worker, on the required network
+        self.m_get_nwinfo.return_value = [
+            MockedVIFInfo(self.vif, self.pubnet),
+            MockedVIFInfo(other_vif, self.pubnet)]
+        resp = detach.__call__.request(url % other_vif, method='DELETE')
+        self.assertTrue(isinstance(resp, webob.exc.HTTPForbidden))
+        self.assertEqual(2, self.m_instance.call_count)
+
+        missing = '55555555-5555-5555-5555-555555555555'
+        resp = detach.__call__.request(url % missing, method='DELETE')
+        self.assertTrue(isinstance(resp, webob.exc.HTTPNotFound))
+        self.assertEqual(3, self.m_instance.call_count)
+        self.assertEqual(0, self.nova.calls)
+
+    def test_notification_forces_lookup(self):
+        conf = dict(self.conf, notification_topics='notifications')
+        waffle = network_count_check.filter_factory(conf)(self.nova)
+        self.addCleanup(notifications._handlers.remove,
+                        waffle.network_cache.on_notification)
+        self._attach(waffle, '33333333-3333-3333-3333-333333333333')
+        notifications.dispatch('instance.interface_detach.end',
+                               {'nova_object.data': {
+                                   'uuid': self.server,
+                                   'tenant_id': '123456'}})
+        self._attach(waffle, '33333333-3333-3333-3333-333333333334')
+        self.assertEqual(2, self.m_instance.call_count)
+
+
+class FakeVIFList(object):
+    """A downstream WSGI app listing VIFs as nova's extension does."""
+
+    def __init__(self, vifs):
+        self.vifs = vifs
+        self.calls = 0
+
+    def __call__(self, environ, start_response):
+        self.calls += 1
+        body = json.dumps({'virtual_interfaces': [
+            {'id': vif_id, 'mac_address': 'fa:16:3e:00:00:01',
+             'ip_addresses': [{'network_id': net_id, 'network_label': 'net',
+                               'address': '192.168.1.1'}] if net_id else []}
+            for vif_id, net_id in self.vifs]}).encode('utf-8')
+        start_response('200 OK', [('Content-Type', 'application/json'),
+                                  ('Content-Length', str(len(body)))])
+        return [body]
+
+
+class TestVIFListPrefetch(tests.TestCase):
+
+    def setUp(self):
+        super(TestVIFListPrefetch, self).setUp()
+        self.create_patch(
+            'wafflehaus.nova.networking.instance_networks._shared')
+        instance_networks._shared = None
+        self.create_patch('wafflehaus.nova.notifications.ensure_listening')
+        nova_path = 'wafflehaus.nova.nova_base.WafflehausNova'
+        self.m_ctx = self.create_patch('%s._get_context' % nova_path)
+        self.m_ctx.return_value = FakeContext()
+        self.m_instance = self.create_patch('%s._get_instance' % nova_path)
+        self.server = '11111111-1111-1111-1111-111111111111'
+        self.vif = '22222222-2222-2222-2222-222222222222'
+        self.other_vif = '44444444-4444-4444-4444-444444444444'
+        self.pubnet = '00000000-0000-0000-0000-000000000000'
+        self.privnet = '55555555-5555-5555-5555-555555555555'
+        self.nova = FakeVIFList([(self.vif, self.pubnet),
+                                 (self.other_vif, self.privnet)])
+        self.conf = {'enabled': 'true', 'required_nets': self.pubnet,
+                     'instance_cache_ttl': '600',
+                     'prefetch_vif_lists': 'true'}
+        self.url = '/123456/servers/%s/os-virtual-interfacesv2' % (
+            self.server)
+        self.waffle = detach_network_check.filter_factory(self.conf)(
+            self.nova)
+
+    def test_detach_after_list_needs_no_lookup(self):
+        resp = self.waffle.__call__.request(self.url, method='GET')
+        self.assertEqual(200, resp.status_int)
+        resp = self.waffle.__call__.request(
+            '%s/%s' % (self.url, self.vif), method='DELETE')
+        self.assertTrue(isinstance(resp, webob.exc.HTTPForbidden))
+        resp = self.waffle.__call__.request(
+            '%s/%s' % (self.url, self.other_vif), method='DELETE')
+        self.assertEqual(200, resp.status_int)
+        self.assertFalse(self.m_instance.called)
+        stats = self.waffle.network_cache.stats()['prefetch']
+        self.assertEqual(1, stats['prefetches'])
+        self.assertEqual(1, stats['hits'])
+
+    def test_other_requests_not_prefetched(self):
+        for url in ('/123456/servers/%s' % self.server,
+                    '/654321/servers/%s/os-virtual-interfacesv2' % (
+                        self.server),
+                    '/123456/servers/server/os-virtual-interfacesv2'):
+            self.waffle.__call__.request(url, method='GET')
+        self.assertEqual(0, self.waffle.network_cache.prefetches)
+
+    def test_large_or_incomplete_lists_ignored(self):
+        self.waffle.prefetch_max_bytes = 10
+        self.waffle.__call__.request(self.url, method='GET')
+        self.waffle.prefetch_max_bytes = 65536
+        self.nova.vifs.append((self.vif.replace('2', '6'), None))
+        self.waffle.__call__.request(self.url, method='GET')
+        self.assertEqual(0, self.waffle.network_cache.prefetches)
+
+    def test_disabled_by_default(self):
+        del self.conf['prefetch_vif_lists']
+        waffle = network_count_check.filter_factory(self.conf)(self.nova)
+        self.assertEqual(self.nova,
+                         waffle.__call__.request(self.url, method='GET'))
+
+
+class FakeAttach(object):
+    """A downstream WSGI app answering attaches with the VIF created."""
+
+    def __init__(self, vif_id, net_id):
+        self.vif_id = vif_id
+        self.net_id = net_id
+
+    def __call__(self, environ, start_response):
+        if environ['REQUEST_METHOD'] == 'DELETE':
+            start_response('202 Accepted', [('Content-Length', '0')])
+            return [b'']
+        body = json.dumps({'virtual_interface': {
+            'id': self.vif_id, 'mac_address': 'fa:16:3e:00:00:01',
+            'ip_addresses': [{'network_id': self.net_id,
+                              'network_label': 'net',
+                              'address': '192.168.1.1'}]}}).encode('utf-8')
+        start_response('200 OK', [('Content-Type', 'application/json'),
+                                  ('Content-Length', str(len(body)))])
+        return [body]
+
+
+class TestWriteThrough(tests.TestCase):
+
+    def setUp(self):
+        super(TestWriteThrough, self).setUp()
+        self.create_patch(
+            'wafflehaus.nova.networking.instance_networks._shared')
+        instance_networks._shared = None
+        self.create_patch('wafflehaus.nova.notifications.ensure_listening')
+        nova_path = 'wafflehaus.nova.nova_base.WafflehausNova'
+        self.m_ctx = self.create_patch('%s._get_context' % nova_path)
+        self.m_ctx.return_value = FakeContext()
+        self.m_instance = self.create_patch('%s._get_instance' % nova_path)
+        self.m_get_nwinfo = self.create_patch(
+            'nova.compute.utils.get_nw_info_for_instance')
+        self.server = '11111111-1111-1111-1111-111111111111'
+        self.vif = '22222222-2222-2222-2222-222222222222'
+        self.new_vif = '44444444-4444-4444-4444-444444444444'
+        self.pubnet = '00000000-0000-0000-0000-000000000000'
+        self.attached = '33333333-3333-3333-3333-333333333333'
+        self.m_get_nwinfo.return_value = [MockedVIFInfo(self.vif,
+                                                        self.pubnet)]
+        self.nova = FakeAttach(self.new_vif, self.attached)
+        self.conf = {'enabled': 'true', 'networks_max': '3',
+                     'required_nets': self.pubnet,
+                     'instance_cache_ttl': '600', 'write_through': 'true'}
+        self.url = '/123456/servers/%s/os-virtual-interfacesv2' % (
+            self.server)
+
+    def _attach(self, waffle):
+        body = '{"virtual_interface": {"network_id": "%s"}}' % self.attached
+        return waffle.__call__.request(self.url, method='POST', body=body)
+
+    def test_attached_vif_learned(self):
+        count = network_count_check.filter_factory(self.conf)(self.nova)
+        detach = detach_network_check.filter_factory(self.conf)(self.nova)
+        self.assertEqual(200, self._attach(count).status_int)
+        entry = count.network_cache.get('123456', self.server)
+        self.assertEqual(ids.pack(self.attached),
+                         entry.vifs[ids.pack(self.new_vif)])
+        self.assertEqual([], entry.pending)
+
+        resp = detach.__call__.request('%s/%s' % (self.url, self.new_vif),
+                                       method='DELETE')
+        self.assertEqual(202, resp.status_int)
+        self.assertEqual(1, self.m_instance.call_count)
+        self.assertEqual({ids.pack(self.vif): ids.pack(self.pubnet)},
+                         count.network_cache.get('123456', self.server).vifs)
+        self.assertEqual({'learned': 1, 'unlearned': 0},
+                         count._stats()['write_through'])
+
+    def test_other_network_kept_pending(self):
+        self.nova.net_id = self.pubnet
+        count = network_count_check.filter_factory(self.conf)(self.nova)
+        self._attach(count)
+        entry = count.network_cache.get('123456', self.server)
+        self.assertEqual([ids.pack(self.attached)], entry.pending)
+        self.assertEqual(1, count.vifs_unlearned)
+
+    def test_disabled_by_default(self):
+        del self.conf['write_through']
+        count = network_count_check.filter_factory(self.conf)(self.nova)
+        self._attach(count)
+        entry = count.network_cache.get('123456', self.server)
+        self.assertEqual([ids.pack(self.attached)], entry.pending)
+        self.assertFalse('write_through' in count._stats())
@@ -0,0 +1,160 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+from wafflehaus.nova import cache
+from wafflehaus.nova import memory_budget
+from wafflehaus.nova.networking import instance_networks
+from wafflehaus.nova.networking import network_catalog
+from wafflehaus.nova.networking import network_count_check
+from wafflehaus import tests
+
+
+class TestMemoryBudget(tests.TestCase):
+
+    def setUp(self):
+        super(TestMemoryBudget, self).setUp()
+        self.budget = memory_budget.MemoryBudget(1 << 20)
+
+    def _fill(self, ttl_cache, count, size=100):
+        for i in range(count):
+            ttl_cache.set(i, 'x' * size)
+
+    def test_parse_bytes(self):
+        self.assertEqual(512, memory_budget.parse_bytes('512'))
+        self.assertEqual(64 << 20, memory_budget.parse_bytes('64M'))
+        self.assertEqual(1536, memory_budget.parse_bytes('1.5kb'))
+        self.assertEqual(0, memory_budget.parse_bytes(0))
+
+    def test_plain_objects_counted_shallow(self):
+        class Context(object):
+            pass
+
+        class Mapping(object):
+            def __init__(self, context):
+                self._context = context
+                self.uuid = 'x' * 36
+
+        context = Context()
+        context.service_catalog = ['x' * 1000] * 100
+        size = memory_budget.deep_size(Mapping(context))
+        self.assertTrue(size < 1000, size)
+
+    def test_inherited_slots_counted(self):
+        class Base(object):
+            __slots__ = ('payload',)
+
+        class Entry(Base):
+            __slots__ = ('version',)
+
+        entry = Entry()
+        entry.payload = 'x' * 1000
+        entry.version = 1
+        self.assertTrue(memory_budget.deep_size(entry) > 1000)
+
+    def test_entry_size_estimated(self):
+        ttl_cache = cache.TTLCache('test', 1000, 60, budget=self.budget)
+        self._fill(ttl_cache, 100, size=1000)
+        entry = self.budget.stats()['caches']['test']
+        self.assertEqual(100, entry['entries'])
+        self.assertTrue(1000 < entry['entry_bytes'] < 1500)
+        self.assertEqual(entry['bytes'], self.budget.stats()['bytes'])
+
+    def test_least_valuable_cache_evicted(self):
+        self.budget.max_bytes = 80000
+        hot = cache.TTLCache('hot', 1000, 60, budget=self.budget)
+        cold = cache.TTLCache('cold', 1000, 60, budget=self.budget)
+        self._fill(hot, 40, size=1000)
+        for i in range(40):
+            hot.get(i)
+        self._fill(cold, 40, size=1000)
+        self.assertTrue(self.budget.total_bytes() <= 80000)
+        self.assertEqual(40, len(hot))
+        self.assertTrue(len(cold) < 40)
+        stats = self.budget.stats()
+        self.assertEqual(0, stats['caches']['hot']['evictions'])
+        self.assertEqual(40 - len(cold), stats['caches']['cold']['evictions'])
+        self.assertEqual(1.0, stats['caches']['hot']['hit_rate'])
+        # The oldest entries went first
+        self.assertIsNone(cold.get(0))
+        self.assertIsNotNone(cold.get(39))
+
+    def test_other_caches_evicted_once_one_is_empty(self):
+        self.budget.max_bytes = 20000
+        first = cache.TTLCache('first', 1000, 60, budget=self.budget)
+        self._fill(first, 10, size=1000)
+        second = cache.TTLCache('second', 1000, 60, budget=self.budget)
+        self._fill(second, 30, size=1000)
+        self.assertTrue(self.budget.total_bytes() <= 20000)
+
+    def test_instance_network_entries_measured(self):
+        network_cache = instance_networks.InstanceNetworkCache(
+            budget=self.budget)
+        network_cache.seed('p', '11111111-1111-1111-1111-111111111111',
+                           {'22222222-2222-2222-2222-222222222222':
+                            '00000000-0000-0000-0000-000000000000'})
+        entry = self.budget.stats()['caches']['instance_networks']
+        self.assertTrue(entry['entry_bytes'] > 100)
+
+    def test_same_names_reported_apart(self):
+        keep = [cache.TTLCache('test', 10, 60, budget=self.budget)
+                for _ in range(2)]
+        self.assertEqual(2, len(keep))
+        self.assertEqual(['test', 'test#2'],
+                         sorted(self.budget.stats()['caches']))
+
+
+class TestBudgetConf(tests.TestCase):
+
+    def setUp(self):
+        super(TestBudgetConf, self).setUp()
+        self.create_patch('wafflehaus.nova.memory_budget._shared')
+        memory_budget._shared = None
+        self.create_patch(
+            'wafflehaus.nova.networking.instance_networks._shared')
+        instance_networks._shared = None
+        self.create_patch(
+            'wafflehaus.nova.networking.network_catalog._shared')
+        network_catalog._shared = None
+        self.create_patch('wafflehaus.nova.networking.network_catalog.'
+                          'NetworkCatalog._ensure_worker')
+
+    def test_disabled_by_default(self):
+        self.assertIsNone(memory_budget.MemoryBudget.from_conf({}))
+        waffle = network_count_check.filter_factory(
+            {'enabled': 'true', 'negative_cache_ttl': '30'})(self.app)
+        self.assertIsNone(waffle.negative_cache.budget)
+
+    def test_shared_by_all_caches(self):
+        conf = {'enabled': 'true', 'memory_budget': '64M',
+                'negative_cache_ttl': '30', 'cell_cache_ttl': '60',
+                'instance_cache_ttl': '600', 'resolve_ports': 'true',
+                'network_catalog': 'true',
+                'network_catalog_api': 'wafflehaus.nova.networking.'
+                                       'network_catalog.FakeNetworkAPI'}
+        waffle = network_count_check.filter_factory(conf)(self.app)
+        budget = waffle.memory_budget
+        self.assertEqual(64 << 20, budget.max_bytes)
+        self.assertTrue(waffle.negative_cache.budget is budget)
+        self.assertTrue(waffle.cell_cache.budget is budget)
+        self.assertTrue(waffle.network_cache.entries.budget is budget)
+        self.assertTrue(waffle.port_resolver.cache.budget is budget)
+        self.assertTrue(waffle.network_catalog.lookups.budget is budget)
+        self.assertEqual(['cell_mappings', 'instance_networks',
+                          'negative_lookups', 'network_catalog_lookups',
+                          'port_networks'],
+                         sorted(waffle._stats()['memory_budget']['caches']))
+
+        conf['memory_budget'] = '32M'
+        network_count_check.filter_factory(conf)(self.app)
+        self.assertEqual(32 << 20, budget.max_bytes)
@@ -0,0 +1,232 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+import json
+
+import webob.exc
+
+from wafflehaus.nova import ids
+from wafflehaus.nova.networking import network_catalog
+from wafflehaus.nova.networking import network_count_check
+from wafflehaus import tests
+
+PUB = '00000000-0000-0000-0000-000000000000'
+MINE = '11111111-1111-1111-1111-111111111111'
+THEIRS = '22222222-2222-2222-2222-222222222222'
+NEW = '33333333-3333-3333-3333-333333333333'
+GONE = '44444444-4444-4444-4444-444444444444'
+RBAC = '66666666-6666-6666-6666-666666666666'
+SERVER = '55555555-5555-5555-5555-555555555555'
+
+FAKE_NETWORKS = '%s:rackspace:shared:public %s:123456 %s:654321' % (
+    PUB, MINE, THEIRS)
+SYNC = [('list', None), ('rbac', None)]
+
+
+class FakeContext(object):
+    project_id = '123456'
+    is_admin = False
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestNetworkCatalog(tests.TestCase):
+
+    def setUp(self):
+        super(TestNetworkCatalog, self).setUp()
+        self.create_patch('wafflehaus.nova.networking.network_catalog.'
+                          'NetworkCatalog._ensure_worker')
+        self.api = network_catalog.FakeNetworkAPI(
+            {'fake_networks': FAKE_NETWORKS})
+        self.clock = FakeClock()
+        self.catalog = network_catalog.NetworkCatalog(
+            self.api, full_interval=3600, clock=self.clock)
+        self.context = FakeContext()
+
+    def test_fake_networks_from_conf(self):
+        self.assertEqual((PUB, 'rackspace', True, 'public'),
+                         self.api.get_network(PUB))
+        self.assertEqual((THEIRS, '654321', False, None),
+                         self.api.get_network(THEIRS))
+
+    def test_nothing_refused_before_first_sync(self):
+        self.assertEqual('', self.catalog.check(self.context, [GONE]))
+        self.assertEqual([], self.api.calls)
+
+    def test_owned_and_shared_networks(self):
+        self.catalog.sync()
+        self.assertEqual('', self.catalog.check(self.context, [PUB, MINE]))
+        self.assertEqual(SYNC, self.api.calls)
+        self.assertEqual(('123456', False, None),
+                         self.catalog.index[ids.pack(MINE)])
+
+    def test_foreign_network(self):
+        self.catalog.sync()
+        msg = self.catalog.check(self.context, [MINE, THEIRS])
+        self.assertTrue(THEIRS in msg)
+        self.assertTrue('not available' in msg)
+        self.assertEqual(('visible', THEIRS), self.api.calls[-1])
+        self.context.is_admin = True
+        self.assertEqual('', self.catalog.check(self.context, [THEIRS]))
+        self.assertEqual(1, self.catalog.stats()['foreign'])
+
+    def test_rbac_shared_network(self):
+        self.api.set(RBAC, '654321')
+        self.api.rbac = [(RBAC, '123456'), (THEIRS, '*')]
+        self.catalog.sync()
+        self.assertEqual('', self.catalog.check(self.context,
+                                                [RBAC, THEIRS]))
+        self.assertEqual(SYNC, self.api.calls)
+        self.context.project_id = '111111'
+        msg = self.catalog.check(self.context, [RBAC])
+        self.assertTrue('not available' in msg)
+        self.assertEqual(2, self.catalog.stats()['rbac_shared'])
+
+    def test_foreign_network_visible_to_project(self):
+        self.catalog.sync()
+        # Shared with the project after the last sync
+        self.api.rbac = [(THEIRS, '123456')]
+        for _ in range(2):
+            self.assertEqual('', self.catalog.check(self.context, [THEIRS]))
+        self.assertEqual(SYNC + [('visible', THEIRS)], self.api.calls)
+        self.assertEqual(0, self.catalog.stats()['foreign'])
+        self.assertEqual(1, self.catalog.stats()['visible_lookups'])
+
+    def test_visibility_lookup_failure_allows(self):
+        self.catalog.sync()
+        self.api.error = RuntimeError('neutron is down')
+        self.assertEqual('', self.catalog.check(self.context, [THEIRS]))
+        self.assertEqual(0, self.catalog.stats()['foreign'])
+
+    def test_unknown_network_looked_up(self):
+        self.catalog.sync()
+        self.api.set(NEW, '123456')
+        self.assertEqual('', self.catalog.check(self.context, [NEW]))
+        self.assertEqual('', self.catalog.check(self.context, [NEW]))
+        self.assertEqual(SYNC + [('get', NEW)], self.api.calls)
+        msg = self.catalog.check(self.context, [GONE])
+        self.assertTrue('could not be found' in msg)
+        stats = self.catalog.stats()
+        self.assertEqual(2, stats['fetched'])
+        self.assertEqual(1, stats['unknown'])
+
+    def test_unknown_network_remembered(self):
+        self.catalog.sync()
+        for _ in range(2):
+            msg = self.catalog.check(self.context, [GONE])
+            self.assertTrue('could not be found' in msg)
+        self.assertEqual(SYNC + [('get', GONE)], self.api.calls)
+        self.clock.now += 11
+        self.api.set(GONE, '123456')
+        self.assertEqual('', self.catalog.check(self.context, [GONE]))
+        self.assertEqual(('get', GONE), self.api.calls[-1])
+
+    def test_lookup_failure_allows(self):
+        self.catalog.sync()
+        self.api.error = RuntimeError('neutron is down')
+        self.assertEqual('', self.catalog.check(self.context, [GONE]))
+        self.assertEqual(1, self.catalog.stats()['errors'])
+
+    def test_incremental_sync(self):
+        self.assertTrue(self.catalog.sync())
+        self.api.set(THEIRS, '123456')
+        self.clock.now += 60
+        self.assertFalse(self.catalog.sync())
+        self.assertEqual(('list', 3), self.api.calls[-2])
+        self.assertEqual('', self.catalog.check(self.context, [THEIRS]))
+        self.assertEqual(3, len(self.catalog.index))
+
+    def test_full_sync_drops_deleted(self):
+        self.catalog.sync()
+        self.api.delete(MINE)
+        self.clock.now += 60
+        self.catalog.sync()
+        self.assertTrue(ids.pack(MINE) in self.catalog.index)
+        self.clock.now += 3600
+        self.assertTrue(self.catalog.sync())
+        self.assertFalse(ids.pack(MINE) in self.catalog.index)
+        stats = self.catalog.stats()
+        self.assertEqual(3, stats['syncs'])
+        self.assertEqual(2, stats['full_syncs'])
+        self.assertEqual({'public': 1}, stats['classes'])
+
+
+class TestCatalogChecks(tests.TestCase):
+
+    def setUp(self):
+        super(TestCatalogChecks, self).setUp()
+        self.create_patch('wafflehaus.nova.networking.network_catalog.'
+                          'NetworkCatalog._ensure_worker')
+        self.create_patch('wafflehaus.nova.networking.network_catalog.'
+                          '_shared')
+        network_catalog._shared = None
+        ctx_path = 'wafflehaus.nova.nova_base.WafflehausNova._get_context'
+        self.m_ctx = self.create_patch(ctx_path)
+        self.m_ctx.return_value = FakeContext()
+        self.m_instance = self.create_patch(
+            'wafflehaus.nova.nova_base.WafflehausNova._get_instance')
+        self.conf = {'enabled': 'true', 'networks_max': '3',
+                     'network_catalog': 'true',
+                     'network_catalog_api': 'wafflehaus.nova.networking.'
+                                            'network_catalog.FakeNetworkAPI',
+                     'fake_networks': FAKE_NETWORKS,
+                     'stats_path': '/wafflehaus/stats'}
+        self.waffle = network_count_check.filter_factory(self.conf)(self.app)
+        self.catalog = self.waffle.network_catalog
+        self.catalog.sync()
+
+    def _boot(self, *networks):
+        body = json.dumps({'server': {'networks': [{'uuid': n}
+                                                   for n in networks]}})
+        return self.waffle.__call__.request('/123456/servers',
+                                            method='POST', body=body)
+
+    def _attach(self, network):
+        body = '{"virtual_interface": {"network_id": "%s"}}' % network
+        return self.waffle.__call__.request(
+            '/123456/servers/%s/os-virtual-interfacesv2' % SERVER,
+            method='POST', body=body)
+
+    def test_shared_catalog(self):
+        other = network_count_check.filter_factory(self.conf)(self.app)
+        self.assertTrue(other.network_catalog is self.catalog)
+
+    def test_boot(self):
+        self.assertEqual(self.app, self._boot(PUB, MINE))
+        resp = self._boot(PUB, THEIRS)
+        self.assertTrue(isinstance(resp, webob.exc.HTTPForbidden))
+        self.assertTrue('not available' in str(resp))
+        resp = self._boot(GONE)
+        self.assertTrue(isinstance(resp, webob.exc.HTTPForbidden))
+        self.assertTrue('could not be found' in str(resp))
+
+    def test_attach_refused_without_instance_lookup(self):
+        resp = self._attach(THEIRS)
+        self.assertTrue(isinstance(resp, webob.exc.HTTPForbidden))
+        self.assertFalse(self.m_instance.called)
+
+    def test_stats(self):
+        self._boot(GONE)
+        self.m_ctx.return_value.is_admin = True
+        resp = self.waffle.__call__.request('/wafflehaus/stats',
+                                            method='GET')
+        stats = json.loads(resp.body.decode('utf-8'))
+        self.assertEqual(3, stats['network_catalog']['networks'])
+        self.assertEqual(1, stats['network_catalog']['unknown'])
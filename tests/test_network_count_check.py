@@ -12,7 +12,10 @@
 #    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 #    License for the specific language governing permissions and limitations
 #    under the License.
+import io
+
 import mock
+import webob
 import webob.exc
 
 from wafflehaus.nova.networking import network_count_check
@@ -35,6 +38,19 @@ class FakeContext(object):
         self.project_id = project
 
 
+class StreamingInput(object):
+    """A non-seekable wsgi.input that records how much was read."""
+
+    def __init__(self, data):
+        self.stream = io.BytesIO(data)
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        chunk = self.stream.read(size)
+        self.bytes_read += len(chunk)
+        return chunk
+
+
 class TestNetworkCountCheck(tests.TestCase):
 
     def setUp(self):
@@ -555,3 +571,132 @@ class TestNetworkCountCheck(tests.TestCase):
         resp = result.__call__.request(goodurl % self.tenant_id, method='POST',
                                        body=body)
         self.assertEqual(self.app, resp)
+
+    def _streaming_request(self, body, chunked=False):
+        req = webob.Request.blank('/%s/servers' % self.tenant_id,
+                                  method='POST')
+        req.environ['wsgi.input'] = StreamingInput(body)
+        req.environ['webob.is_body_seekable'] = False
+        if chunked:
+            req.environ.pop('CONTENT_LENGTH', None)
+            req.environ['HTTP_TRANSFER_ENCODING'] = 'chunked'
+        else:
+            req.environ['CONTENT_LENGTH'] = str(len(body))
+        return req
+
+    def test_boot_over_content_length_limit_not_read(self):
+        m_ctx = self.create_patch(self.ctx_path)
+        m_ctx.return_value = self.context
+        conf = {'max_inspect_bytes': '16', 'enabled': 'true'}
+        result = network_count_check.filter_factory(conf)(self.app)
+
+        body = b'{"server": {"networks":[]}}'
+        req = self._streaming_request(body)
+        resp = result.__call__(req)
+        self.assertTrue(isinstance(resp,
+                                   webob.exc.HTTPRequestEntityTooLarge))
+        self.assertEqual(0, req.environ['wsgi.input'].bytes_read)
+
+    def test_chunked_boot_body_rewound_for_downstream(self):
+        m_ctx = self.create_patch(self.ctx_path)
+        m_ctx.return_value = self.context
+        conf = {'networks_min': '0', 'enabled': 'true'}
+        result = network_count_check.filter_factory(conf)(self.app)
+
+        body = b'{"server": {"networks":[]}}'
+        req = self._streaming_request(body, chunked=True)
+        resp = result.__call__(req)
+        self.assertEqual(self.app, resp)
+        self.assertEqual(len(body), req.content_length)
+        self.assertTrue(req.is_body_seekable)
+        self.assertFalse('HTTP_TRANSFER_ENCODING' in req.environ)
+        self.assertEqual(body, req.environ['wsgi.input'].read())
+
+    def test_chunked_boot_over_limit_stops_reading(self):
+        m_ctx = self.create_patch(self.ctx_path)
+        m_ctx.return_value = self.context
+        conf = {'max_inspect_bytes': '16', 'enabled': 'true'}
+        result = network_count_check.filter_factory(conf)(self.app)
+
+        req = self._streaming_request(b'x' * 100000, chunked=True)
+        resp = result.__call__(req)
+        self.assertTrue(isinstance(resp,
+                                   webob.exc.HTTPRequestEntityTooLarge))
+        self.assertEqual(17, req.environ['wsgi.input'].bytes_read)
+
+    def test_attach_over_limit(self):
+        m_ctx = self.create_patch(self.ctx_path)
+        m_ctx.return_value = self.context
+        m_instance = self.create_patch(self.get_instance_path)
+        conf = {'max_inspect_bytes': '16', 'enabled': 'true'}
+        result = network_count_check.filter_factory(conf)(self.app)
+
+        body = '{"virtual_interface": {"network_id": "%s"}}' % self.adduuid
+        goodurl = '/%s/servers/%s/os-virtual-interfacesv2'
+        resp = result.__call__.request(goodurl % (self.tenant_id,
+                                                  self.vifuuid),
+                                       method='POST', body=body)
+        self.assertTrue(isinstance(resp,
+                                   webob.exc.HTTPRequestEntityTooLarge))
+        self.assertEqual(0, m_instance.call_count)
+
+
+class TestPreAuth(tests.TestCase):
+
+    def setUp(self):
+        super(TestPreAuth, self).setUp()
+        self.app = mock.Mock()
+        self.banned = '22222222-2222-2222-2222-222222222222'
+        self.conf = {'enabled': 'true', 'pre_auth': 'true',
+                     'networks_max': '2', 'banned_nets': self.banned,
+                     'required_nets': '00000000-0000-0000-0000-000000000000'}
+        self.m_ctx = self.create_patch(
+            'wafflehaus.nova.nova_base.WafflehausNova._get_context')
+
+    def _boot(self, waffle, networks, path='/123456/servers'):
+        body = '{"server": {"networks": [%s]}}' % ', '.join(
+            '{"uuid": "%s"}' % net for net in networks)
+        return waffle.__call__.request(path, method='POST', body=body)
+
+    def test_rejects_before_auth(self):
+        waffle = network_count_check.filter_factory(self.conf)(self.app)
+        resp = self._boot(waffle, [self.banned])
+        self.assertTrue(isinstance(resp, webob.exc.HTTPForbidden))
+        resp = self._boot(waffle, ['a', 'b', 'c'], path='/servers')
+        self.assertTrue(isinstance(resp, webob.exc.HTTPForbidden))
+        self.assertEqual(0, self.m_ctx.call_count)
+        self.assertEqual({'checked': 2, 'rejected': 2},
+                         waffle._stats()['pre_auth'])
+
+    def test_passes_what_auth_must_decide(self):
+        waffle = network_count_check.filter_factory(self.conf)(self.app)
+        # The required network may be on a port, or the check after auth
+        # rejects it
+        self.assertEqual(self.app, self._boot(waffle, ['a']))
+        self.assertEqual(self.app, waffle.__call__.request(
+            '/123456/servers', method='POST', body='not json'))
+        self.assertEqual(self.app, waffle.__call__.request(
+            '/123456/servers/action', method='POST', body='{}'))
+        self.assertEqual(self.app, waffle.__call__.request(
+            '/123456/servers', method='POST',
+            body='{"server": {"networks": "auto"}}'))
+        self.assertEqual(0, self.m_ctx.call_count)
+
+    def test_body_left_for_nova(self):
+        waffle = network_count_check.filter_factory(self.conf)(self.app)
+        body = b'{"server": {"networks": [{"uuid": "a"}]}}'
+        req = webob.Request.blank('/123456/servers', method='POST')
+        req.environ['wsgi.input'] = StreamingInput(body)
+        req.environ['webob.is_body_seekable'] = False
+        req.environ['CONTENT_LENGTH'] = str(len(body))
+        self.assertEqual(self.app, waffle.__call__(req))
+        self.assertEqual(body, req.environ['wsgi.input'].read())
+
+    def test_chunked_body_not_read(self):
+        waffle = network_count_check.filter_factory(self.conf)(self.app)
+        req = webob.Request.blank('/123456/servers', method='POST')
+        req.environ['wsgi.input'] = StreamingInput(b'{}')
+        req.environ['HTTP_TRANSFER_ENCODING'] = 'chunked'
+        req.environ.pop('CONTENT_LENGTH', None)
+        self.assertEqual(self.app, waffle.__call__(req))
+        self.assertEqual(0, req.environ['wsgi.input'].bytes_read)
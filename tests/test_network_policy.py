@@ -0,0 +1,133 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+import webob.exc
+
+from wafflehaus.nova import ids
+from wafflehaus.nova.networking import network_count_check
+from wafflehaus.nova.networking import network_policy
+from wafflehaus import tests
+
+
+class FakeContext(object):
+    project_id = '123456'
+
+
+class TestNetworkPolicy(tests.TestCase):
+
+    def setUp(self):
+        super(TestNetworkPolicy, self).setUp()
+        self.net_a = '11111111-1111-1111-1111-111111111111'
+        self.net_b = '22222222-2222-2222-2222-222222222222'
+        self.store1 = '33333333-3333-3333-3333-333333333333'
+        self.store2 = '44444444-4444-4444-4444-444444444444'
+        self.other = '55555555-5555-5555-5555-555555555555'
+        self.conf = {'enabled': 'true', 'networks_max': '2',
+                     'network_classes': 'storage',
+                     'network_class_storage': '%s %s' % (self.store1,
+                                                         self.store2),
+                     'network_class_storage_max': '1',
+                     'exclusive_nets': '%s,%s' % (self.net_a, self.net_b)}
+
+    def _policy(self, **kwargs):
+        return network_count_check.NetworkCountConfig(
+            dict(self.conf, **kwargs)).policy
+
+    def test_known_networks_get_one_bit_each(self):
+        policy = self._policy(banned_nets=self.store1)
+        self.assertEqual(4, len(policy.index))
+        bits = sorted(policy.index.values())
+        self.assertEqual([1, 2, 4, 8], bits)
+
+    def test_unknown_networks_still_count(self):
+        policy = self._policy()
+        nets = policy.mask([self.store1, self.other, self.other])
+        self.assertEqual(set([ids.pack(self.other)]), nets.extra)
+        self.assertEqual(2, len(nets))
+        msg = policy.check_count([self.store1, self.other, 'x'], None, 1)
+        self.assertTrue('isolated network' in msg)
+
+    def test_class_limit(self):
+        policy = self._policy()
+        self.assertEqual('', policy.check_boot([self.store1, self.other]))
+        msg = policy.check_boot([self.store1, self.store2])
+        self.assertTrue('class storage' in msg)
+
+    def test_class_min_only_on_boot(self):
+        policy = self._policy(network_class_storage_min='1')
+        msg = policy.check_boot([self.other])
+        self.assertTrue('At least 1' in msg)
+        self.assertEqual('', policy.check_attach([self.other], set()))
+
+    def test_exclusive_networks(self):
+        policy = self._policy()
+        msg = policy.check_boot([self.net_a, self.net_b])
+        self.assertTrue('cannot be attached together' in msg)
+        msg = policy.check_attach([self.net_b], set([self.net_a]))
+        self.assertTrue('cannot be attached together' in msg)
+        self.assertEqual('', policy.check_attach([self.net_b],
+                                                 set([self.other])))
+
+    def test_legacy_checks_match_policy(self):
+        required = set([self.net_a])
+        banned = set([self.net_b])
+        self.assertEqual('', network_count_check.check_required_networks(
+            set([self.net_a, self.other]), required))
+        self.assertTrue('but missing' in
+                        network_count_check.check_required_networks(
+                            set([self.other]), required))
+        self.assertTrue('not allowed' in
+                        network_count_check.check_banned_networks(
+                            set([self.net_b]), banned))
+        self.assertEqual('', network_count_check.check_network_count(
+            set([self.net_a]), 1, 1, set([self.net_b]), banned, False))
+        self.assertTrue('Exactly 1' in network_count_check.check_network_count(
+            set([self.net_a]), 1, 1, set([self.net_b]), set(), False))
+
+    def test_network_set_union(self):
+        policy = network_policy.NetworkPolicy(required=[self.net_a])
+        nets = policy.mask([self.net_a]) | policy.mask([self.other])
+        self.assertEqual(1, nets.bits)
+        self.assertEqual(2, len(nets))
+        self.assertEqual([self.net_a], policy.names_for(nets.bits))
+
+    def test_boot_rejected_by_class_limit(self):
+        ctx_path = 'wafflehaus.nova.nova_base.WafflehausNova._get_context'
+        m_ctx = self.create_patch(ctx_path)
+        m_ctx.return_value = FakeContext()
+
+        result = network_count_check.filter_factory(self.conf)(self.app)
+        body = '{"server": {"networks":[{"uuid": "%s"}, {"uuid": "%s"}]}}'
+        resp = result.__call__.request(
+            '/123456/servers', method='POST',
+            body=body % (self.store1, self.store2))
+        self.assertTrue(isinstance(resp, webob.exc.HTTPForbidden))
+        self.assertTrue('class storage' in str(resp))
+
+    def test_pre_auth_only_fails_what_no_tenant_passes(self):
+        policy = self._policy(
+            banned_nets=self.other, networks_min='2',
+            required_nets=self.net_a,
+            policy_rules='ban %s when project = 1\nexclusive %s %s' % (
+                self.store1, self.store2, self.net_b))
+        self.assertEqual('banned', policy.evaluate_pre_auth([self.other])[0])
+        self.assertEqual('count', policy.evaluate_pre_auth(
+            [self.net_a, 'x', 'y'])[0])
+        self.assertEqual('class', policy.evaluate_pre_auth(
+            [self.store1, self.store2])[0])
+        self.assertEqual('rule2', policy.evaluate_pre_auth(
+            [self.store2, self.net_b])[0])
+        # Missing required networks and minimums may come from ports, and
+        # conditional rules depend on the tenant
+        self.assertEqual((None, ''), policy.evaluate_pre_auth([self.store1]))
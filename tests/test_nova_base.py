@@ -0,0 +1,187 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+import subprocess
+import sys
+
+import mock
+from nova import exception
+import webob.exc
+
+from wafflehaus.nova import ids
+from wafflehaus.nova.networking import detach_network_check
+from wafflehaus.nova import notifications
+from wafflehaus.nova import nova_base
+from wafflehaus import tests
+
+
+class FakeContext(object):
+    project_id = '123456'
+
+
+class TestWafflehausNova(tests.TestCase):
+
+    def setUp(self):
+        super(TestWafflehausNova, self).setUp()
+        self.pkg = 'wafflehaus.nova.nova_base.WafflehausNova'
+        self.m_get_compute = self.create_patch(
+            '%s._get_compute' % self.pkg)
+
+    def test_compute_not_loaded_on_create(self):
+        nova_base.WafflehausNova(self.app, {'enabled': 'true'})
+        self.assertEqual(0, self.m_get_compute.call_count)
+
+    def test_compute_loaded_once_on_use(self):
+        waffle = nova_base.WafflehausNova(self.app, {'enabled': 'true'})
+        self.assertEqual(self.m_get_compute.return_value, waffle.compute)
+        self.assertEqual(self.m_get_compute.return_value, waffle.compute)
+        self.assertEqual(1, self.m_get_compute.call_count)
+
+    def _probe_modules(self, imports, heavy):
+        probe = ("import sys\n%s\n"
+                 "print(','.join(m for m in %r if m in sys.modules))\n" % (
+                     "\n".join("import %s" % i for i in imports), heavy))
+        out = subprocess.check_output([sys.executable, '-c', probe])
+        return out.decode('utf-8').strip()
+
+    def test_filter_modules_defer_heavy_imports(self):
+        imports = ['wafflehaus.nova.networking.network_count_check',
+                   'wafflehaus.nova.networking.detach_network_check']
+        loaded = self._probe_modules(imports, ('nova', 'oslo_serialization'))
+        self.assertEqual('', loaded)
+
+
+class TestNegativeCache(tests.TestCase):
+
+    def setUp(self):
+        super(TestNegativeCache, self).setUp()
+        self.pkg = 'wafflehaus.nova.nova_base.WafflehausNova'
+        self.m_get_instance = self.create_patch(
+            '%s._get_instance' % self.pkg)
+        self.server_id = '12345678-1234-1234-1234-123456789012'
+        self.m_get_instance.side_effect = exception.InstanceNotFound(
+            instance_id=self.server_id)
+        self.m_get_context = self.create_patch(
+            '%s._get_context' % self.pkg)
+        self.m_get_context.return_value = FakeContext()
+        self.url = '123456/servers/%s/os-virtual-interfacesv2/%s' % (
+            self.server_id, self.server_id)
+        self.conf = {'enabled': 'true', 'negative_cache_ttl': '30'}
+
+    def test_not_found_without_cache(self):
+        waffle = nova_base.WafflehausNova(self.app, {'enabled': 'true'})
+        for _ in range(2):
+            self.assertRaises(webob.exc.HTTPNotFound, waffle._lookup_instance,
+                              FakeContext(), self.server_id)
+        self.assertEqual(2, self.m_get_instance.call_count)
+
+    def test_not_found_answered_from_cache(self):
+        result = detach_network_check.filter_factory(self.conf)(self.app)
+        for _ in range(3):
+            resp = result.__call__.request(self.url, method='DELETE')
+            self.assertTrue(isinstance(resp, webob.exc.HTTPNotFound))
+        self.assertEqual(1, self.m_get_instance.call_count)
+        self.assertEqual(2, result.negative_cache.stats()['hits'])
+
+    def test_cache_is_per_project(self):
+        waffle = nova_base.WafflehausNova(self.app, self.conf)
+        other = FakeContext()
+        other.project_id = '654321'
+        for context in (FakeContext(), other):
+            self.assertRaises(webob.exc.HTTPNotFound, waffle._lookup_instance,
+                              context, self.server_id)
+        self.assertEqual(2, self.m_get_instance.call_count)
+
+    def test_create_notification_clears_entry(self):
+        self.create_patch('wafflehaus.nova.notifications.ensure_listening')
+        conf = dict(self.conf, notification_topics='notifications')
+        waffle = nova_base.WafflehausNova(self.app, conf)
+        self.addCleanup(notifications._handlers.remove,
+                        waffle._on_instance_notification)
+        self.assertRaises(webob.exc.HTTPNotFound, waffle._lookup_instance,
+                          FakeContext(), self.server_id)
+        self.assertEqual(1, len(waffle.negative_cache))
+
+        notifications.dispatch('compute.instance.create.end',
+                               {'tenant_id': '123456',
+                                'instance_id': self.server_id})
+        self.assertEqual(0, len(waffle.negative_cache))
+        self.m_get_instance.side_effect = None
+        waffle._lookup_instance(FakeContext(), self.server_id)
+        self.assertEqual(2, self.m_get_instance.call_count)
+
+
+class TestCellCache(tests.TestCase):
+
+    def setUp(self):
+        super(TestCellCache, self).setUp()
+        self.pkg = 'wafflehaus.nova.nova_base.WafflehausNova'
+        self.m_get_instance = self.create_patch(
+            '%s._get_instance' % self.pkg)
+        self.m_get_mapping = self.create_patch(
+            '%s._get_cell_mapping' % self.pkg)
+        self.m_get_mapping.return_value = 'cell1'
+        self.m_from_cell = self.create_patch(
+            '%s._get_instance_from_cell' % self.pkg)
+        self.server_id = '12345678-1234-1234-1234-123456789012'
+        self.waffle = nova_base.WafflehausNova(
+            self.app, {'enabled': 'true', 'cell_cache_ttl': '3600'})
+
+    def _lookup(self):
+        return self.waffle._lookup_instance(FakeContext(), self.server_id)
+
+    def test_known_cell_queried_directly(self):
+        for _ in range(3):
+            self.assertEqual(self.m_from_cell.return_value, self._lookup())
+        self.assertEqual(1, self.m_get_mapping.call_count)
+        self.assertEqual(3, self.m_from_cell.call_count)
+        self.assertEqual(0, self.m_get_instance.call_count)
+        self.m_from_cell.assert_called_with(mock.ANY, 'cell1', self.server_id)
+
+    def test_stale_mapping_resolved_again(self):
+        self._lookup()
+        self.m_get_mapping.return_value = 'cell2'
+        self.m_from_cell.side_effect = [
+            exception.InstanceNotFound(instance_id=self.server_id),
+            self.m_from_cell.return_value]
+        self._lookup()
+        self.assertEqual(2, self.m_get_mapping.call_count)
+        self.assertEqual('cell2', self.waffle.cell_cache.get(
+            ids.pack(self.server_id)))
+        self.assertEqual(1, self.waffle.cell_stale)
+
+    def test_unmapped_instance_falls_back_to_compute(self):
+        self.m_get_mapping.side_effect = exception.NotFound()
+        self.assertEqual(self.m_get_instance.return_value, self._lookup())
+        self.m_get_mapping.side_effect = None
+        self.m_get_mapping.return_value = None
+        self._lookup()
+        self.assertEqual(2, self.m_get_instance.call_count)
+        self.assertEqual(0, len(self.waffle.cell_cache))
+        self.assertEqual(2, self.waffle.cell_fallbacks)
+
+    def test_missing_instance_not_cached(self):
+        self.m_from_cell.side_effect = exception.InstanceNotFound(
+            instance_id=self.server_id)
+        self.assertRaises(webob.exc.HTTPNotFound, self._lookup)
+        self.assertEqual(0, len(self.waffle.cell_cache))
+
+    def test_delete_notification_forgets_cell(self):
+        self._lookup()
+        self.waffle._on_cell_notification('instance.update', None,
+                                          self.server_id)
+        self.assertEqual(1, len(self.waffle.cell_cache))
+        self.waffle._on_cell_notification('compute.instance.delete.end',
+                                          None, self.server_id)
+        self.assertEqual(0, len(self.waffle.cell_cache))
@@ -0,0 +1,175 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+import json
+
+import mock
+import webob.exc
+
+from wafflehaus.nova.networking import network_count_check
+from wafflehaus.nova.networking import network_policy
+from wafflehaus import tests
+
+PUB = '00000000-0000-0000-0000-000000000000'
+PRIV = '11111111-1111-1111-1111-111111111111'
+GPU = '22222222-2222-2222-2222-222222222222'
+STORAGE = '33333333-3333-3333-3333-333333333333'
+
+
+class FakeContext(object):
+
+    def __init__(self, project_id='123456', is_admin=False):
+        self.project_id = project_id
+        self.is_admin = is_admin
+
+
+def _policy(rules, **kwargs):
+    return network_policy.NetworkPolicy(networks_max=10, rules=rules,
+                                        **kwargs)
+
+
+class TestPolicyRules(tests.TestCase):
+
+    def test_require_and_ban(self):
+        policy = _policy("require %s\nban %s" % (PUB, GPU))
+        self.assertEqual(('rule1', 'Networks (%s) required but missing' %
+                          PUB), policy.evaluate_boot([PRIV]))
+        self.assertEqual(('rule2', 'Networks (%s) not allowed' % GPU),
+                         policy.evaluate_boot([PUB, GPU]))
+        self.assertEqual((None, ''), policy.evaluate_boot([PUB, PRIV]))
+
+    def test_conditions(self):
+        policy = _policy("gpu: ban %s when flavor not in gpu1,gpu2 "
+                         "and project != 42" % GPU)
+        facts = {'project': '7', 'flavor': 'm1'}
+        self.assertEqual('gpu', policy.evaluate_boot([GPU], facts)[0])
+        facts['flavor'] = 'gpu2'
+        self.assertEqual(None, policy.evaluate_boot([GPU], facts)[0])
+        facts.update(flavor='m1', project='42')
+        self.assertEqual(None, policy.evaluate_boot([GPU], facts)[0])
+
+    def test_count_ranges(self):
+        policy = _policy("count 2..3\ncount 1 when image = tiny",
+                         optional=[PUB])
+        self.assertTrue(policy.check_boot([PRIV]))
+        self.assertFalse(policy.check_boot([PUB, PRIV, GPU]))
+        self.assertTrue(policy.check_boot([PRIV, GPU, STORAGE, 'other']))
+        facts = {'image': 'tiny'}
+        self.assertTrue(policy.evaluate_boot([PRIV, GPU], facts)[1])
+
+    def test_implication_and_exclusion(self):
+        policy = _policy("if %s then %s\nexclusive %s,%s" %
+                         (GPU, STORAGE, PUB, PRIV))
+        self.assertEqual('rule1', policy.evaluate_boot([GPU])[0])
+        self.assertEqual(None, policy.evaluate_boot([GPU, STORAGE])[0])
+        self.assertEqual('rule2', policy.evaluate_boot([PUB, PRIV])[0])
+
+    def test_attach_skips_requirements_and_minimums(self):
+        policy = _policy("require %s\nif %s then %s\ncount 3..4\n"
+                         "exclusive %s %s" % (PUB, GPU, STORAGE, PUB, PRIV))
+        self.assertEqual((None, ''), policy.evaluate_attach([GPU], []))
+        self.assertEqual('rule4', policy.evaluate_attach([PRIV], [PUB])[0])
+        self.assertEqual('rule3', policy.evaluate_attach(
+            [GPU], [PUB, STORAGE, 'a', 'b'])[0])
+
+    def test_cheapest_rules_run_first(self):
+        policy = _policy("count ..1\nban %s" % GPU)
+        names = [rule.name for rule in policy.rules.rules]
+        self.assertEqual(['rule2', 'rule1'], names)
+        self.assertEqual('rule2', policy.evaluate_boot([GPU, PUB])[0])
+        stats = dict((s['name'], s) for s in policy.rules.stats())
+        self.assertEqual(1, stats['rule2']['rejections'])
+        self.assertEqual(0, stats['rule1']['evaluations'])
+
+    def test_rule_timing(self):
+        ticks = iter(range(100))
+        policy = _policy("ban %s" % GPU)
+        policy.rules.timer = lambda: next(ticks) * 0.5
+        policy.evaluate_boot([PUB])
+        policy.evaluate_boot([PUB])
+        stats = policy.rules.stats()[0]
+        self.assertEqual(2, stats['evaluations'])
+        self.assertEqual(1000.0, stats['total_ms'])
+        self.assertEqual(500000.0, stats['mean_us'])
+
+    def test_bad_rules_fail_to_load(self):
+        for text in ("allow %s" % PUB, "require", "count lots",
+                     "exclusive %s" % PUB, "if %s %s" % (PUB, PRIV),
+                     "ban %s when colour = red" % PUB,
+                     "ban %s when project red" % PUB,
+                     "ban %s when project =" % PUB):
+            self.assertRaises(ValueError, _policy, text)
+
+    def test_report_only_rules_never_reject(self):
+        policy = _policy("watch: report ban %s\nban %s" % (GPU, STORAGE))
+        self.assertEqual((None, ''), policy.evaluate_boot([PUB, GPU]))
+        self.assertEqual('rule2', policy.evaluate_boot([GPU, STORAGE])[0])
+        watch = policy.rules.stats()[0]
+        self.assertTrue(watch['report_only'])
+        self.assertEqual(2, watch['rejections'])
+        self.assertRaises(ValueError, _policy, "report")
+
+    def test_comments_and_blank_lines(self):
+        policy = _policy("\n# public network everywhere\nrequire %s\n" % PUB)
+        self.assertEqual(1, len(policy.rules))
+        self.assertEqual('rule3', policy.rules.rules[0].name)
+
+
+class TestPolicyRulesFilter(tests.TestCase):
+
+    def setUp(self):
+        super(TestPolicyRulesFilter, self).setUp()
+        nova_path = 'wafflehaus.nova.nova_base.WafflehausNova'
+        self.m_ctx = self.create_patch('%s._get_context' % nova_path)
+        self.m_ctx.return_value = FakeContext()
+        self.m_instance = self.create_patch('%s._get_instance' % nova_path)
+        self.m_get_nwinfo = self.create_patch(
+            'nova.compute.utils.get_nw_info_for_instance')
+        self.m_get_nwinfo.return_value = []
+        self.conf = {'enabled': 'true', 'networks_max': '5',
+                     'stats_path': '/wafflehaus/stats',
+                     'policy_rules': 'gpu-only: ban %s when flavor != g1' %
+                                     GPU}
+
+    def test_boot_flavor_from_request(self):
+        result = network_count_check.filter_factory(self.conf)(self.app)
+        body = ('{"server": {"flavorRef": "%s", "networks": '
+                '[{"uuid": "%s"}]}}')
+        resp = result.__call__.request('/123456/servers', method='POST',
+                                       body=body % ('m1', GPU))
+        self.assertTrue(isinstance(resp, webob.exc.HTTPForbidden))
+        resp = result.__call__.request(
+            '/123456/servers', method='POST',
+            body=body % ('http://nova/123456/flavors/g1', GPU))
+        self.assertEqual(self.app, resp)
+
+        self.m_ctx.return_value = FakeContext(is_admin=True)
+        resp = result.__call__.request('/wafflehaus/stats', method='GET')
+        rules = json.loads(resp.body.decode('utf-8'))['policy_rules']
+        self.assertEqual('gpu-only', rules[0]['name'])
+        self.assertEqual(2, rules[0]['evaluations'])
+        self.assertEqual(1, rules[0]['rejections'])
+
+    def test_attach_flavor_from_instance(self):
+        self.m_instance.return_value = mock.Mock(
+            flavor=mock.Mock(flavorid='m1'), image_ref='img')
+        result = network_count_check.filter_factory(self.conf)(self.app)
+        url = '/123456/servers/%s/os-virtual-interfacesv2' % PRIV
+        body = '{"virtual_interface": {"network_id": "%s"}}' % GPU
+        resp = result.__call__.request(url, method='POST', body=body)
+        self.assertTrue(isinstance(resp, webob.exc.HTTPForbidden))
+
+        self.m_instance.return_value.flavor.flavorid = 'g1'
+        resp = result.__call__.request(url, method='POST', body=body)
+        self.assertEqual(self.app, resp)
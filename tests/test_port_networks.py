@@ -0,0 +1,140 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+import json
+
+import webob.exc
+
+from wafflehaus.nova.networking import network_count_check
+from wafflehaus.nova.networking import port_networks
+from wafflehaus import tests
+
+PUB = '00000000-0000-0000-0000-000000000000'
+PRIV = '11111111-1111-1111-1111-111111111111'
+BANNED = '22222222-2222-2222-2222-222222222222'
+
+
+class FakeContext(object):
+    project_id = '123456'
+    is_admin = True
+
+
+class FakeNeutron(object):
+    """A port API answering from a dict, loaded through port_api."""
+
+    ports = {'port-pub': PUB, 'port-priv': PRIV, 'port-priv2': PRIV,
+             'port-banned': BANNED}
+
+    def __init__(self, conf):
+        self.conf = conf
+        self.calls = []
+        self.error = None
+
+    def list_ports(self, context, port_ids):
+        self.calls.append(sorted(port_ids))
+        if self.error is not None:
+            raise self.error
+        return dict((port_id, self.ports[port_id]) for port_id in port_ids
+                    if port_id in self.ports)
+
+
+class TestPortResolver(tests.TestCase):
+
+    def setUp(self):
+        super(TestPortResolver, self).setUp()
+        self.neutron = FakeNeutron({})
+        self.resolver = port_networks.PortResolver(self.neutron)
+
+    def test_one_lookup_for_uncached_ports(self):
+        self.assertEqual({'port-pub': PUB, 'port-priv': PRIV},
+                         self.resolver.resolve(None, ['port-pub',
+                                                      'port-priv']))
+        self.resolver.resolve(None, ['port-pub', 'port-priv2'])
+        self.resolver.resolve(None, ['port-pub', 'port-priv2'])
+        self.assertEqual([['port-priv', 'port-pub'], ['port-priv2']],
+                         self.neutron.calls)
+        stats = self.resolver.stats()
+        self.assertEqual(2, stats['lookups'])
+        self.assertEqual(3, stats['ports_looked_up'])
+        self.assertEqual(3, stats['cache']['hits'])
+
+    def test_without_cache(self):
+        resolver = port_networks.PortResolver(self.neutron, ttl=0)
+        resolver.resolve(None, ['port-pub'])
+        resolver.resolve(None, ['port-pub'])
+        self.assertEqual(2, len(self.neutron.calls))
+        self.assertFalse('cache' in resolver.stats())
+
+    def test_missing_port(self):
+        self.assertRaises(webob.exc.HTTPBadRequest, self.resolver.resolve,
+                          None, ['port-pub', 'port-gone'])
+
+    def test_lookup_failure(self):
+        self.neutron.error = RuntimeError('neutron is down')
+        self.assertRaises(webob.exc.HTTPServiceUnavailable,
+                          self.resolver.resolve, None, ['port-pub'])
+
+
+class TestPortBoots(tests.TestCase):
+
+    def setUp(self):
+        super(TestPortBoots, self).setUp()
+        ctx_path = 'wafflehaus.nova.nova_base.WafflehausNova._get_context'
+        self.m_ctx = self.create_patch(ctx_path)
+        self.m_ctx.return_value = FakeContext()
+        self.conf = {'enabled': 'true', 'networks_max': '2',
+                     'banned_nets': BANNED, 'resolve_ports': 'true',
+                     'port_api': 'tests.test_port_networks.FakeNeutron',
+                     'stats_path': '/wafflehaus/stats'}
+        self.waffle = network_count_check.filter_factory(self.conf)(self.app)
+        self.neutron = self.waffle.port_resolver.port_api
+
+    def _boot(self, *entries):
+        networks = json.dumps(list(entries))
+        body = '{"server": {"networks": %s}}' % networks
+        return self.waffle.__call__.request('/123456/servers',
+                                            method='POST', body=body)
+
+    def test_ports_count_toward_limits(self):
+        resp = self._boot({'port': 'port-pub'}, {'port': 'port-priv'},
+                          {'uuid': BANNED.replace('2', '3')})
+        self.assertTrue(isinstance(resp, webob.exc.HTTPForbidden))
+        self.assertEqual([['port-priv', 'port-pub']], self.neutron.calls)
+
+    def test_ports_on_banned_networks(self):
+        resp = self._boot({'port': 'port-banned'})
+        self.assertTrue(isinstance(resp, webob.exc.HTTPForbidden))
+        self.assertTrue('not allowed' in str(resp))
+
+    def test_ports_on_the_same_network(self):
+        resp = self._boot({'port': 'port-priv'}, {'port': 'port-priv2'},
+                          {'uuid': PUB, 'port': 'port-pub'})
+        self.assertEqual(self.app, resp)
+        self.assertEqual([['port-priv', 'port-priv2']], self.neutron.calls)
+
+    def test_lookup_errors_returned(self):
+        resp = self._boot({'port': 'port-gone'})
+        self.assertTrue(isinstance(resp, webob.exc.HTTPBadRequest))
+        self.neutron.error = RuntimeError('neutron is down')
+        resp = self._boot({'port': 'port-pub'})
+        self.assertTrue(isinstance(resp, webob.exc.HTTPServiceUnavailable))
+
+    def test_stats(self):
+        self._boot({'port': 'port-pub'})
+        self._boot({'port': 'port-pub'})
+        resp = self.waffle.__call__.request('/wafflehaus/stats',
+                                            method='GET')
+        stats = json.loads(resp.body.decode('utf-8'))['port_networks']
+        self.assertEqual(1, stats['lookups'])
+        self.assertEqual(1, stats['cache']['hits'])
@@ -0,0 +1,144 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+from nova import exception
+
+from wafflehaus.nova.networking import detach_network_check
+from wafflehaus.nova import replica
+from wafflehaus import tests
+
+SERVER = '33333333-3333-3333-3333-333333333333'
+
+
+class FakeContext(object):
+    project_id = '123456'
+    is_admin = True
+
+
+class FakeLag(object):
+    lag = 1.0
+
+    def __init__(self, conf=None):
+        self.conf = conf
+
+    def lag_seconds(self):
+        if isinstance(self.lag, Exception):
+            raise self.lag
+        return self.lag
+
+
+class TestReplicaRouter(tests.TestCase):
+
+    def setUp(self):
+        super(TestReplicaRouter, self).setUp()
+        self.now = 1000.0
+        self.lag = FakeLag()
+        self.router = replica.ReplicaRouter(self.lag, max_lag=5,
+                                            interval=5,
+                                            clock=lambda: self.now)
+        # Measured by the tests, not a worker
+        self.router._pid = replica.os.getpid()
+
+    def _read(self, fail=None):
+        def from_replica():
+            if fail is not None:
+                raise fail
+            return 'replica'
+        return self.router.call(from_replica, lambda: 'primary',
+                                missing=(KeyError,))
+
+    def test_primary_until_measured(self):
+        self.assertEqual('primary', self._read())
+        self.router.measure()
+        self.assertEqual('replica', self._read())
+        stats = self.router.stats()
+        self.assertEqual(1, stats['replica_reads'])
+        self.assertEqual(1, stats['primary_reads'])
+        self.assertEqual(1, stats['lagging'])
+        self.assertEqual(0.5, stats['replica_share'])
+
+    def test_lag_over_bound_reads_primary(self):
+        self.lag.lag = 6.0
+        self.assertFalse(self.router.measure())
+        self.assertEqual('primary', self._read())
+        self.lag.lag = None
+        self.assertFalse(self.router.measure())
+        self.lag.lag = ValueError('no replica')
+        self.assertFalse(self.router.measure())
+        self.assertEqual(1, self.router.probe_errors)
+
+    def test_stale_measurement_reads_primary(self):
+        self.router.measure()
+        self.now += 16
+        self.assertEqual('primary', self._read())
+
+    def test_missing_on_replica_read_from_primary(self):
+        self.router.measure()
+        self.assertEqual('primary', self._read(KeyError()))
+        self.assertEqual(1, self.router.missing)
+        self.assertEqual('replica', self._read())
+
+    def test_failed_replica_read_stops_replica_reads(self):
+        self.router.measure()
+        self.assertEqual('primary', self._read(ValueError()))
+        self.assertEqual('primary', self._read())
+        self.assertEqual(1, self.router.failures)
+        self.router.measure()
+        self.assertEqual('replica', self._read())
+
+
+class TestReplicaLookups(tests.TestCase):
+
+    def setUp(self):
+        super(TestReplicaLookups, self).setUp()
+        self.create_patch('wafflehaus.nova.replica._shared')
+        replica._shared = None
+        nova_path = 'wafflehaus.nova.nova_base.WafflehausNova'
+        self.m_ctx = self.create_patch('%s._get_context' % nova_path)
+        self.m_ctx.return_value = FakeContext()
+        self.m_get_instance = self.create_patch('%s._get_instance' %
+                                                nova_path)
+        self.m_replica = self.create_patch(
+            '%s._get_instance_from_replica' % nova_path)
+        self.conf = {'enabled': 'true', 'replica_max_lag': '5',
+                     'replica_lag_api': 'tests.test_replica.FakeLag',
+                     'stats_path': '/stats'}
+
+    def _waffle(self):
+        waffle = detach_network_check.filter_factory(self.conf)(self.app)
+        self.addCleanup(waffle.replica.stop)
+        waffle.replica.measure()
+        return waffle
+
+    def test_disabled_by_default(self):
+        waffle = detach_network_check.filter_factory(
+            {'enabled': 'true'})(self.app)
+        self.assertIsNone(waffle.replica)
+
+    def test_lookups_read_replica(self):
+        waffle = self._waffle()
+        instance = waffle._lookup_instance(FakeContext(), SERVER)
+        self.assertEqual(self.m_replica.return_value, instance)
+        self.assertEqual(0, self.m_get_instance.call_count)
+        resp = waffle.__call__.request('/stats', method='GET')
+        self.assertEqual(1, resp.json_body['replica']['replica_reads'])
+
+    def test_instance_missing_on_replica_read_from_primary(self):
+        waffle = self._waffle()
+        self.m_replica.side_effect = exception.InstanceNotFound(
+            instance_id=SERVER)
+        instance = waffle._lookup_instance(FakeContext(), SERVER)
+        self.assertEqual(self.m_get_instance.return_value, instance)
+        self.assertEqual(1, waffle.replica.missing)
+        self.assertTrue(waffle.replica.usable)
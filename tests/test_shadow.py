@@ -0,0 +1,194 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+import time
+
+import webob.exc
+
+from wafflehaus.nova.networking import detach_network_check
+from wafflehaus.nova.networking import instance_networks
+from wafflehaus.nova.networking import network_count_check
+from wafflehaus.nova.networking import shadow
+from wafflehaus import tests
+
+PUB = '00000000-0000-0000-0000-000000000000'
+SERVER = '11111111-1111-1111-1111-111111111111'
+VIF = '22222222-2222-2222-2222-222222222222'
+OTHER_VIF = '44444444-4444-4444-4444-444444444444'
+
+
+class FakeContext(object):
+    project_id = '123456'
+
+
+class MockedVIFInfo(dict):
+    def __init__(self, vif_id, net_id):
+        self['address'] = '196.168.1.1'
+        self['id'] = vif_id
+        self['network'] = {'id': net_id, 'label': 'nw_label'}
+
+    def fixed_ips(self):
+        return [{'address': '192.168.1.1'}]
+
+
+def nova_app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'application/json')])
+    return [b'{}']
+
+
+def _too_many(vifs):
+    return 'too many' if len(vifs) > 1 else ''
+
+
+def _check(lookup, decide, rejected=False, age=5, **kwargs):
+    entry = instance_networks.ServerNetworks({VIF: PUB}, 0)
+    return shadow.ShadowCheck('attach', lookup, decide, entry, rejected, age,
+                              **kwargs)
+
+
+class TestShadowVerifier(tests.TestCase):
+
+    def setUp(self):
+        super(TestShadowVerifier, self).setUp()
+        self.create_patch('%s.ShadowVerifier._ensure_worker' %
+                          shadow.__name__)
+        self.verifier = shadow.ShadowVerifier(1.0, queue_size=2)
+
+    def test_matching_lookup(self):
+        self.verifier.submit(_check(lambda: {VIF: PUB}, lambda vifs: ''))
+        self.verifier.drain()
+        report = self.verifier.report()['attach']
+        self.assertEqual(1, report['verified'])
+        self.assertEqual(0, report['mismatches'])
+        self.assertEqual({'<10s': {'verified': 1, 'mismatches': 0}},
+                         report['ages'])
+
+    def test_mismatch_and_flip(self):
+        self.verifier.submit(_check(lambda: {VIF: PUB, 'v2': 'n2'},
+                                    _too_many, age=400))
+        self.verifier.drain()
+        report = self.verifier.report()['attach']
+        self.assertEqual(1, report['mismatches'])
+        self.assertEqual(1.0, report['mismatch_rate'])
+        self.assertEqual(1, report['flipped_to_reject'])
+        self.assertEqual(1, report['ages']['<900s']['mismatches'])
+
+    def test_own_request_ignored(self):
+        self.verifier.submit(_check(lambda: {VIF: PUB, 'v2': 'n2'},
+                                    lambda vifs: '', ignore_nets=['n2']))
+        self.verifier.submit(_check(lambda: {}, lambda vifs: '',
+                                    ignore_vifs=[VIF]))
+        self.verifier.drain()
+        self.assertEqual(0, self.verifier.report()['attach']['mismatches'])
+
+    def test_full_queue_drops(self):
+        for _ in range(3):
+            self.verifier.submit(_check(lambda: {}, lambda vifs: ''))
+        report = self.verifier.report()
+        self.assertEqual(2, report['sampled'])
+        self.assertEqual(1, report['dropped'])
+
+    def test_lookup_errors_counted(self):
+        def lookup():
+            raise RuntimeError('db gone')
+        self.verifier.submit(_check(lookup, lambda vifs: ''))
+        self.verifier.drain()
+        report = self.verifier.report()['attach']
+        self.assertEqual(1, report['errors'])
+        self.assertEqual(0, report['verified'])
+
+    def test_sampling(self):
+        draws = [0.3, 0.1]
+        verifier = shadow.ShadowVerifier(0.25, rng=draws.pop)
+        self.assertTrue(verifier.should_sample())
+        self.assertFalse(verifier.should_sample())
+
+
+class TestShadowFilters(tests.TestCase):
+
+    def setUp(self):
+        super(TestShadowFilters, self).setUp()
+        for name in ('instance_networks', 'shadow'):
+            self.create_patch('wafflehaus.nova.networking.%s._shared' % name)
+        instance_networks._shared = None
+        shadow._shared = None
+        self.create_patch('%s.ShadowVerifier._ensure_worker' %
+                          shadow.__name__)
+        nova_path = 'wafflehaus.nova.nova_base.WafflehausNova'
+        self.m_ctx = self.create_patch('%s._get_context' % nova_path)
+        self.m_ctx.return_value = FakeContext()
+        self.m_instance = self.create_patch('%s._get_instance' % nova_path)
+        self.m_get_nwinfo = self.create_patch(
+            'nova.compute.utils.get_nw_info_for_instance')
+        self.m_get_nwinfo.return_value = [MockedVIFInfo(VIF, PUB)]
+        self.conf = {'enabled': 'true', 'networks_max': '2',
+                     'optional_nets': PUB, 'required_nets': PUB,
+                     'instance_cache_ttl': '600',
+                     'shadow_sample_rate': '1'}
+        self.attach_url = '/123456/servers/%s/os-virtual-interfacesv2' % (
+            SERVER)
+
+    def _attach(self, waffle, network):
+        body = '{"virtual_interface": {"network_id": "%s"}}' % network
+        return waffle.__call__.request(self.attach_url, method='POST',
+                                       body=body)
+
+    def test_cached_attach_verified_off_the_request(self):
+        waffle = network_count_check.filter_factory(self.conf)(nova_app)
+        self._attach(waffle, 'n1')
+        # The first attach was decided from a lookup, not from the cache
+        self.assertEqual(0, waffle.shadow.sampled)
+
+        # nova gained two networks the cache does not know about
+        self.m_get_nwinfo.return_value = [MockedVIFInfo(VIF, PUB),
+                                          MockedVIFInfo('v1', 'n1'),
+                                          MockedVIFInfo('v2', 'n2'),
+                                          MockedVIFInfo('v3', 'n3')]
+        time.sleep(0.01)
+        self.assertEqual(200, self._attach(waffle, 'n4').status_int)
+        self.assertEqual(1, waffle.shadow.sampled)
+        self.assertEqual(1, self.m_instance.call_count)
+
+        waffle.shadow.drain()
+        self.assertEqual(2, self.m_instance.call_count)
+        report = waffle._stats()['shadow']['attach']
+        self.assertEqual(1, report['mismatches'])
+        self.assertEqual(1, report['flipped_to_reject'])
+
+    def test_cached_detach_verified(self):
+        self.m_get_nwinfo.return_value = [MockedVIFInfo(VIF, PUB),
+                                          MockedVIFInfo(OTHER_VIF, 'n2')]
+        waffle = detach_network_check.filter_factory(self.conf)(nova_app)
+        url = '%s/%%s' % self.attach_url
+        waffle.__call__.request(url % OTHER_VIF, method='DELETE')
+        self.m_get_nwinfo.return_value = [MockedVIFInfo(VIF, PUB)]
+        time.sleep(0.01)
+        resp = waffle.__call__.request(url % VIF, method='DELETE')
+        self.assertTrue(isinstance(resp, webob.exc.HTTPForbidden))
+        waffle.shadow.drain()
+        report = waffle.shadow.report()['detach']
+        self.assertEqual(1, report['verified'])
+        self.assertEqual(0, report['mismatches'])
+        self.assertEqual(0, report['flipped_to_accept'])
+
+
+class TestShadowWorker(tests.TestCase):
+
+    def test_checks_verified_in_background(self):
+        verifier = shadow.ShadowVerifier(1.0)
+        verifier.submit(_check(lambda: {VIF: PUB}, lambda vifs: ''))
+        deadline = time.time() + 5
+        while not verifier.stats['attach'].verified:
+            self.assertTrue(time.time() < deadline)
+            time.sleep(0.01)
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""Compares string and packed IDs in cached entries and policy checks.
+
+Builds the same population of cached servers twice, once holding IDs as
+36 character strings and once packed by wafflehaus.nova.ids, and reports
+the memory per cached server and the time of the set operations attach
+checks perform on them. Usage:
+
+    python tools/bench_ids.py [--servers N] [--vifs N] [--networks N]
+"""
+from __future__ import print_function
+
+import argparse
+import random
+import sys
+import timeit
+import uuid
+
+from wafflehaus.nova import ids
+from wafflehaus.nova.networking import instance_networks
+from wafflehaus.nova.networking import network_policy
+
+
+def deep_size(obj, seen=None):
+    """Bytes held by obj and everything it references, counted once."""
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(k, seen) + deep_size(v, seen)
+                    for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_size(item, seen) for item in obj)
+    elif hasattr(obj, '__slots__'):
+        size += sum(deep_size(getattr(obj, name), seen)
+                    for name in obj.__slots__ if hasattr(obj, name))
+    return size
+
+
+class StringNetworks(object):
+    """ServerNetworks as it was before IDs were packed."""
+    __slots__ = ('vifs', 'pending', 'version', 'seeded_at', 'facts',
+                 'restored')
+
+    def __init__(self, vifs):
+        self.vifs = dict(vifs)
+        self.pending = []
+        self.version = 0
+        self.seeded_at = 0.0
+        self.facts = None
+        self.restored = False
+
+    def networks(self):
+        return set(self.vifs.values())
+
+
+def population(servers, vifs, networks, seed=0):
+    rng = random.Random(seed)
+
+    def new_id():
+        return str(uuid.UUID(int=rng.getrandbits(128)))
+
+    nets = [new_id() for _ in range(networks)]
+    return nets, [(new_id(), dict((new_id(), rng.choice(nets))
+                                  for _ in range(vifs)))
+                  for _ in range(servers)]
+
+
+def build(servers, packed):
+    entries = {}
+    for server, vifs in servers:
+        # Copies, so the string form does not share the source's strings
+        server = ''.join(server)
+        vifs = dict((''.join(v), ''.join(n)) for v, n in vifs.items())
+        if packed:
+            entries[('project', ids.pack(server))] = (
+                instance_networks.ServerNetworks(vifs, 0.0))
+        else:
+            entries[('project', server)] = StringNetworks(vifs)
+    return entries
+
+
+def time_checks(entries, policy, attaching, runs):
+    values = list(entries.values())
+
+    def check():
+        for entry in values:
+            policy.evaluate_attach(attaching, entry.networks())
+
+    return timeit.timeit(check, number=runs) / runs / len(values)
+
+
+def time_sets(entries, probe, runs):
+    values = [entry.networks() for entry in entries.values()]
+
+    def intersect():
+        for networks in values:
+            networks & probe
+
+    return timeit.timeit(intersect, number=runs) / runs / len(values)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--servers', type=int, default=10000,
+                        help='cached servers (default: 10000)')
+    parser.add_argument('--vifs', type=int, default=3,
+                        help='VIFs per server (default: 3)')
+    parser.add_argument('--networks', type=int, default=50,
+                        help='distinct networks (default: 50)')
+    parser.add_argument('--runs', type=int, default=20,
+                        help='timing passes over all servers (default: 20)')
+    args = parser.parse_args()
+
+    nets, servers = population(args.servers, args.vifs, args.networks)
+    policy = network_policy.NetworkPolicy(
+        banned=nets[:2], optional=nets[2:4], networks_max=args.vifs + 1)
+    attaching = [nets[-1]]
+
+    print('%-8s %14s %16s %16s' % ('ids', 'bytes/server', 'attach check us',
+                                   'intersect us'))
+    for packed in (False, True):
+        entries = build(servers, packed)
+        size = deep_size(entries) / float(len(entries))
+        probe = set(nets[:10])
+        if packed:
+            probe = set(ids.pack(net) for net in probe)
+        check = time_checks(entries, policy, attaching, args.runs)
+        sets = time_sets(entries, probe, args.runs)
+        print('%-8s %14.0f %16.2f %16.2f' % (
+            'packed' if packed else 'string', size, check * 1e6, sets * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""Measures import and filter_factory time of the wafflehaus.nova filters.
+
+Each import is timed in a fresh interpreter so that nothing is already
+sitting in sys.modules, which is what a paste load or a freshly forked
+worker sees. Usage:
+
+    python tools/bench_startup.py [--runs N] [--factory-runs N]
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import subprocess
+import sys
+import timeit
+
+FILTERS = {
+    'network_count_check':
+        'wafflehaus.nova.networking.network_count_check',
+    'detach_network_check':
+        'wafflehaus.nova.networking.detach_network_check',
+}
+
+HEAVY_MODULES = ('nova', 'oslo_serialization', 'pkg_resources')
+
+_IMPORT_PROBE = """
+import json, sys, time
+start = time.time()
+__import__(%r)
+elapsed = time.time() - start
+print(json.dumps({'elapsed': elapsed,
+                  'loaded': [m for m in %r if m in sys.modules]}))
+"""
+
+
+def _median(values):
+    values = sorted(values)
+    mid = len(values) // 2
+    if len(values) % 2:
+        return values[mid]
+    return (values[mid - 1] + values[mid]) / 2.0
+
+
+def time_import(module, runs):
+    """Returns (median seconds, heavy modules loaded) for a cold import."""
+    timings = []
+    loaded = []
+    for _ in range(runs):
+        out = subprocess.check_output(
+            [sys.executable, '-c', _IMPORT_PROBE % (module, HEAVY_MODULES)])
+        result = json.loads(out.decode('utf-8').strip().splitlines()[-1])
+        timings.append(result['elapsed'])
+        loaded = result['loaded']
+    return _median(timings), loaded
+
+
+def time_factory(module, runs, enabled):
+    """Returns the mean seconds to build the filter through paste."""
+    mod = __import__(module, fromlist=['filter_factory'])
+    conf = {'enabled': 'true' if enabled else 'false'}
+
+    def build():
+        mod.filter_factory(conf)(lambda environ, start_response: [])
+
+    return timeit.timeit(build, number=runs) / runs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5,
+                        help='cold imports per filter (default: 5)')
+    parser.add_argument('--factory-runs', type=int, default=1000,
+                        help='filter_factory calls per filter (default: 1000)')
+    args = parser.parse_args()
+
+    print('%-22s %12s %16s %16s  %s' % ('filter', 'import ms',
+                                        'factory us (on)', 'factory us (off)',
+                                        'heavy modules loaded'))
+    for name, module in sorted(FILTERS.items()):
+        imp, loaded = time_import(module, args.runs)
+        on = time_factory(module, args.factory_runs, True)
+        off = time_factory(module, args.factory_runs, False)
+        print('%-22s %12.2f %16.2f %16.2f  %s' % (
+            name, imp * 1e3, on * 1e6, off * 1e6, ','.join(loaded) or '-'))
+
+
+if __name__ == '__main__':
+    main()
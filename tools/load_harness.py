@@ -0,0 +1,369 @@
+#!/usr/bin/env python
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""Multi-process load harness for the nova networking waffles.
+
+The parent binds one listening socket and forks N workers, the way nova-api
+does. Each worker serves NetworkCountCheck and DetachNetworkCheck in front
+of a fake nova app, with the compute API replaced by a fake whose lookups
+sleep for a tunable latency. A threaded client then drives mixed boot,
+attach, detach and GET traffic, choosing servers with a Zipf distribution.
+Usage:
+
+    python tools/load_harness.py --workers 4 --clients 32 --duration 30 \\
+        --latency-ms 5 --mix boot=1,attach=2,detach=2,get=5
+"""
+from __future__ import print_function
+
+import argparse
+import bisect
+import json
+import multiprocessing
+import os
+import random
+import socket
+import sys
+import threading
+import time
+import types
+import uuid
+
+try:
+    import http.client as httplib
+except ImportError:
+    import httplib
+
+TENANT = '123456'
+REQUIRED_NET = '00000000-0000-0000-0000-000000000001'
+PUBLIC_NET = '00000000-0000-0000-0000-000000000000'
+NAMESPACE = uuid.UUID('6ba7b811-9dad-11d1-80b4-00c04fd430c8')
+
+
+def server_id(n):
+    return str(uuid.uuid5(NAMESPACE, 'server-%d' % n))
+
+
+def isolated_net(n):
+    return str(uuid.uuid5(NAMESPACE, 'network-%d' % n))
+
+
+def server_networks(server):
+    """Deterministic network list shared by the fake backend and client."""
+    rnd = random.Random(server)
+    nets = [PUBLIC_NET, REQUIRED_NET]
+    nets.extend(isolated_net(rnd.randint(0, 15))
+                for _ in range(rnd.randint(0, 2)))
+    return nets
+
+
+def vif_id(server, index):
+    return str(uuid.uuid5(NAMESPACE, '%s-vif-%d' % (server, index)))
+
+
+class FakeVIF(dict):
+    def __init__(self, vif, network):
+        super(FakeVIF, self).__init__(address='aa:bb:cc:dd:ee:ff', id=vif,
+                                      network={'id': network,
+                                               'label': 'fake'})
+
+    def fixed_ips(self):
+        return [{'address': '10.0.0.1'}]
+
+
+class FakeInstance(dict):
+    pass
+
+
+def install_fake_compute(latency, jitter, counters, slot):
+    """Puts a fake nova.compute with tunable latency into sys.modules."""
+    rnd = random.Random(os.getpid())
+
+    class API(object):
+        def get(self, context, server, want_objects=True):
+            counters[slot] += 1
+            delay = latency + (rnd.uniform(0, jitter) if jitter else 0)
+            if delay:
+                time.sleep(delay)
+            return FakeInstance(uuid=server)
+
+    def get_nw_info_for_instance(instance):
+        server = instance['uuid']
+        return [FakeVIF(vif_id(server, i), net)
+                for i, net in enumerate(server_networks(server))]
+
+    nova = types.ModuleType('nova')
+    compute = types.ModuleType('nova.compute')
+    utils = types.ModuleType('nova.compute.utils')
+    exception = types.ModuleType('nova.exception')
+    compute.API = API
+    compute.utils = utils
+    utils.get_nw_info_for_instance = get_nw_info_for_instance
+    exception.NotFound = type('NotFound', (Exception,), {})
+    exception.InstanceNotFound = type('InstanceNotFound',
+                                      (exception.NotFound,), {})
+    nova.compute = compute
+    nova.exception = exception
+    sys.modules.update({'nova': nova, 'nova.compute': compute,
+                        'nova.compute.utils': utils,
+                        'nova.exception': exception})
+
+
+class FakeContext(object):
+    def __init__(self, project_id):
+        self.project_id = project_id
+
+
+def fake_nova_app(environ, start_response):
+    """Stands in for the nova API application."""
+    length = int(environ.get('CONTENT_LENGTH') or 0)
+    if length:
+        environ['wsgi.input'].read(length)
+    start_response('200 OK', [('Content-Type', 'application/json'),
+                              ('Content-Length', '2')])
+    return [b'{}']
+
+
+def fake_auth(app):
+    """Sets nova.context the way the keystone middleware would."""
+    def middleware(environ, start_response):
+        environ['nova.context'] = FakeContext(TENANT)
+        return app(environ, start_response)
+    return middleware
+
+
+def build_pipeline(conf):
+    from wafflehaus.nova.networking import detach_network_check
+    from wafflehaus.nova.networking import network_count_check
+
+    app = fake_nova_app
+    app = network_count_check.filter_factory(conf)(app)
+    app = detach_network_check.filter_factory(conf)(app)
+    return fake_auth(app)
+
+
+def _serve_wsgiref(sock, app):
+    from wsgiref import simple_server
+    try:
+        import socketserver
+    except ImportError:
+        import SocketServer as socketserver
+
+    class Server(socketserver.ThreadingMixIn, simple_server.WSGIServer):
+        daemon_threads = True
+
+    class Handler(simple_server.WSGIRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+    server = Server(sock.getsockname(), Handler, bind_and_activate=False)
+    server.socket = sock
+    server.server_name, server.server_port = sock.getsockname()[:2]
+    server.setup_environ()
+    server.set_app(app)
+    server.serve_forever()
+
+
+def _serve_eventlet(sock, app):
+    import eventlet
+    eventlet.monkey_patch()
+    import eventlet.wsgi
+    eventlet.wsgi.server(eventlet.greenio.GreenSocket(sock), app,
+                         log_output=False)
+
+
+def worker_main(sock, args, conf, counters, slot):
+    install_fake_compute(args.latency_ms / 1000.0,
+                         args.latency_jitter_ms / 1000.0, counters, slot)
+    app = build_pipeline(conf)
+    if args.eventlet:
+        _serve_eventlet(sock, app)
+    else:
+        _serve_wsgiref(sock, app)
+
+
+class Zipf(object):
+    """Samples ranks 0..n-1 with probability proportional to 1/(k+1)^s."""
+
+    def __init__(self, n, s, rnd):
+        self.rnd = rnd
+        total = 0.0
+        self.cdf = []
+        for k in range(n):
+            total += 1.0 / (k + 1) ** s
+            self.cdf.append(total)
+        self.total = total
+
+    def sample(self):
+        return bisect.bisect_left(self.cdf, self.rnd.random() * self.total)
+
+
+def parse_mix(value):
+    mix = []
+    for part in value.split(','):
+        name, weight = part.split('=')
+        mix.append((name.strip(), float(weight)))
+    return mix
+
+
+def make_request(op, server):
+    base = '/%s/servers' % TENANT
+    if op == 'boot':
+        nets = [{'uuid': n} for n in server_networks(server)[1:]]
+        body = json.dumps({'server': {'name': 'x', 'networks': nets}})
+        return 'POST', base, body
+    if op == 'attach':
+        body = json.dumps({'virtual_interface': {
+            'network_id': isolated_net(random.randint(0, 15))}})
+        return 'POST', '%s/%s/os-virtual-interfacesv2' % (base, server), body
+    if op == 'detach':
+        index = random.randrange(len(server_networks(server)))
+        return 'DELETE', '%s/%s/os-virtual-interfacesv2/%s' % (
+            base, server, vif_id(server, index)), None
+    return 'GET', '%s/%s' % (base, server), None
+
+
+def client_main(port, args, mix, deadline, results, lock):
+    rnd = random.Random()
+    zipf = Zipf(args.servers, args.zipf, rnd)
+    names = [m[0] for m in mix]
+    cum = []
+    total = 0.0
+    for _, weight in mix:
+        total += weight
+        cum.append(total)
+    conn = httplib.HTTPConnection('127.0.0.1', port, timeout=30)
+    local = {}
+    while time.time() < deadline:
+        op = names[bisect.bisect_left(cum, rnd.random() * total)]
+        method, path, body = make_request(op, server_id(zipf.sample()))
+        headers = {'Content-Type': 'application/json'}
+        start = time.time()
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            resp = conn.getresponse()
+            resp.read()
+            status = resp.status
+        except (socket.error, httplib.HTTPException):
+            conn.close()
+            conn = httplib.HTTPConnection('127.0.0.1', port, timeout=30)
+            status = 0
+        elapsed = time.time() - start
+        latencies, statuses = local.setdefault(op, ([], {}))
+        latencies.append(elapsed)
+        statuses[status] = statuses.get(status, 0) + 1
+    conn.close()
+    with lock:
+        for op, (latencies, statuses) in local.items():
+            agg = results.setdefault(op, ([], {}))
+            agg[0].extend(latencies)
+            for status, count in statuses.items():
+                agg[1][status] = agg[1].get(status, 0) + count
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1,
+                int(round(pct / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def report(results, elapsed, lookups):
+    total = sum(len(lat) for lat, _ in results.values())
+    print('requests: %d in %.1fs, %.1f req/s' % (total, elapsed,
+                                                 total / elapsed))
+    print('backend lookups: %d (%.2f per request), per worker: %s' % (
+        sum(lookups), sum(lookups) / float(total or 1),
+        ','.join(str(n) for n in lookups)))
+    print('%-8s %8s %9s %9s %9s %9s %9s  %s' % (
+        'op', 'count', 'mean ms', 'p50 ms', 'p99 ms', 'p99.9 ms', 'max ms',
+        'statuses'))
+    for op in sorted(results):
+        latencies, statuses = results[op]
+        latencies.sort()
+        mean = sum(latencies) / len(latencies)
+        print('%-8s %8d %9.2f %9.2f %9.2f %9.2f %9.2f  %s' % (
+            op, len(latencies), mean * 1e3,
+            percentile(latencies, 50) * 1e3, percentile(latencies, 99) * 1e3,
+            percentile(latencies, 99.9) * 1e3, latencies[-1] * 1e3,
+            ' '.join('%s:%d' % s for s in sorted(statuses.items()))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--servers', type=int, default=1000,
+                        help='distinct server UUIDs (default: 1000)')
+    parser.add_argument('--zipf', type=float, default=1.1,
+                        help='Zipf exponent of server popularity')
+    parser.add_argument('--latency-ms', type=float, default=2.0,
+                        help='fake compute lookup latency')
+    parser.add_argument('--latency-jitter-ms', type=float, default=0.0)
+    parser.add_argument('--mix', default='boot=1,attach=2,detach=2,get=5')
+    parser.add_argument('--eventlet', action='store_true',
+                        help='serve with eventlet.wsgi like nova-api')
+    parser.add_argument('--conf', action='append', default=[],
+                        metavar='KEY=VALUE',
+                        help='extra filter configuration')
+    args = parser.parse_args()
+
+    conf = {'enabled': 'true', 'required_nets': REQUIRED_NET,
+            'optional_nets': PUBLIC_NET, 'networks_max': '3'}
+    conf.update(item.split('=', 1) for item in args.conf)
+    mix = parse_mix(args.mix)
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(1024)
+    port = sock.getsockname()[1]
+
+    counters = multiprocessing.Array('l', args.workers, lock=False)
+    ctx = multiprocessing.get_context('fork') if hasattr(
+        multiprocessing, 'get_context') else multiprocessing
+    workers = [ctx.Process(target=worker_main,
+                           args=(sock, args, conf, counters, slot))
+               for slot in range(args.workers)]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+
+    results = {}
+    lock = threading.Lock()
+    start = time.time()
+    deadline = start + args.duration
+    clients = [threading.Thread(target=client_main,
+                                args=(port, args, mix, deadline, results,
+                                      lock))
+               for _ in range(args.clients)]
+    try:
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        elapsed = time.time() - start
+    finally:
+        for worker in workers:
+            worker.terminate()
+        sock.close()
+    report(results, elapsed, list(counters))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""Replays captured requests through the networking filters.
+
+Reads capture files written with capture_file set and sends each summary,
+rebuilt as a request, through NetworkCountCheck (a pre_auth instance for
+pre-auth boots) and DetachNetworkCheck in front of a fake nova that keeps
+the servers' VIFs. Redacted IDs are turned back into UUIDs, boot bodies are
+padded to their captured size, and instance lookups take their captured
+time. Requests are sent at the captured pace times --speed; --speed 0 sends
+them as fast as possible, without lookup delays. Reports, per kind of
+request, the time spent in the filters and how many decisions match the
+captured ones. Usage:
+
+    python tools/replay_captures.py CAPTURE... [--speed N]
+        [--conf KEY=VALUE]...
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import sys
+import time
+import types
+import uuid
+
+import webob
+import webob.exc
+
+from wafflehaus.nova.networking import capture
+from wafflehaus.nova.networking import detach_network_check
+from wafflehaus.nova.networking import network_count_check
+
+
+def as_uuid(number):
+    return str(uuid.UUID(int=number))
+
+
+class ReplayContext(object):
+    is_admin = False
+
+    def __init__(self, project_id):
+        self.project_id = project_id
+
+
+class FakeVIF(dict):
+    def __init__(self, vif_id, net_id):
+        super(FakeVIF, self).__init__(
+            address='fa:16:3e:00:00:01', id=vif_id,
+            network={'id': net_id, 'label': 'replay'})
+
+    def fixed_ips(self):
+        return [{'address': '192.0.2.1'}]
+
+
+class FakeInstance(dict):
+    pass
+
+
+class FakeNova(object):
+    """Answers the requests the filters pass on, keeping servers' VIFs."""
+
+    def __init__(self):
+        self.servers = {}
+
+    def vifs(self, server_id):
+        return self.servers.setdefault(server_id, {})
+
+    def _json(self, start_response, status, body):
+        body = json.dumps(body).encode('utf-8')
+        start_response(status, [('Content-Type', 'application/json'),
+                                ('Content-Length', str(len(body)))])
+        return [body]
+
+    def _vif_view(self, vif_id, net_id):
+        return {'id': vif_id, 'mac_address': 'fa:16:3e:00:00:01',
+                'ip_addresses': [{'network_id': net_id,
+                                  'network_label': 'replay',
+                                  'address': '192.0.2.1'}]}
+
+    def __call__(self, environ, start_response):
+        parts = [p for p in environ['PATH_INFO'].split('/') if p]
+        method = environ['REQUEST_METHOD']
+        if len(parts) == 2:
+            return self._json(start_response, '202 Accepted', {})
+        vifs = self.vifs(parts[2])
+        if method == 'GET':
+            return self._json(start_response, '200 OK', {
+                'virtual_interfaces': [self._vif_view(v, n)
+                                       for v, n in vifs.items()]})
+        if method == 'DELETE':
+            vifs.pop(parts[4], None)
+            start_response('202 Accepted', [('Content-Length', '0')])
+            return [b'']
+        request = webob.Request(environ)
+        net_id = json.loads(request.body)['virtual_interface']['network_id']
+        vif_id = str(uuid.uuid4())
+        vifs[vif_id] = net_id
+        return self._json(start_response, '200 OK',
+                          {'virtual_interface': self._vif_view(vif_id,
+                                                               net_id)})
+
+
+def install_fake_compute(replayer):
+    """Puts a fake nova.compute answering from replayer into sys.modules.
+    """
+    class API(object):
+        def get(self, context, server, want_objects=True):
+            if replayer.speed > 0 and replayer.lookup_seconds:
+                time.sleep(replayer.lookup_seconds / replayer.speed)
+            return FakeInstance(uuid=server)
+
+    def get_nw_info_for_instance(instance):
+        return [FakeVIF(vif, net) for vif, net in
+                replayer.nova.vifs(instance['uuid']).items()]
+
+    nova = types.ModuleType('nova')
+    compute = types.ModuleType('nova.compute')
+    utils = types.ModuleType('nova.compute.utils')
+    exception = types.ModuleType('nova.exception')
+    compute.API = API
+    compute.utils = utils
+    utils.get_nw_info_for_instance = get_nw_info_for_instance
+    exception.InstanceNotFound = type('InstanceNotFound', (Exception,), {})
+    nova.compute = compute
+    nova.exception = exception
+    sys.modules.update({'nova': nova, 'nova.compute': compute,
+                        'nova.compute.utils': utils,
+                        'nova.exception': exception})
+
+
+class Replayer(object):
+
+    def __init__(self, conf, speed):
+        self.speed = speed
+        self.nova = FakeNova()
+        self.lookup_seconds = 0.0
+        self.count = network_count_check.filter_factory(conf)(self.nova)
+        self.pre_auth = network_count_check.filter_factory(
+            dict(conf, pre_auth='true'))(self.nova)
+        self.detach = detach_network_check.filter_factory(conf)(self.nova)
+        self.results = {}
+
+    def _prepare(self, record, server, vif):
+        """Gives the fake server the VIFs it had when captured."""
+        vifs = self.nova.vifs(server)
+        if record.kind == capture.DETACH and record.networks:
+            vifs[vif] = record.networks[0]
+        while len(vifs) < record.server_vifs:
+            vifs[str(uuid.uuid4())] = as_uuid(len(vifs) + 1)
+
+    def _request(self, record):
+        project = '%016x' % record.project
+        server = as_uuid(record.server)
+        vif = as_uuid(record.vif)
+        self._prepare(record, server, vif)
+        method, route = capture.ROUTES[record.kind]
+        path = route.format(project=project, server=server, vif=vif)
+        body = None
+        if record.kind in (capture.BOOT, capture.PRE_AUTH_BOOT):
+            server_body = {'name': '', 'flavorRef': '1',
+                           'networks': [{'uuid': n}
+                                        for n in record.networks]}
+            size = len(json.dumps({'server': server_body}))
+            server_body['name'] = 'x' * max(record.body_bytes - size, 0)
+            body = json.dumps({'server': server_body})
+        elif record.kind == capture.ATTACH:
+            body = json.dumps({'virtual_interface': {
+                'network_id': record.networks[0]}})
+        request = webob.Request.blank(path, method=method)
+        if body is not None:
+            request.body = body.encode('utf-8')
+            request.content_type = 'application/json'
+        if record.kind != capture.PRE_AUTH_BOOT:
+            request.environ['nova.context'] = ReplayContext(project)
+        return request
+
+    def _waffle(self, record):
+        if record.kind == capture.PRE_AUTH_BOOT:
+            return self.pre_auth
+        if record.kind == capture.DETACH:
+            return self.detach
+        return self.count
+
+    def replay(self, records):
+        if not records:
+            return 0.0
+        first = records[0].time
+        started = time.time()
+        for record in records:
+            if record.kind == capture.ATTACH and not record.networks:
+                continue
+            if self.speed > 0:
+                delay = (started + (record.time - first) / self.speed -
+                         time.time())
+                if delay > 0:
+                    time.sleep(delay)
+            request = self._request(record)
+            waffle = self._waffle(record)
+            self.lookup_seconds = record.lookup_seconds
+            would_reject = waffle.would_reject
+            begin = time.time()
+            resp = request.get_response(waffle)
+            elapsed = time.time() - begin
+            rejected = (resp.status_int == 403 or
+                        waffle.would_reject > would_reject)
+            result = self.results.setdefault(
+                capture.KINDS[record.kind],
+                {'requests': 0, 'matched': 0, 'truncated': 0, 'times': []})
+            result['requests'] += 1
+            result['matched'] += int(
+                rejected == (record.decision != capture.ACCEPT))
+            result['truncated'] += int(record.truncated)
+            result['times'].append(elapsed)
+        return time.time() - started
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('captures', nargs='+', help='capture files')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='pace relative to the capture, 0 for as fast '
+                             'as possible (default: 1)')
+    parser.add_argument('--conf', action='append', default=[],
+                        metavar='KEY=VALUE',
+                        help='filter setting, repeatable')
+    args = parser.parse_args()
+
+    conf = {'enabled': 'true'}
+    for setting in args.conf:
+        key, _, value = setting.partition('=')
+        conf[key.strip()] = value.strip()
+    records = []
+    for path in args.captures:
+        records.extend(capture.read_captures(path))
+    records.sort(key=lambda record: record.time)
+
+    replayer = Replayer(conf, args.speed)
+    install_fake_compute(replayer)
+    wall = replayer.replay(records)
+
+    print('%-14s %9s %9s %10s %10s %10s' % (
+        'kind', 'requests', 'matched', 'mean us', 'p50 us', 'p99 us'))
+    for kind, result in sorted(replayer.results.items()):
+        times = result['times']
+        print('%-14s %9d %9d %10.1f %10.1f %10.1f' % (
+            kind, result['requests'], result['matched'],
+            sum(times) / len(times) * 1e6, percentile(times, 0.5) * 1e6,
+            percentile(times, 0.99) * 1e6))
+        if result['truncated']:
+            print('  %d with networks beyond the slot size left out' %
+                  result['truncated'])
+    total = sum(r['requests'] for r in replayer.results.values())
+    print('%d requests in %.2f s' % (total, wall), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
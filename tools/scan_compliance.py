@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""Scans existing instances against the network count policy.
+
+Reads the NetworkCountCheck settings from a paste filter section, plus any
+--conf overrides, and evaluates every instance of the cells listed in the
+nova API database (or given with --cell) with them. Writes the summary as
+JSON and lists the projects with the most violating instances. Usage:
+
+    python tools/scan_compliance.py --paste /etc/nova/api-paste.ini \\
+        --filter network_count_check --api-db mysql+pymysql://... \\
+        [--cell NAME=URL]... [--conf KEY=VALUE]... [--processes 8] \\
+        [--checkpoint scan.json] [--output summary.json]
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import sys
+
+try:
+    import configparser
+except ImportError:
+    import ConfigParser as configparser
+
+from wafflehaus.nova.networking import compliance_scan
+
+
+def paste_conf(path, section):
+    parser = configparser.RawConfigParser()
+    parser.optionxform = str
+    if not parser.read(path):
+        raise SystemExit('Cannot read %s' % path)
+    if not section.startswith('filter:'):
+        section = 'filter:' + section
+    return dict(parser.items(section))
+
+
+def print_progress(scanner):
+    done, total = scanner.progress()
+    summary = scanner.summary
+    print('%d/%d ranges, %d instances, %d violating' % (
+        done, total, summary.scanned, summary.violating), file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--paste', help='paste configuration file')
+    parser.add_argument('--filter', default='network_count_check',
+                        help='filter section (default: %(default)s)')
+    parser.add_argument('--conf', action='append', default=[],
+                        metavar='KEY=VALUE',
+                        help='filter setting, repeatable')
+    parser.add_argument('--api-db', help='nova API database URL')
+    parser.add_argument('--cell', action='append', default=[],
+                        metavar='NAME=URL',
+                        help='cell database, repeatable')
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--ranges', type=int, default=4,
+                        help='UUID ranges per cell (default: %(default)s)')
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--batch-timeout', type=float, default=600,
+                        help='seconds a pooled batch may take before the '
+                             'scan fails (default: %(default)s)')
+    parser.add_argument('--examples', type=int, default=10,
+                        help='example servers kept per project')
+    parser.add_argument('--checkpoint',
+                        help='file to save progress to and resume from')
+    parser.add_argument('--output', help='file to write the summary to')
+    parser.add_argument('--top', type=int, default=20,
+                        help='projects to list (default: %(default)s)')
+    args = parser.parse_args()
+
+    conf = {}
+    if args.paste:
+        conf.update(paste_conf(args.paste, args.filter))
+    for setting in args.conf:
+        key, _, value = setting.partition('=')
+        conf[key.strip()] = value.strip()
+    cells = []
+    if args.api_db:
+        cells.extend(compliance_scan.cells_from_api_db(args.api_db))
+    for cell in args.cell:
+        name, _, url = cell.partition('=')
+        cells.append((name.strip(), url.strip()))
+    if not cells:
+        parser.error('give --api-db or at least one --cell')
+
+    scanner = compliance_scan.ComplianceScanner(
+        conf, cells, processes=args.processes, ranges_per_cell=args.ranges,
+        batch_size=args.batch_size, max_examples=args.examples,
+        batch_timeout=args.batch_timeout,
+        checkpoint=args.checkpoint, on_progress=print_progress)
+    report = scanner.run()
+
+    if args.output:
+        with open(args.output, 'w') as stream:
+            json.dump(report, stream, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+    projects = sorted(report['projects'].items(),
+                      key=lambda item: -item[1]['violating'])
+    print('%-34s %9s  %s' % ('project', 'violating', 'rules'),
+          file=sys.stderr)
+    for project, entry in projects[:args.top]:
+        rules = ', '.join('%s=%d' % item
+                          for item in sorted(entry['rules'].items()))
+        print('%-34s %9d  %s' % (project, entry['violating'], rules),
+              file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
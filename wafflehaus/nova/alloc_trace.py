@@ -0,0 +1,225 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""Memory allocated by waffle requests, attributed to their phases.
+
+For a sample of requests tracemalloc is started when the request enters the
+waffle and stopped when it leaves, so only that request's allocations are
+traced and the rest of the time costs nothing. The bytes and blocks still
+allocated at the end of each phase (parse, lookup, policy, ...) are added
+to that phase, and with Python 3.9 or later so is the peak within it.
+
+tracemalloc sees the whole process: phases that wait on nova also count
+what other requests allocate meanwhile in a busy eventlet worker. Only one
+request is traced at a time, and none if something else is using
+tracemalloc. On Python 2, which has no tracemalloc, tracing is disabled.
+"""
+import collections
+import logging
+import random
+import threading
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+LOG = logging.getLogger(__name__)
+
+_local = threading.local()
+_tracing_lock = threading.Lock()
+
+
+class _NullContext(object):
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL = _NullContext()
+
+
+def _filters():
+    # Snapshots themselves, and this module's bookkeeping, are not the
+    # request's allocations
+    return [tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__)]
+
+
+def _measure():
+    """Returns (bytes, blocks) traced now."""
+    snapshot = tracemalloc.take_snapshot().filter_traces(_filters())
+    size = blocks = 0
+    for trace in snapshot.traces:
+        size += trace.size
+        blocks += 1
+    return size, blocks
+
+
+def phase(name):
+    """Attributes allocations within to a phase of the traced request."""
+    trace = getattr(_local, 'trace', None)
+    if trace is None:
+        return _NULL
+    return _Phase(trace, name)
+
+
+def label(kind):
+    """Names the kind of request (boot, attach, ...) being traced."""
+    trace = getattr(_local, 'trace', None)
+    if trace is not None:
+        trace.kind = kind
+
+
+class RequestTrace(object):
+    """Allocations of one sampled request, by phase."""
+
+    def __init__(self):
+        self.kind = 'other'
+        self.phases = collections.OrderedDict()
+
+    def add(self, name, size, blocks, peak):
+        totals = self.phases.setdefault(name, [0, 0, 0])
+        totals[0] += size
+        totals[1] += blocks
+        totals[2] = max(totals[2], peak)
+
+
+class _Phase(object):
+
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+        self.start = None
+        self.base = 0
+
+    def __enter__(self):
+        self.start = _measure()
+        # The snapshot is gone again; the peak is measured from here
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+            self.base = tracemalloc.get_traced_memory()[0]
+        return self
+
+    def __exit__(self, *exc_info):
+        peak = 0
+        if hasattr(tracemalloc, 'reset_peak'):
+            peak = tracemalloc.get_traced_memory()[1] - self.base
+        size, blocks = _measure()
+        self.trace.add(self.name, size - self.start[0],
+                       blocks - self.start[1], peak)
+        return False
+
+
+class _Request(object):
+
+    def __init__(self, tracer):
+        self.tracer = tracer
+        self.trace = None
+
+    def __enter__(self):
+        if not _tracing_lock.acquire(False):
+            self.tracer.busy += 1
+            return None
+        if tracemalloc.is_tracing():
+            _tracing_lock.release()
+            self.tracer.busy += 1
+            return None
+        tracemalloc.start()
+        self.trace = _local.trace = RequestTrace()
+        return self.trace
+
+    def __exit__(self, *exc_info):
+        if self.trace is None:
+            return False
+        try:
+            size, blocks = _measure()
+            peaks = [totals[2] for totals in self.trace.phases.values()]
+            self.trace.add('total', size, blocks, max(peaks or [0]))
+        finally:
+            _local.trace = None
+            tracemalloc.stop()
+            _tracing_lock.release()
+        self.tracer.record(self.trace)
+        return False
+
+
+class PhaseStats(object):
+    """Allocations of a phase over all sampled requests."""
+
+    def __init__(self):
+        self.requests = 0
+        self.bytes = 0
+        self.blocks = 0
+        self.peak = 0
+
+    def report(self):
+        requests = float(self.requests or 1)
+        return {'requests': self.requests,
+                'mean_bytes': self.bytes / requests,
+                'mean_blocks': self.blocks / requests,
+                'max_peak_bytes': self.peak}
+
+
+class AllocationTracer(object):
+    """Samples requests and traces their allocations."""
+
+    def __init__(self, sample_rate, rng=random.random):
+        self.sample_rate = sample_rate
+        self.rng = rng
+        self.sampled = 0
+        self.busy = 0
+        self.stats = collections.defaultdict(
+            lambda: collections.defaultdict(PhaseStats))
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_conf(cls, conf):
+        """Returns a tracer if alloc_trace_sample_rate is set."""
+        rate = float(conf.get('alloc_trace_sample_rate', 0))
+        if rate <= 0:
+            return None
+        if tracemalloc is None:
+            LOG.warning('alloc_trace_sample_rate is set but tracemalloc is '
+                        'not available; allocations are not traced')
+            return None
+        return cls(min(rate, 1.0))
+
+    def request(self):
+        """Returns a context tracing the request, if it is sampled."""
+        if self.rng() >= self.sample_rate:
+            return _NULL
+        return _Request(self)
+
+    def record(self, trace):
+        with self._lock:
+            self.sampled += 1
+            phases = self.stats[trace.kind]
+            for name, (size, blocks, peak) in trace.phases.items():
+                stats = phases[name]
+                stats.requests += 1
+                stats.bytes += size
+                stats.blocks += blocks
+                stats.peak = max(stats.peak, peak)
+
+    def report(self):
+        with self._lock:
+            report = {'sample_rate': self.sample_rate,
+                      'sampled': self.sampled, 'busy': self.busy}
+            for kind, phases in self.stats.items():
+                report[kind] = dict((name, stats.report())
+                                    for name, stats in phases.items())
+        return report
@@ -0,0 +1,203 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""Asynchronous JSON-lines audit log for waffle policy decisions.
+
+Request threads only append to a bounded deque; a background writer drains
+it in batches, fsyncs at most every fsync_interval seconds and rotates the
+file by size. When the deque is full the record is dropped and counted so
+that a slow disk can never stall the API.
+"""
+import atexit
+import collections
+import json
+import logging
+import os
+import threading
+import time
+
+LOG = logging.getLogger(__name__)
+
+_audit_logs = {}
+_audit_logs_lock = threading.Lock()
+
+
+class AuditLog(object):
+    """Bounded, batched, rotating JSON-lines writer."""
+
+    def __init__(self, path, queue_size=10000, batch_size=256,
+                 flush_interval=1.0, fsync_interval=5.0, max_bytes=0,
+                 backup_count=5):
+        # %(pid)s is resolved by the process that opens the file, not the
+        # one paste loads the app in before nova forks its API workers
+        self.path_template = path
+        self.path = None
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.written = 0
+        self.dropped = 0
+        self.rotations = 0
+        self._queue = collections.deque()
+        self._wakeup = threading.Event()
+        self._write_lock = threading.Lock()
+        self._stream = None
+        self._stream_pid = None
+        self._last_fsync = 0.0
+        self._pid = None
+        self._writer = None
+        self._closed = False
+
+    @classmethod
+    def from_conf(cls, conf):
+        """Returns the shared AuditLog configured in conf, or None."""
+        path = conf.get('audit_log_file')
+        if not path:
+            return None
+        with _audit_logs_lock:
+            audit_log = _audit_logs.get(path)
+            if audit_log is None:
+                audit_log = cls(
+                    path,
+                    queue_size=int(conf.get('audit_queue_size', 10000)),
+                    batch_size=int(conf.get('audit_batch_size', 256)),
+                    flush_interval=float(conf.get('audit_flush_interval',
+                                                  1.0)),
+                    fsync_interval=float(conf.get('audit_fsync_interval',
+                                                  5.0)),
+                    max_bytes=int(conf.get('audit_max_bytes', 0)),
+                    backup_count=int(conf.get('audit_backup_count', 5)))
+                _audit_logs[path] = audit_log
+                atexit.register(audit_log.close)
+        return audit_log
+
+    def record(self, **fields):
+        """Queues a record without blocking; returns False if dropped."""
+        if self._closed:
+            return False
+        if len(self._queue) >= self.queue_size:
+            self.dropped += 1
+            return False
+        fields.setdefault('ts', round(time.time(), 6))
+        self._queue.append(fields)
+        self._ensure_writer()
+        if len(self._queue) >= self.batch_size:
+            self._wakeup.set()
+        return True
+
+    def stats(self):
+        return {'queued': len(self._queue), 'written': self.written,
+                'dropped': self.dropped, 'rotations': self.rotations}
+
+    def _ensure_writer(self):
+        # Paste loads the app before nova forks its API workers and threads
+        # do not survive a fork, so every process starts its own writer.
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._write_lock:
+            if self._pid == pid:
+                return
+            self._stream = None
+            self._writer = threading.Thread(target=self._run,
+                                            name='wafflehaus-audit')
+            self._writer.daemon = True
+            self._pid = pid
+            self._writer.start()
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                LOG.exception('Unable to write audit log %s',
+                              self.path or self.path_template)
+
+    def _take_batch(self):
+        batch = []
+        try:
+            while len(batch) < self.batch_size:
+                batch.append(self._queue.popleft())
+        except IndexError:
+            pass
+        return batch
+
+    def flush(self):
+        """Writes everything queued so far."""
+        with self._write_lock:
+            batch = self._take_batch()
+            while batch:
+                self._write_batch(batch)
+                batch = self._take_batch()
+            if self._stream is not None:
+                self._stream.flush()
+                now = time.time()
+                if now - self._last_fsync >= self.fsync_interval:
+                    os.fsync(self._stream.fileno())
+                    self._last_fsync = now
+
+    def _write_batch(self, batch):
+        lines = [json.dumps(rec, separators=(',', ':'), sort_keys=True)
+                 for rec in batch]
+        data = '\n'.join(lines) + '\n'
+        stream = self._open()
+        stream.write(data)
+        self.written += len(batch)
+        if self.max_bytes and stream.tell() >= self.max_bytes:
+            self._rotate()
+
+    def _open(self):
+        pid = os.getpid()
+        if self._stream is None or self._stream_pid != pid:
+            self.path = self.path_template % {'pid': pid}
+            self._stream = open(self.path, 'a')
+            self._stream_pid = pid
+        return self._stream
+
+    def _rotate(self):
+        self._stream.flush()
+        os.fsync(self._stream.fileno())
+        self._stream.close()
+        self._stream = None
+        if self.backup_count > 0:
+            for i in range(self.backup_count - 1, 0, -1):
+                src = '%s.%d' % (self.path, i)
+                if os.path.exists(src):
+                    os.rename(src, '%s.%d' % (self.path, i + 1))
+            os.rename(self.path, self.path + '.1')
+        else:
+            os.remove(self.path)
+        self.rotations += 1
+
+    def close(self):
+        """Drains the queue, syncs the file and stops the writer."""
+        if self._closed:
+            return
+        self._closed = True
+        self._wakeup.set()
+        writer = self._writer
+        if (writer is not None and self._pid == os.getpid() and
+                writer is not threading.current_thread()):
+            writer.join(self.flush_interval + 1)
+        self.fsync_interval = 0
+        self.flush()
+        with self._write_lock:
+            if self._stream is not None:
+                self._stream.close()
+                self._stream = None
@@ -0,0 +1,117 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+import collections
+import threading
+import time
+
+
+class TTLCache(object):
+    """Bounded LRU mapping whose entries expire after a time to live.
+
+    With a budget (see wafflehaus.nova.memory_budget), entries may also be
+    evicted to keep the memory of all caches within it.
+    """
+
+    def __init__(self, name, max_entries, ttl, clock=time.time,
+                 budget=None):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.budget = budget
+        if budget is not None:
+            budget.register(self)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return default
+            expires, value = entry
+            if expires <= self.clock():
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._data[key] = entry
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires = self.clock() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (expires, value)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evictions += 1
+        if self.budget is not None:
+            self.budget.stored(self, key, value)
+
+    def evict(self, count):
+        """Evicts up to count least recently used entries; returns how many.
+        """
+        with self._lock:
+            count = min(count, len(self._data))
+            for _ in range(count):
+                self._data.popitem(last=False)
+            self.evictions += count
+        return count
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def pop_matching(self, predicate):
+        """Removes every entry whose key satisfies predicate."""
+        with self._lock:
+            keys = [key for key in self._data if predicate(key)]
+            for key in keys:
+                del self._data[key]
+        return len(keys)
+
+    def items(self):
+        """Returns (key, value, expires) of live entries, oldest use first."""
+        now = self.clock()
+        with self._lock:
+            return [(key, value, expires)
+                    for key, (expires, value) in self._data.items()
+                    if expires > now]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'name': self.name, 'entries': len(self._data),
+                'max_entries': self.max_entries, 'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / float(lookups) if lookups else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations}
@@ -0,0 +1,186 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""Hedged instance lookups.
+
+A lookup runs in its own thread while the request thread waits for it up to
+a threshold, the observed percentile of recent lookup times. A lookup still
+running by then is hedged: a second one is started, and whichever returns
+first answers the request; a failure answers only if the other lookup fails
+too. The loser is left to finish and is discarded.
+
+Hedges draw on a token bucket every lookup adds hedge_budget percent of a
+token to, up to hedge_burst tokens, so at most that share of lookups is
+ever sent twice, however slow the database gets. Lookups made while no
+hedge could be sent, because the bucket is empty or too few lookup times
+are known yet, run in the request thread as they would without hedging.
+"""
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+_shared = None
+_shared_lock = threading.Lock()
+
+PRIMARY = 'primary'
+HEDGE = 'hedge'
+
+
+class LatencyWindow(object):
+    """The most recent lookup times and a percentile of them.
+
+    The percentile is recomputed every refresh samples, not per lookup.
+    """
+
+    def __init__(self, percentile=95, size=1000, refresh=100):
+        self.percentile = percentile
+        self.size = size
+        self.refresh = refresh
+        self.samples = []
+        self.added = 0
+        self.value = None
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            if len(self.samples) < self.size:
+                self.samples.append(seconds)
+            else:
+                self.samples[self.added % self.size] = seconds
+            self.added += 1
+            if self.added % self.refresh == 0:
+                ordered = sorted(self.samples)
+                index = int(len(ordered) * self.percentile / 100.0)
+                self.value = ordered[min(index, len(ordered) - 1)]
+
+
+class HedgedLookups(object):
+    """Sends a second lookup for ones slower than the recent percentile."""
+
+    def __init__(self, budget=5.0, burst=10.0, percentile=95,
+                 min_delay=0.002, window=1000, refresh=100,
+                 clock=time.time):
+        self.budget = budget / 100.0
+        self.burst = burst
+        self.min_delay = min_delay
+        self.clock = clock
+        self.latency = LatencyWindow(percentile, window, refresh)
+        self.tokens = burst
+        self.lookups = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.denied = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_conf(cls, conf):
+        """Returns the process-wide hedger if hedge_budget is set."""
+        global _shared
+        budget = float(conf.get('hedge_budget', 0))
+        if budget <= 0:
+            return None
+        with _shared_lock:
+            if _shared is None:
+                _shared = cls(
+                    budget=min(budget, 100.0),
+                    burst=float(conf.get('hedge_burst', 10)),
+                    percentile=float(conf.get('hedge_percentile', 95)),
+                    min_delay=float(conf.get('hedge_min_delay', 0.002)))
+        return _shared
+
+    def delay(self):
+        """Seconds to wait before hedging, or None if not known yet."""
+        value = self.latency.value
+        if value is None:
+            return None
+        return max(value, self.min_delay)
+
+    def _take_token(self):
+        with self._lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            self.hedged += 1
+            return True
+
+    def _attempt(self, kind, lookup, outcomes):
+        start = self.clock()
+        try:
+            outcome = (kind, lookup(), None)
+        except Exception as e:
+            outcome = (kind, None, e)
+        if kind == PRIMARY:
+            self.latency.add(self.clock() - start)
+        outcomes.put(outcome)
+
+    def _start(self, kind, lookup, outcomes):
+        thread = threading.Thread(target=self._attempt,
+                                  args=(kind, lookup, outcomes),
+                                  name='wafflehaus-lookup')
+        thread.daemon = True
+        thread.start()
+
+    def call(self, lookup, hedge=None):
+        """Returns lookup(), or hedge() (lookup by default) if faster."""
+        with self._lock:
+            self.lookups += 1
+            self.tokens = min(self.burst, self.tokens + self.budget)
+            tokens = self.tokens
+        delay = self.delay()
+        if delay is None or tokens < 1:
+            start = self.clock()
+            try:
+                return lookup()
+            finally:
+                self.latency.add(self.clock() - start)
+
+        outcomes = queue.Queue()
+        self._start(PRIMARY, lookup, outcomes)
+        try:
+            kind, result, error = outcomes.get(True, delay)
+        except queue.Empty:
+            running = 1
+            if self._take_token():
+                self._start(HEDGE, hedge or lookup, outcomes)
+                running = 2
+            else:
+                with self._lock:
+                    self.denied += 1
+            kind, result, error = outcomes.get()
+            if error is not None and running > 1:
+                # A failure only answers once nothing else can
+                kind, result, error = outcomes.get()
+            if kind == HEDGE and error is None:
+                with self._lock:
+                    self.hedge_wins += 1
+        if error is not None:
+            raise error
+        return result
+
+    def stats(self):
+        delay = self.delay()
+        return {'lookups': self.lookups, 'hedged': self.hedged,
+                'hedge_rate': (float(self.hedged) / self.lookups
+                               if self.lookups else 0.0),
+                'hedge_wins': self.hedge_wins,
+                'win_rate': (float(self.hedge_wins) / self.hedged
+                             if self.hedged else 0.0),
+                'denied': self.denied,
+                'threshold_ms': (round(delay * 1000, 3)
+                                 if delay is not None else None),
+                'budget_percent': self.budget * 100}
@@ -0,0 +1,77 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""Compact form of the UUIDs servers, VIFs, ports and networks go by.
+
+Caches and policy indexes hold a UUID as its 128-bit integer rather than its
+36 character string, which is about half the memory and hashes and compares
+as a single number. IDs are packed where they enter a cache or index and
+unpacked where they leave it for a message, an audit record or a snapshot.
+Anything that is not a dashed UUID is left as it is, so packing a value
+twice, or packing a project ID or a name, is harmless.
+
+Network IDs repeat on every server, so packed network IDs are also interned:
+cached entries share one object per network.
+"""
+try:
+    _STRING_TYPES = (str, unicode)  # noqa
+    _INT_TYPES = (int, long)  # noqa
+except NameError:
+    _STRING_TYPES = (str,)
+    _INT_TYPES = (int,)
+
+_HEX_DIGITS = frozenset('0123456789abcdefABCDEF')
+
+# Networks are few; the bound only guards against unbounded growth
+MAX_INTERNED = 65536
+_interned = {}
+
+
+def pack(value):
+    """Returns the int for a dashed UUID string, otherwise value itself."""
+    if (isinstance(value, _STRING_TYPES) and len(value) == 36 and
+            value[8] == value[13] == value[18] == value[23] == '-'):
+        digits = value.replace('-', '')
+        if len(digits) == 32 and _HEX_DIGITS.issuperset(digits):
+            return int(digits, 16)
+    return value
+
+
+def unpack(value):
+    """Returns the dashed UUID string for a packed value."""
+    if isinstance(value, _INT_TYPES) and not isinstance(value, bool):
+        digits = '%032x' % value
+        return '%s-%s-%s-%s-%s' % (digits[:8], digits[8:12], digits[12:16],
+                                   digits[16:20], digits[20:])
+    return value
+
+
+def pack_network(value):
+    """Packs a network ID, sharing one object per network."""
+    packed = pack(value)
+    interned = _interned.get(packed)
+    if interned is not None:
+        return interned
+    if len(_interned) < MAX_INTERNED:
+        _interned[packed] = packed
+    return packed
+
+
+def pack_vifs(vifs):
+    """Packs a {vif id: network id} mapping."""
+    return dict((pack(vif), pack_network(net)) for vif, net in vifs.items())
+
+
+def unpack_vifs(vifs):
+    return dict((unpack(vif), unpack(net)) for vif, net in vifs.items())
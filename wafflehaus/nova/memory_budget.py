@@ -0,0 +1,205 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""One memory budget shared by every cache of a worker.
+
+Caches created with the budget register with it. Their bytes are estimated
+as entries times a per-cache entry size, measured on a sample of the entries
+stored. When the estimated total goes over the budget, least recently used
+entries are evicted from the cache whose memory is worth the least, the one
+with the lowest hit rate per byte of entry, until it fits again.
+
+Estimates count the containers and __slots__ objects an entry references,
+including ones shared with other entries, such as interned network IDs, so
+they err high. Other objects, such as the CellMapping objects nova hands
+out, count only themselves and their attribute dict: what they reference,
+like the request context they were loaded with, is not the cache's.
+"""
+import sys
+import threading
+import weakref
+
+_shared = None
+_shared_lock = threading.Lock()
+
+# An OrderedDict entry costs its hash slot and link besides key and value
+_ENTRY_OVERHEAD = 100
+# Entries measured before a cache's size estimate is trusted
+_MEASURE_FIRST = 16
+
+_SUFFIXES = {'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30}
+
+
+def parse_bytes(value):
+    """Returns bytes from an int, or an int with a K, M or G suffix."""
+    value = str(value).strip().lower().rstrip('b')
+    if value and value[-1] in _SUFFIXES:
+        return int(float(value[:-1]) * _SUFFIXES[value[-1]])
+    return int(value)
+
+
+def _slots(cls):
+    """Returns the slot names declared by cls and its bases."""
+    names = []
+    for klass in cls.__mro__:
+        slots = klass.__dict__.get('__slots__', ())
+        if isinstance(slots, str):
+            slots = (slots,)
+        names.extend(name for name in slots
+                     if name not in ('__dict__', '__weakref__'))
+    return names
+
+
+def deep_size(obj, seen=None):
+    """Bytes held by obj, counting each object once.
+
+    Containers and objects with __slots__ are followed into what they hold.
+    Other objects count only themselves and their attribute dict, not the
+    objects it references.
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(k, seen) + deep_size(v, seen)
+                    for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_size(item, seen) for item in obj)
+    elif hasattr(obj, '__slots__'):
+        size += sum(deep_size(getattr(obj, name), seen)
+                    for name in _slots(type(obj)) if hasattr(obj, name))
+    elif hasattr(obj, '__dict__'):
+        size += sys.getsizeof(obj.__dict__)
+    return size
+
+
+class _Usage(object):
+    """What the budget knows of one registered cache."""
+
+    def __init__(self):
+        self.entry_bytes = 0.0
+        self.measured = 0
+        self.stored = 0
+        self.evictions = 0
+
+
+class MemoryBudget(object):
+    """Keeps the estimated bytes of registered caches within max_bytes."""
+
+    def __init__(self, max_bytes, sample_every=32):
+        self.max_bytes = max_bytes
+        self.sample_every = sample_every
+        self.enforcements = 0
+        self._caches = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_conf(cls, conf):
+        """Returns the process-wide budget if memory_budget is set."""
+        global _shared
+        max_bytes = parse_bytes(conf.get('memory_budget', 0))
+        if max_bytes <= 0:
+            return None
+        with _shared_lock:
+            if _shared is None:
+                _shared = cls(max_bytes)
+            else:
+                # The smallest budget any filter asked for holds
+                _shared.max_bytes = min(_shared.max_bytes, max_bytes)
+        return _shared
+
+    def register(self, cache):
+        with self._lock:
+            self._caches.setdefault(cache, _Usage())
+
+    def stored(self, cache, key, value):
+        """Called by a cache after storing an entry; evicts if over budget.
+
+        Must not be called with the cache's lock held.
+        """
+        with self._lock:
+            usage = self._caches.get(cache)
+            if usage is None:
+                return
+            usage.stored += 1
+            if (usage.measured < _MEASURE_FIRST or
+                    usage.stored % self.sample_every == 0):
+                size = deep_size((key, value)) + _ENTRY_OVERHEAD
+                usage.measured += 1
+                weight = 1.0 / min(usage.measured, _MEASURE_FIRST)
+                usage.entry_bytes += (size - usage.entry_bytes) * weight
+        self.enforce()
+
+    def _bytes(self, cache, usage):
+        return len(cache) * usage.entry_bytes
+
+    def total_bytes(self):
+        with self._lock:
+            caches = list(self._caches.items())
+        return sum(self._bytes(cache, usage) for cache, usage in caches)
+
+    @staticmethod
+    def _value(cache, usage):
+        """Hit rate per byte of entry: what an entry of cache is worth."""
+        lookups = cache.hits + cache.misses
+        hit_rate = cache.hits / float(lookups) if lookups else 0.0
+        return hit_rate / max(usage.entry_bytes, 1.0)
+
+    def enforce(self):
+        """Evicts from the least valuable caches until within budget."""
+        with self._lock:
+            caches = list(self._caches.items())
+        over = sum(self._bytes(c, u) for c, u in caches) - self.max_bytes
+        if over <= 0:
+            return 0
+        self.enforcements += 1
+        evicted = 0
+        caches.sort(key=lambda item: self._value(*item))
+        for cache, usage in caches:
+            if over <= 0:
+                break
+            if not usage.entry_bytes or not len(cache):
+                continue
+            wanted = int(over // usage.entry_bytes) + 1
+            dropped = cache.evict(wanted)
+            with self._lock:
+                usage.evictions += dropped
+            over -= dropped * usage.entry_bytes
+            evicted += dropped
+        return evicted
+
+    def stats(self):
+        with self._lock:
+            caches = list(self._caches.items())
+        report = {}
+        total = 0
+        for cache, usage in sorted(caches, key=lambda item: item[0].name):
+            size = self._bytes(cache, usage)
+            total += size
+            lookups = cache.hits + cache.misses
+            name = cache.name
+            suffix = 2
+            while name in report:
+                name = '%s#%d' % (cache.name, suffix)
+                suffix += 1
+            report[name] = {
+                'entries': len(cache), 'bytes': int(size),
+                'entry_bytes': int(usage.entry_bytes),
+                'hit_rate': cache.hits / float(lookups) if lookups else 0.0,
+                'evictions': usage.evictions}
+        return {'max_bytes': self.max_bytes, 'bytes': int(total),
+                'enforcements': self.enforcements, 'caches': report}
@@ -0,0 +1,120 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""Snapshot files of cached records, for warm restarts.
+
+A snapshot is a fixed header followed by zlib-compressed JSON records::
+
+    magic 'WHNS' | format version | record count | crc32 | payload length |
+    created at | mean lookup seconds
+
+Files are written to a temporary file in the same directory, synced and
+renamed over the old snapshot, so a reader sees either the old or the new
+file and never a partial one. Files with another format version, a short
+payload or a bad checksum are ignored.
+"""
+import fcntl
+import json
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import time
+import zlib
+
+LOG = logging.getLogger(__name__)
+
+MAGIC = b'WHNS'
+FORMAT_VERSION = 1
+_HEADER = struct.Struct('>4sHHIIIdd')
+
+
+class Snapshot(object):
+    """The records of a snapshot file and what its header says of them."""
+
+    def __init__(self, records, created, lookup_seconds):
+        self.records = records
+        self.created = created
+        self.lookup_seconds = lookup_seconds
+
+
+def dump(path, records, lookup_seconds=0.0):
+    """Atomically replaces path with a snapshot of records."""
+    payload = zlib.compress(json.dumps(
+        records, separators=(',', ':')).encode('utf-8'))
+    header = _HEADER.pack(MAGIC, FORMAT_VERSION, 0, len(records),
+                          zlib.crc32(payload) & 0xffffffff, len(payload),
+                          time.time(), lookup_seconds)
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix='.snapshot-', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as stream:
+            stream.write(header)
+            stream.write(payload)
+            stream.flush()
+            os.fsync(stream.fileno())
+        os.rename(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    return len(header) + len(payload)
+
+
+def load(path):
+    """Returns the Snapshot in path, or None if it is missing or invalid."""
+    try:
+        stream = open(path, 'rb')
+    except (IOError, OSError):
+        return None
+    with stream:
+        size = os.fstat(stream.fileno()).st_size
+        if size < _HEADER.size:
+            LOG.warning('Ignoring truncated snapshot %s', path)
+            return None
+        view = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            (magic, version, _flags, count, crc, length, created,
+             lookup_seconds) = _HEADER.unpack_from(view, 0)
+            if magic != MAGIC or version != FORMAT_VERSION:
+                LOG.warning('Ignoring snapshot %s of unknown format', path)
+                return None
+            payload = view[_HEADER.size:_HEADER.size + length]
+        finally:
+            view.close()
+    if len(payload) != length or zlib.crc32(payload) & 0xffffffff != crc:
+        LOG.warning('Ignoring corrupt snapshot %s', path)
+        return None
+    records = json.loads(zlib.decompress(payload).decode('utf-8'))
+    if len(records) != count:
+        LOG.warning('Ignoring corrupt snapshot %s', path)
+        return None
+    return Snapshot(records, created, lookup_seconds)
+
+
+class SnapshotLock(object):
+    """Holds an exclusive lock on path + '.lock' between processes."""
+
+    def __init__(self, path):
+        self.path = path + '.lock'
+        self.stream = None
+
+    def __enter__(self):
+        self.stream = open(self.path, 'a')
+        fcntl.flock(self.stream.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        fcntl.flock(self.stream.fileno(), fcntl.LOCK_UN)
+        self.stream.close()
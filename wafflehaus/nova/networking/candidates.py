@@ -0,0 +1,129 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""Candidate network policies evaluated next to the active one.
+
+Each candidate is the filter's configuration with some settings replaced,
+given as candidate_<name>_<setting>. Candidates never block a request: on a
+sample of requests they are evaluated against the networks, existing
+networks and facts the active policy already gathered, so they cost no
+lookups of their own, and their would-be decisions are counted.
+"""
+import collections
+import random
+import threading
+
+
+def candidate_conf(conf, name):
+    """Returns conf with the candidate_<name>_ settings applied."""
+    prefix = 'candidate_%s_' % name
+    merged = dict(conf)
+    # A candidate has no candidates of its own
+    merged.pop('candidate_policies', None)
+    for key, value in conf.items():
+        if key.startswith(prefix):
+            merged[key[len(prefix):]] = value
+    return merged
+
+
+class CandidateStats(object):
+    """Would-be decisions of one candidate, against the active policy."""
+
+    def __init__(self):
+        self.evaluated = 0
+        self.would_reject = 0
+        self.newly_rejected = 0
+        self.newly_accepted = 0
+        self.rules = collections.defaultdict(int)
+
+    def record(self, active_msg, rule, msg):
+        self.evaluated += 1
+        if msg:
+            self.would_reject += 1
+            self.rules[rule] += 1
+            if not active_msg:
+                self.newly_rejected += 1
+        elif active_msg:
+            self.newly_accepted += 1
+
+    def report(self):
+        rate = (self.would_reject / float(self.evaluated)
+                if self.evaluated else 0.0)
+        return {'evaluated': self.evaluated,
+                'would_reject': self.would_reject,
+                'reject_rate': rate,
+                'newly_rejected': self.newly_rejected,
+                'newly_accepted': self.newly_accepted,
+                'rules': dict(self.rules)}
+
+
+class CandidatePolicies(object):
+    """Candidate policies and the sampling of requests they see."""
+
+    def __init__(self, policies, sample_rate=1.0, rng=random.random):
+        self.policies = policies
+        self.sample_rate = sample_rate
+        self.rng = rng
+        self.requests = 0
+        self.sampled = 0
+        self.stats = dict((name, CandidateStats()) for name, _ in policies)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_conf(cls, conf, make_policy):
+        """Builds the candidates listed in candidate_policies, or None.
+
+        make_policy(conf) returns the NetworkPolicy for a configuration.
+        """
+        names = (conf.get('candidate_policies') or '').split()
+        if not names:
+            return None
+        policies = [(name, make_policy(candidate_conf(conf, name)))
+                    for name in names]
+        return cls(policies, float(conf.get('candidate_sample_rate', 1.0)))
+
+    def _sample(self):
+        self.requests += 1
+        if self.rng() >= self.sample_rate:
+            return False
+        self.sampled += 1
+        return True
+
+    def evaluate_boot(self, active_msg, networks, facts=None):
+        """Counts what each candidate would decide for a server boot."""
+        if not self._sample():
+            return
+        for name, policy in self.policies:
+            rule, msg = policy.evaluate_boot(networks, facts)
+            with self._lock:
+                self.stats[name].record(active_msg, rule, msg)
+
+    def evaluate_attach(self, active_msg, networks, existing_nets,
+                        facts=None):
+        """Counts what each candidate would decide for an attach."""
+        if not self._sample():
+            return
+        for name, policy in self.policies:
+            rule, msg = policy.evaluate_attach(networks, existing_nets,
+                                               facts)
+            with self._lock:
+                self.stats[name].record(active_msg, rule, msg)
+
+    def report(self):
+        with self._lock:
+            report = dict((name, stats.report())
+                          for name, stats in self.stats.items())
+        report.update(requests=self.requests, sampled=self.sampled,
+                      sample_rate=self.sample_rate)
+        return report
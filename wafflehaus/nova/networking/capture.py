@@ -0,0 +1,270 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""Sampled summaries of checked requests in a memory-mapped ring file.
+
+Each summary is one fixed-size slot: when it was made, the kind of request
+(which implies its method and route), the decision, the body size, the
+instance lookup time, how many VIFs the server had, the networks of the
+request, and redacted project, server and VIF IDs. Redacted IDs are the
+first 8 bytes of a salted SHA-1, so the same server is the same number
+throughout a capture without its ID being kept. Network IDs are kept, since
+policies name them.
+
+A sample costs a struct pack and a copy into the mapping; nothing is
+written by the request thread, the kernel writes the pages back. The newest
+capture_slots summaries are kept. Each worker writes its own file;
+read_captures() returns a file's summaries oldest first, and
+tools/replay_captures.py sends them through the filters again.
+"""
+import collections
+import functools
+import hashlib
+import mmap
+import os
+import random
+import struct
+import threading
+import time
+
+from wafflehaus.nova import ids
+
+MAGIC = b'WHCAP1\0\0'
+
+# magic, slot size, slots, next sequence number
+_HEADER = struct.Struct('<8sIIQ')
+_HEADER_BYTES = 64
+_CURSOR_OFFSET = 16
+
+# sequence, time, kind, decision, networks, networks stored, body bytes,
+# lookup microseconds, server VIFs, project, server, VIF
+_SLOT = struct.Struct('<QdBBBBIIHQQQ')
+_NETWORK = struct.Struct('<QQ')
+
+BOOT = 1
+ATTACH = 2
+DETACH = 3
+PRE_AUTH_BOOT = 4
+VIF_LIST = 5
+KINDS = {BOOT: 'boot', ATTACH: 'attach', DETACH: 'detach',
+         PRE_AUTH_BOOT: 'pre_auth_boot', VIF_LIST: 'vif_list'}
+ROUTES = {BOOT: ('POST', '/{project}/servers'),
+          ATTACH: ('POST', '/{project}/servers/{server}/'
+                           'os-virtual-interfacesv2'),
+          DETACH: ('DELETE', '/{project}/servers/{server}/'
+                             'os-virtual-interfacesv2/{vif}'),
+          PRE_AUTH_BOOT: ('POST', '/{project}/servers'),
+          VIF_LIST: ('GET', '/{project}/servers/{server}/'
+                            'os-virtual-interfacesv2')}
+
+ACCEPT = 0
+REJECT = 1
+WOULD_REJECT = 2
+DECISIONS = {ACCEPT: 'accept', REJECT: 'reject', WOULD_REJECT: 'would_reject'}
+
+_MASK = (1 << 64) - 1
+
+# Networks and projects repeat; their packed forms are kept, up to a bound
+MAX_MEMO = 65536
+
+_captures = {}
+_captures_lock = threading.Lock()
+
+Capture = collections.namedtuple('Capture', [
+    'sequence', 'time', 'kind', 'decision', 'body_bytes', 'lookup_seconds',
+    'server_vifs', 'project', 'server', 'vif', 'networks', 'truncated'])
+
+
+def _pack_network(network_id):
+    value = ids.pack(network_id)
+    if value is network_id:
+        # Not a UUID; keep a redacted form so it replays consistently
+        value = redact(value)
+    return _NETWORK.pack(value >> 64, value & _MASK)
+
+
+def _memoized(memo, make, value):
+    packed = memo.get(value)
+    if packed is None:
+        packed = make(value)
+        if len(memo) < MAX_MEMO:
+            memo[value] = packed
+    return packed
+
+
+def redact(value, salt=b''):
+    """Returns a 64-bit number standing for value, or 0 for none."""
+    if not value:
+        return 0
+    if not isinstance(value, bytes):
+        value = value.encode('utf-8')
+    return struct.unpack('<Q', hashlib.sha1(salt + value).digest()[:8])[0]
+
+
+class CaptureRing(object):
+    """Fixed-size ring of request summaries in a memory-mapped file."""
+
+    def __init__(self, path, slots=65536, slot_bytes=128):
+        if slot_bytes < _SLOT.size + _NETWORK.size:
+            raise ValueError('capture slots need at least %d bytes' %
+                             (_SLOT.size + _NETWORK.size))
+        self.path = path
+        self.slots = slots
+        self.slot_bytes = slot_bytes
+        self.max_networks = (slot_bytes - _SLOT.size) // _NETWORK.size
+        self._lock = threading.Lock()
+        size = _HEADER_BYTES + slots * slot_bytes
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            os.ftruncate(fd, size)
+            self._map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        _HEADER.pack_into(self._map, 0, MAGIC, slot_bytes, slots, 0)
+        self.sequence = 0
+
+    def append(self, kind, decision, body_bytes, lookup_seconds,
+               server_vifs, project, server, vif, networks):
+        """Writes one summary; redacted IDs and packed networks as given."""
+        stored = b''.join(networks[:self.max_networks])
+        with self._lock:
+            self.sequence += 1
+            sequence = self.sequence
+            offset = (_HEADER_BYTES +
+                      (sequence - 1) % self.slots * self.slot_bytes)
+            _SLOT.pack_into(
+                self._map, offset, sequence, time.time(), kind, decision,
+                min(len(networks), 255), len(stored) // _NETWORK.size,
+                min(body_bytes, 0xffffffff),
+                min(int(lookup_seconds * 1e6), 0xffffffff),
+                min(server_vifs, 0xffff), project, server, vif)
+            offset += _SLOT.size
+            self._map[offset:offset + len(stored)] = stored
+            struct.pack_into('<Q', self._map, _CURSOR_OFFSET, sequence)
+
+    def close(self):
+        with self._lock:
+            self._map.flush()
+            self._map.close()
+
+
+def read_captures(path):
+    """Returns the summaries in a capture file, oldest first."""
+    with open(path, 'rb') as stream:
+        data = stream.read()
+    magic, slot_bytes, slots, last = _HEADER.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise ValueError('%s is not a capture file' % path)
+    captures = []
+    for sequence in range(max(1, last - slots + 1), last + 1):
+        offset = _HEADER_BYTES + (sequence - 1) % slots * slot_bytes
+        fields = _SLOT.unpack_from(data, offset)
+        if fields[0] != sequence:
+            # Overwritten while the file was read
+            continue
+        (_, when, kind, decision, count, stored, body_bytes, lookup_us,
+         server_vifs, project, server, vif) = fields
+        offset += _SLOT.size
+        networks = []
+        for _ in range(stored):
+            high, low = _NETWORK.unpack_from(data, offset)
+            networks.append(ids.unpack((high << 64) | low))
+            offset += _NETWORK.size
+        captures.append(Capture(sequence, when, kind, decision, body_bytes,
+                                lookup_us / 1e6, server_vifs, project,
+                                server, vif, networks, count > stored))
+    return captures
+
+
+class TrafficCapture(object):
+    """Samples checked requests into each worker's own CaptureRing."""
+
+    def __init__(self, path, sample_rate=1.0, slots=65536, slot_bytes=128,
+                 salt=b'', rng=random.random):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.slots = slots
+        self.slot_bytes = slot_bytes
+        self.salt = salt
+        self.rng = rng
+        self.captured = 0
+        self.errors = 0
+        self._ring = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._redact = functools.partial(redact, salt=salt)
+        self._projects = {}
+        self._networks = {}
+
+    @classmethod
+    def from_conf(cls, conf):
+        """Returns the shared capture configured in conf, or None."""
+        path = conf.get('capture_file')
+        if not path:
+            return None
+        salt = conf.get('capture_salt')
+        if not salt:
+            # Unsalted, a redacted ID is just the hash of a guessable UUID
+            raise ValueError("capture_file needs capture_salt")
+        with _captures_lock:
+            capture = _captures.get(path)
+            if capture is None:
+                capture = cls(
+                    path,
+                    sample_rate=float(conf.get('capture_sample_rate', 1.0)),
+                    slots=int(conf.get('capture_slots', 65536)),
+                    slot_bytes=int(conf.get('capture_slot_bytes', 128)),
+                    salt=salt.encode('utf-8'))
+                _captures[path] = capture
+        return capture
+
+    def _get_ring(self):
+        # Workers forked from one parent must not share a mapping
+        pid = os.getpid()
+        if self._pid == pid:
+            return self._ring
+        with self._lock:
+            if self._pid != pid:
+                path = self.path % {'pid': pid}
+                if path == self.path:
+                    path = '%s.%d' % (path, pid)
+                self._ring = CaptureRing(path, self.slots, self.slot_bytes)
+                self._pid = pid
+        return self._ring
+
+    def should_sample(self):
+        return self.sample_rate >= 1.0 or self.rng() < self.sample_rate
+
+    def record(self, kind, decision, body_bytes=0, lookup_seconds=0.0,
+               server_vifs=0, project=None, server=None, vif=None,
+               networks=()):
+        """Summarizes one request; never raises into it."""
+        try:
+            self._get_ring().append(
+                kind, decision, body_bytes or 0, lookup_seconds or 0.0,
+                server_vifs or 0,
+                _memoized(self._projects, self._redact, project),
+                self._redact(server), self._redact(vif),
+                [_memoized(self._networks, _pack_network, network)
+                 for network in networks])
+            self.captured += 1
+        except Exception:
+            self.errors += 1
+
+    def stats(self):
+        ring = self._ring
+        return {'captured': self.captured, 'errors': self.errors,
+                'sample_rate': self.sample_rate,
+                'path': ring.path if ring is not None else None,
+                'slots': self.slots}
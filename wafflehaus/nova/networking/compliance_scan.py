@@ -0,0 +1,431 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""Offline scan of existing instances against the network count policy.
+
+NetworkCountCheck only sees new boots and attaches. The scanner reads the
+network info cache of every instance from the cell databases and runs its
+networks through the same NetworkPolicy.evaluate_boot(), so the effect of a
+policy change on the fleet can be measured.
+
+Each cell's instances are split into UUID ranges, and each range is read in
+keyset-paginated batches (uuid > last seen, ORDER BY uuid, LIMIT n), so a
+query holds one batch and costs the same at any depth. Batches run in a
+pool of processes with one outstanding batch per range, which scans cells
+and ranges in parallel. Only violations are summarized, per project with a
+bounded number of example servers, so memory does not grow with the fleet.
+Range cursors and the summary are saved to a checkpoint file, and a scan
+given the same checkpoint resumes where it stopped.
+"""
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import sqlite3
+import tempfile
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from wafflehaus.nova.networking import network_count_check
+
+LOG = logging.getLogger(__name__)
+
+CHECKPOINT_VERSION = 1
+CELL0_UUID = '00000000-0000-0000-0000-000000000000'
+
+_INSTANCES = ('SELECT i.uuid, i.project_id, i.image_ref, c.network_info, '
+              '%(flavor)s FROM instances i '
+              'JOIN instance_info_caches c ON c.instance_uuid = i.uuid '
+              '%(extra)s'
+              'WHERE i.deleted = 0 AND c.deleted = 0 AND i.uuid > ? '
+              '%(before)s'
+              'ORDER BY i.uuid LIMIT ?')
+
+# Policy and connections of a scanning process, set up by _init_worker()
+_worker = {}
+
+
+def connect(url):
+    """Returns (DB-API connection, placeholder) for a database URL.
+
+    sqlite:/// URLs are opened with sqlite3; others need SQLAlchemy, which
+    nova already depends on.
+    """
+    if url.startswith('sqlite:///'):
+        return sqlite3.connect(url[len('sqlite:///'):]), '?'
+    import sqlalchemy
+    from sqlalchemy import pool
+
+    engine = sqlalchemy.create_engine(url, poolclass=pool.NullPool)
+    placeholder = '?' if engine.dialect.paramstyle == 'qmark' else '%s'
+    return engine.raw_connection(), placeholder
+
+
+def _query(connection, placeholder, sql, params=()):
+    cursor = connection.cursor()
+    try:
+        cursor.execute(sql.replace('?', placeholder), params)
+        return cursor.fetchall()
+    finally:
+        cursor.close()
+
+
+def cells_from_api_db(url):
+    """Returns [(name, database URL)] of the cells in a nova API database.
+
+    cell0 only holds instances that were never scheduled, and so have no
+    networks; it is left out.
+    """
+    connection, placeholder = connect(url)
+    try:
+        rows = _query(connection, placeholder,
+                      'SELECT uuid, name, database_connection '
+                      'FROM cell_mappings ORDER BY id')
+    finally:
+        connection.close()
+    return [(name or uuid, database) for uuid, name, database in rows
+            if uuid != CELL0_UUID]
+
+
+def uuid_ranges(count):
+    """Splits the UUID space into count (lower, upper) ranges.
+
+    A bound is a prefix of 8 hex digits, which sorts before every UUID it
+    begins, so lower < uuid < upper selects each UUID exactly once.
+    """
+    bounds = [''] + ['%08x' % (i * (1 << 32) // count)
+                     for i in range(1, count)] + [None]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _networks(network_info):
+    """Returns the network IDs in an instance's network info cache."""
+    vifs = json.loads(network_info) if network_info else []
+    return [vif['network']['id'] for vif in vifs
+            if vif.get('network') and vif['network'].get('id')]
+
+
+def _flavor_id(flavor):
+    """Returns the flavorid in instance_extra's flavor, or None."""
+    try:
+        return json.loads(flavor)['cur']['nova_object.data']['flavorid']
+    except (TypeError, ValueError, KeyError):
+        return None
+
+
+def _init_worker(conf):
+    cfg = network_count_check.NetworkCountConfig(conf)
+    # A forked worker must not close connections inherited from the parent:
+    # they are the parent's, and may belong to another of its threads
+    _worker.clear()
+    _worker['policy'] = cfg.policy
+    _worker['want_facts'] = cfg.needs_instance_facts()
+    _worker['connections'] = {}
+
+
+def _close_connections():
+    """Closes the connections opened by batches scanned in this process."""
+    for connection, _ in _worker.pop('connections', {}).values():
+        try:
+            connection.close()
+        except Exception:
+            LOG.exception('Unable to close a cell database connection')
+
+
+def _connection(url):
+    connections = _worker['connections']
+    if url not in connections:
+        connections[url] = connect(url)
+    return connections[url]
+
+
+def scan_batch(index, url, after, before, limit):
+    """Evaluates the next batch of a range of a cell's instances.
+
+    Returns (index, last UUID read, rows read, unreadable rows,
+    [(project, server, rule, message)], error). Errors are returned as
+    text rather than raised, since they have to cross processes.
+    """
+    try:
+        connection, placeholder = _connection(url)
+        want_facts = _worker['want_facts']
+        params = [after]
+        if before is not None:
+            params.append(before)
+        params.append(limit)
+        sql = _INSTANCES % {
+            'flavor': 'e.flavor' if want_facts else 'NULL',
+            'extra': ('LEFT JOIN instance_extra e '
+                      'ON e.instance_uuid = i.uuid ' if want_facts else ''),
+            'before': 'AND i.uuid < ? ' if before is not None else ''}
+        rows = _query(connection, placeholder, sql, params)
+        policy = _worker['policy']
+        unreadable = 0
+        violations = []
+        for server, project, image, network_info, flavor in rows:
+            try:
+                networks = _networks(network_info)
+            except (TypeError, ValueError, KeyError):
+                unreadable += 1
+                continue
+            facts = None
+            if want_facts:
+                facts = {'project': project, 'flavor': _flavor_id(flavor),
+                         'image': image or None}
+            rule, msg = policy.evaluate_boot(networks, facts)
+            if msg:
+                violations.append((project, server, rule, msg))
+        if rows:
+            after = rows[-1][0]
+        return index, after, len(rows), unreadable, violations, None
+    except Exception as e:
+        return index, after, 0, 0, [], '%s: %s' % (type(e).__name__, e)
+
+
+class ComplianceSummary(object):
+    """Counts of violating instances, per rule, cell and project."""
+
+    def __init__(self, max_examples=10):
+        self.max_examples = max_examples
+        self.scanned = 0
+        self.unreadable = 0
+        self.violating = 0
+        self.rules = {}
+        self.messages = {}
+        self.cells = {}
+        self.projects = {}
+
+    def add(self, cell, scanned, unreadable, violations):
+        self.scanned += scanned
+        self.unreadable += unreadable
+        self.violating += len(violations)
+        cell_counts = self.cells.setdefault(cell,
+                                            {'scanned': 0, 'violating': 0})
+        cell_counts['scanned'] += scanned
+        cell_counts['violating'] += len(violations)
+        for project, server, rule, msg in violations:
+            self.rules[rule] = self.rules.get(rule, 0) + 1
+            self.messages[msg] = self.messages.get(msg, 0) + 1
+            entry = self.projects.setdefault(
+                project, {'violating': 0, 'rules': {}, 'servers': []})
+            entry['violating'] += 1
+            entry['rules'][rule] = entry['rules'].get(rule, 0) + 1
+            if len(entry['servers']) < self.max_examples:
+                entry['servers'].append(server)
+
+    def report(self):
+        return {'scanned': self.scanned, 'unreadable': self.unreadable,
+                'violating': self.violating, 'rules': self.rules,
+                'messages': self.messages, 'cells': self.cells,
+                'projects': self.projects}
+
+    @classmethod
+    def from_report(cls, report, max_examples=10):
+        summary = cls(max_examples)
+        for key in ('scanned', 'unreadable', 'violating', 'rules',
+                    'messages', 'cells', 'projects'):
+            setattr(summary, key, report[key])
+        return summary
+
+
+def policy_digest(conf):
+    """Identifies a policy configuration, so resumed scans keep to it."""
+    text = json.dumps(sorted(conf.items()))
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def save_checkpoint(path, state):
+    """Atomically replaces path with the scan state."""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix='.checkpoint-', dir=directory)
+    try:
+        with os.fdopen(fd, 'w') as stream:
+            json.dump(state, stream)
+            stream.flush()
+            os.fsync(stream.fileno())
+        os.rename(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+def load_checkpoint(path):
+    """Returns the scan state saved in path, or None if there is none."""
+    try:
+        with open(path) as stream:
+            state = json.load(stream)
+    except (IOError, OSError):
+        return None
+    if state.get('version') != CHECKPOINT_VERSION:
+        raise ValueError('%s is not a compliance scan checkpoint' % path)
+    return state
+
+
+class ComplianceScanner(object):
+    """Scans the instances of cells against a NetworkCountCheck policy.
+
+    conf is the network count filter's configuration and cells a list of
+    (name, database URL). With processes above 1, batches are evaluated in
+    a process pool; otherwise in this process. A pooled batch without a
+    result after batch_timeout seconds, as when its worker died, fails the
+    scan like a batch that could not be read.
+    """
+
+    def __init__(self, conf, cells, processes=1, ranges_per_cell=4,
+                 batch_size=500, max_examples=10, checkpoint=None,
+                 checkpoint_interval=10.0, on_progress=None,
+                 batch_timeout=600.0, clock=time.time):
+        self.conf = conf
+        self.cells = dict(cells)
+        self.processes = processes
+        self.ranges_per_cell = ranges_per_cell
+        self.batch_size = batch_size
+        self.max_examples = max_examples
+        self.checkpoint = checkpoint
+        self.checkpoint_interval = checkpoint_interval
+        self.on_progress = on_progress
+        self.batch_timeout = batch_timeout
+        self.clock = clock
+        self.ranges = None
+        self.summary = None
+
+    def _start(self):
+        state = None
+        if self.checkpoint:
+            state = load_checkpoint(self.checkpoint)
+        if state is None:
+            self.ranges = [{'cell': cell, 'lower': lower, 'upper': upper,
+                            'cursor': lower, 'scanned': 0, 'done': False}
+                           for cell in sorted(self.cells)
+                           for lower, upper in uuid_ranges(
+                               self.ranges_per_cell)]
+            self.summary = ComplianceSummary(self.max_examples)
+            return
+        if state['policy'] != policy_digest(self.conf):
+            raise ValueError('%s was made with another policy' %
+                             self.checkpoint)
+        if set(r['cell'] for r in state['ranges']) != set(self.cells):
+            raise ValueError('%s was made for other cells' % self.checkpoint)
+        self.ranges = state['ranges']
+        self.summary = ComplianceSummary.from_report(state['summary'],
+                                                     self.max_examples)
+
+    def save(self):
+        if self.checkpoint:
+            save_checkpoint(self.checkpoint, {
+                'version': CHECKPOINT_VERSION,
+                'policy': policy_digest(self.conf),
+                'ranges': self.ranges,
+                'summary': self.summary.report()})
+        if self.on_progress is not None:
+            self.on_progress(self)
+
+    def progress(self):
+        """Returns (ranges done, ranges) of the scan."""
+        return (sum(1 for r in self.ranges if r['done']), len(self.ranges))
+
+    def run(self):
+        """Scans every range not done yet; returns the summary report."""
+        self._start()
+        results = queue.Queue()
+        # range index -> (AsyncResult, deadline) of the batches not done
+        pending = {}
+        pool = None
+        if self.processes > 1:
+            pool = multiprocessing.Pool(self.processes, _init_worker,
+                                        (self.conf,))
+        else:
+            _init_worker(self.conf)
+
+        def submit(index):
+            scan_range = self.ranges[index]
+            args = (index, self.cells[scan_range['cell']],
+                    scan_range['cursor'], scan_range['upper'],
+                    self.batch_size)
+            if pool is None:
+                results.put(scan_batch(*args))
+                pending[index] = (None, None)
+            else:
+                pending[index] = (
+                    pool.apply_async(scan_batch, args, callback=results.put),
+                    self.clock() + self.batch_timeout)
+
+        for index, scan_range in enumerate(self.ranges):
+            if not scan_range['done']:
+                submit(index)
+        saved = self.clock()
+        try:
+            while pending:
+                (index, cursor, count, unreadable, violations,
+                 error) = self._next(results, pending)
+                scan_range = self.ranges[index]
+                if error:
+                    raise RuntimeError('Scanning cell %s failed: %s' %
+                                       (scan_range['cell'], error))
+                scan_range['cursor'] = cursor
+                scan_range['scanned'] += count
+                scan_range['done'] = count < self.batch_size
+                self.summary.add(scan_range['cell'], count, unreadable,
+                                 violations)
+                if not scan_range['done']:
+                    submit(index)
+                if self.clock() - saved >= self.checkpoint_interval:
+                    self.save()
+                    saved = self.clock()
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+            else:
+                _close_connections()
+            self.save()
+        return self.summary.report()
+
+    def _next(self, results, pending):
+        """Returns the result of the next batch to finish, or to fail.
+
+        A pool never returns the task of a worker that died, so a batch
+        without a result by its deadline is failed; its range keeps its
+        cursor, and a resumed scan reads the batch again.
+        """
+        while True:
+            try:
+                # A timeout keeps the wait interruptible
+                result = results.get(True, 1.0)
+            except queue.Empty:
+                pass
+            else:
+                del pending[result[0]]
+                return result
+            now = self.clock()
+            for index, (async_result, deadline) in list(pending.items()):
+                if async_result is None:
+                    continue
+                if async_result.ready() and not async_result.successful():
+                    try:
+                        async_result.get()
+                    except Exception as e:
+                        error = '%s: %s' % (type(e).__name__, e)
+                elif now >= deadline:
+                    error = ('no result within %g seconds, its worker may '
+                             'have died' % self.batch_timeout)
+                else:
+                    continue
+                del pending[index]
+                return index, None, 0, 0, [], error
@@ -12,14 +12,18 @@
 #    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 #    License for the specific language governing permissions and limitations
 #    under the License.
+import functools
+import time
+
 import webob.dec
 import webob.exc
 
 from oslo_utils import uuidutils
+from wafflehaus.nova import alloc_trace
+from wafflehaus.nova import ids
+from wafflehaus.nova.networking import capture
 from wafflehaus.nova.networking import networking_base as net_base
 
-from nova.compute import utils as compute_utils
-
 
 def _translate_vif_summary_view(_context, vif):
     """Maps keys for VIF summary view."""
@@ -44,7 +48,9 @@ class DetachNetworkCheck(net_base.WafflehausNovaNetworking):
 
     def _get_network_info(self, context, server_id, entity_maker):
         """Returns a list of VIFs, transformed through entity_maker."""
-        instance = self._get_instance(context, server_id)
+        from nova.compute import utils as compute_utils
+
+        instance = self._lookup_instance(context, server_id)
         nw_info = compute_utils.get_nw_info_for_instance(instance)
         vifs = []
         for vif in nw_info:
@@ -57,17 +63,59 @@ class DetachNetworkCheck(net_base.WafflehausNovaNetworking):
             vifs.append(entity_maker(context, v))
         return {'virtual_interfaces': vifs}
 
+    def _get_vif_network(self, context, server_id, vif_id):
+        """Returns (network id of the server's VIF or None, cache entry).
+        """
+        if self.network_cache is not None:
+            entry = self._get_cached_networks(context, server_id, vif_id)
+            network_id = entry.vifs.get(ids.pack(vif_id))
+            if network_id is None:
+                # Not even a fresh lookup of the server knows the VIF
+                msg = "VIF %s could not be found." % vif_id
+                raise webob.exc.HTTPNotFound(explanation=msg)
+            return ids.unpack(network_id), entry
+
+        ent_maker = _translate_vif_summary_view
+        network_info = self._get_network_info(context, server_id,
+                                              entity_maker=ent_maker)
+        for vif in network_info["virtual_interfaces"]:
+            if vif['id'] == vif_id:
+                ip_info = vif['ip_addresses']
+                return ip_info[0]['network_id'], None
+        return None, None
+
+    def _decide_detach(self, vif_id, vifs):
+        """The detach decision for a VIF among the server's actual vifs."""
+        if ids.unpack(vifs.get(ids.pack(vif_id))) in self.required_networks:
+            return "Network (%s) cannot be detached" % ",".join(
+                self.required_networks)
+        return ""
+
+    def _apply_detach(self, project_id, server_id, vif_id, version, resp):
+        """Records a detach nova accepted in the instance network cache."""
+        self.network_cache.apply_detach(project_id, server_id, vif_id,
+                                        version=version)
+
     @webob.dec.wsgify
     def __call__(self, req, **local_config):
         super(DetachNetworkCheck, self).__call__(req)
         if not self.enabled:
             return self.app
 
+        if self._is_stats_request(req):
+            return self._stats_response(req)
+
 # TODO(jlh): eventually we will need to make this a wafflehaus supported fx
         verb = req.method
+        if verb == "GET" and self.prefetch_vif_lists:
+            return self._traced(self._prefetch_vif_list, req)
         if verb != "DELETE":
             return self.app
 
+        return self._traced(self._check_request, req)
+
+    def _check_request(self, req):
+        """Returns the response to a DELETE, or the app to pass it on to."""
         context = self._get_context(req)
         if not context:
             return self.app
@@ -94,20 +142,41 @@ class DetachNetworkCheck(net_base.WafflehausNovaNetworking):
 # TODO(jlh): Everything above ^^ is what needs to be one line
 
         # at this point we know it is the correct call
-        ent_maker = _translate_vif_summary_view
-        network_info = self._get_network_info(context, server_uuid,
-                                              entity_maker=ent_maker)
-
-        msg = "Network (%s) cannot be detached"
-        network_list = ",".join(self.required_networks)
-        for vif in network_info["virtual_interfaces"]:
-            if vif['id'] == vif_uuid:
-                ip_info = vif['ip_addresses']
-                network_id = ip_info[0]['network_id']
-                if network_id in self.required_networks:
-                    self.log.info("attempt to detach required network")
-                    return webob.exc.HTTPForbidden(msg % network_list)
-
+        alloc_trace.label('detach')
+        started = time.time()
+        try:
+            with alloc_trace.phase('lookup'):
+                network_id, entry = self._get_vif_network(
+                    context, server_uuid, vif_uuid)
+        except webob.exc.HTTPNotFound as not_found:
+            return not_found
+        lookup_seconds = time.time() - started
+        version = entry.version if entry is not None else None
+        if network_id is None:
+            return self.app
+        decide = functools.partial(self._decide_detach, vif_uuid)
+
+        msg = ""
+        if network_id in self.required_networks:
+            self.log.info("attempt to detach required network")
+            msg = "Network (%s) cannot be detached" % ",".join(
+                self.required_networks)
+            self._record_rejection(context, 'required', [network_id])
+        self._audit('detach', context, msg, server=server_uuid,
+                    vif=vif_uuid, networks=[network_id])
+        self._capture(capture.DETACH, req, context, msg, [network_id],
+                      server=server_uuid, vif=vif_uuid,
+                      server_vifs=len(entry.vifs) if entry else 0,
+                      lookup_seconds=lookup_seconds)
+        self._shadow_verify('detach', context, server_uuid, entry, msg,
+                            decide, started, ignore_vifs=[vif_uuid])
+        if self._enforce(msg):
+            return webob.exc.HTTPForbidden(msg)
+
+        if version is not None:
+            return self._forward(req, functools.partial(
+                self._apply_detach, projectid, server_uuid, vif_uuid,
+                version))
         return self.app
 
 
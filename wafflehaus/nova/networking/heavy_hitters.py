@@ -0,0 +1,191 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""Bounded-memory statistics of which projects and networks get rejected.
+
+Counts go into a count-min sketch of fixed width and depth, and only the k
+keys with the highest estimates are kept by name, so memory does not grow
+with the number of tenants or networks. Sketches cover a time window and
+are rotated, keeping the previous window for reporting.
+"""
+import array
+import threading
+import time
+
+_GOLDEN = 0x9e3779b97f4a7c15
+_MASK64 = 0xffffffffffffffff
+
+_rejection_stats = None
+_rejection_stats_lock = threading.Lock()
+
+
+class CountMinSketch(object):
+    """Approximate counts that never underestimate."""
+
+    def __init__(self, width=2048, depth=4):
+        self.width = width
+        self.depth = depth
+        self._zeros = array.array('l', [0]) * width
+        self.rows = [array.array('l', self._zeros) for _ in range(depth)]
+        self.total = 0
+
+    @staticmethod
+    def _hashes(key):
+        # Double hashing from the two halves of one mixed 64-bit hash. The
+        # multiply spreads every bit of hash(key) into both halves, so keys
+        # agreeing in their low bits do not collide in every row.
+        mixed = (hash(key) * _GOLDEN) & _MASK64
+        mixed ^= mixed >> 29
+        return mixed & 0xffffffff, (mixed >> 32) | 1
+
+    def _indexes(self, key):
+        h1, h2 = self._hashes(key)
+        width = self.width
+        return [(h1 + i * h2) % width for i in range(self.depth)]
+
+    def add(self, key, count=1):
+        """Counts key and returns its new estimate."""
+        self.total += count
+        h1, h2 = self._hashes(key)
+        width = self.width
+        estimate = None
+        for row in self.rows:
+            index = h1 % width
+            value = row[index] + count
+            row[index] = value
+            if estimate is None or value < estimate:
+                estimate = value
+            h1 += h2
+        return estimate
+
+    def estimate(self, key):
+        return min(row[index]
+                   for row, index in zip(self.rows, self._indexes(key)))
+
+    def clear(self):
+        for row in self.rows:
+            row[:] = self._zeros
+        self.total = 0
+
+
+class HeavyHitters(object):
+    """The k keys with the highest count-min estimates."""
+
+    def __init__(self, k=20, width=2048, depth=4):
+        self.k = k
+        self.sketch = CountMinSketch(width, depth)
+        self.top = {}
+        # A lower bound of the smallest estimate in top, so most keys that
+        # are not heavy hitters are turned away without scanning top.
+        self._floor = 0
+
+    def add(self, key, count=1):
+        estimate = self.sketch.add(key, count)
+        top = self.top
+        if key in top or len(top) < self.k:
+            top[key] = estimate
+            return
+        if estimate <= self._floor:
+            return
+        smallest = min(top, key=top.get)
+        self._floor = top[smallest]
+        if estimate > self._floor:
+            del top[smallest]
+            top[key] = estimate
+            self._floor = min(top.values())
+
+    def items(self):
+        return sorted(self.top.items(), key=lambda item: (-item[1], item[0]))
+
+    def clear(self):
+        self.sketch.clear()
+        self.top.clear()
+        self._floor = 0
+
+
+class WindowedHeavyHitters(object):
+    """Heavy hitters for the current and the previous time window."""
+
+    def __init__(self, window=300, k=20, width=2048, depth=4,
+                 clock=time.time):
+        self.window = window
+        self.clock = clock
+        self.current = HeavyHitters(k, width, depth)
+        self.previous = HeavyHitters(k, width, depth)
+        self.window_start = clock()
+        self.previous_start = None
+
+    def _rotate(self, now):
+        elapsed = now - self.window_start
+        if elapsed < self.window:
+            return
+        # Swap and clear rather than allocate, so a rotation costs no memory
+        self.previous, self.current = self.current, self.previous
+        self.current.clear()
+        self.previous_start = self.window_start
+        if elapsed >= 2 * self.window:
+            self.previous.clear()
+            self.previous_start = now - self.window
+        self.window_start = now
+
+    def add(self, key, count=1):
+        self._rotate(self.clock())
+        self.current.add(key, count)
+
+    def report(self):
+        self._rotate(self.clock())
+        return {'window_start': self.window_start,
+                'total': self.current.sketch.total,
+                'top': self.current.items(),
+                'previous_window_start': self.previous_start,
+                'previous_total': self.previous.sketch.total,
+                'previous_top': self.previous.items()}
+
+
+class RejectionStats(object):
+    """Heavy hitters of rejected requests by project, network and rule."""
+
+    DIMENSIONS = ('project', 'network', 'rule')
+
+    def __init__(self, window=300, k=20, width=2048, depth=4,
+                 clock=time.time):
+        self._lock = threading.Lock()
+        self.trackers = dict(
+            (dim, WindowedHeavyHitters(window, k, width, depth, clock))
+            for dim in self.DIMENSIONS)
+
+    @classmethod
+    def from_conf(cls, conf):
+        """Returns the process-wide RejectionStats, creating it from conf."""
+        global _rejection_stats
+        with _rejection_stats_lock:
+            if _rejection_stats is None:
+                _rejection_stats = cls(
+                    window=float(conf.get('rejection_stats_window', 300)),
+                    k=int(conf.get('rejection_stats_top', 20)),
+                    width=int(conf.get('rejection_stats_width', 2048)),
+                    depth=int(conf.get('rejection_stats_depth', 4)))
+        return _rejection_stats
+
+    def record(self, project, rule, networks=()):
+        with self._lock:
+            self.trackers['project'].add(project)
+            self.trackers['rule'].add(rule)
+            for network in networks or ():
+                self.trackers['network'].add(network)
+
+    def report(self):
+        with self._lock:
+            return dict((dim, tracker.report())
+                        for dim, tracker in self.trackers.items())
@@ -0,0 +1,390 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""Incrementally maintained network state of servers.
+
+An entry is seeded from one instance lookup and then kept current by the
+attach and detach requests the waffles approve and nova accepts, so later
+checks on the same server do not need to look it up again. Every update
+bumps the entry's version; an update computed from an older version than
+the entry now holds is not applied and the entry is dropped instead, to be
+re-seeded. Entries older than refresh_interval are looked up again and
+compared, which detects and repairs divergence from nova.
+
+With instance_cache_snapshot set, entries are saved to that file every
+instance_cache_snapshot_interval seconds and at exit, and loaded again when
+the cache is created, so a restarted nova-api starts warm.
+
+Server, VIF and network IDs are held packed (see wafflehaus.nova.ids);
+methods take them in either form.
+"""
+import atexit
+import logging
+import os
+import threading
+import time
+
+from wafflehaus.nova import cache
+from wafflehaus.nova import ids
+from wafflehaus.nova import memory_budget
+from wafflehaus.nova.networking import cache_snapshot
+
+LOG = logging.getLogger(__name__)
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def get_vif_networks(instance):
+    """Returns the packed {vif id: network id} of an instance."""
+    from nova.compute import utils as compute_utils
+
+    nw_info = compute_utils.get_nw_info_for_instance(instance)
+    return dict((ids.pack(vif["id"]), ids.pack_network(vif["network"]["id"]))
+                for vif in nw_info)
+
+
+def get_instance_facts(instance):
+    """Returns the flavor and image policy rule conditions can test."""
+    flavor = getattr(instance, 'flavor', None)
+    return {'flavor': getattr(flavor, 'flavorid', None),
+            'image': getattr(instance, 'image_ref', None) or None}
+
+
+class ServerNetworks(object):
+    """Known VIFs of a server, plus approved attaches without a VIF id."""
+    __slots__ = ('vifs', 'pending', 'version', 'seeded_at', 'facts',
+                 'restored', 'prefetched')
+
+    def __init__(self, vifs, seeded_at, version=0, facts=None):
+        self.vifs = ids.pack_vifs(vifs)
+        self.facts = facts
+        self.restored = False
+        self.prefetched = False
+        self.pending = []
+        self.version = version
+        self.seeded_at = seeded_at
+
+    def networks(self):
+        networks = set(self.vifs.values())
+        networks.update(self.pending)
+        return networks
+
+
+class InstanceNetworkCache(object):
+    """Per (project, server) network state shared by the networking waffles.
+    """
+
+    def __init__(self, max_entries=10000, ttl=3600, refresh_interval=300,
+                 clock=time.time, budget=None):
+        self.clock = clock
+        self.refresh_interval = refresh_interval
+        self.entries = cache.TTLCache('instance_networks', max_entries, ttl,
+                                      clock, budget=budget)
+        self.seeds = 0
+        self.refreshes = 0
+        self.divergences = 0
+        self.updates = 0
+        self.conflicts = 0
+        self.lookup_seconds = 0.0
+        self.snapshot_path = None
+        self.snapshot_interval = 0
+        self.snapshot_stats = {}
+        self.restored_hits = 0
+        self.prefetches = 0
+        self.prefetch_hits = 0
+        self._restored_lookup_mean = 0.0
+        self._dirty = False
+        self._pid = None
+        self._snapshotter = None
+        self._stop = threading.Event()
+        self._snapshot_lock = threading.Lock()
+
+    @classmethod
+    def from_conf(cls, conf):
+        """Returns the process-wide cache if instance_cache_ttl is set."""
+        global _shared
+        ttl = float(conf.get('instance_cache_ttl', 0))
+        if ttl <= 0:
+            return None
+        with _shared_lock:
+            if _shared is None:
+                _shared = cls(
+                    max_entries=int(conf.get('instance_cache_size', 10000)),
+                    ttl=ttl,
+                    refresh_interval=float(conf.get(
+                        'instance_cache_refresh', 300)),
+                    budget=memory_budget.MemoryBudget.from_conf(conf))
+                path = conf.get('instance_cache_snapshot')
+                if path:
+                    _shared.snapshot_path = path
+                    _shared.snapshot_interval = float(conf.get(
+                        'instance_cache_snapshot_interval', 300))
+                    _shared.load_snapshot()
+                    atexit.register(_shared.close)
+        return _shared
+
+    def get(self, project_id, server_id):
+        """Returns the fresh entry for a server, or None to look it up."""
+        if self.snapshot_path and self.snapshot_interval > 0:
+            self._ensure_snapshotter()
+        entry = self.entries.get((project_id, ids.pack(server_id)))
+        if entry is None:
+            return None
+        if self.clock() - entry.seeded_at >= self.refresh_interval:
+            return None
+        if entry.restored:
+            entry.restored = False
+            self.restored_hits += 1
+        if entry.prefetched:
+            entry.prefetched = False
+            self.prefetch_hits += 1
+        return entry
+
+    def seed(self, project_id, server_id, vifs, facts=None,
+             lookup_seconds=None):
+        """Stores looked up VIFs, counting divergence from what was held.
+
+        lookup_seconds is how long the lookup took, to estimate the time
+        saved by restored entries.
+        """
+        key = (project_id, ids.pack(server_id))
+        vifs = ids.pack_vifs(vifs)
+        self._dirty = True
+        if lookup_seconds is not None:
+            self.lookup_seconds += lookup_seconds
+        previous = self.entries.pop(key)
+        version = 0
+        if previous is not None:
+            self.refreshes += 1
+            version = previous.version + 1
+            if previous.networks() != set(vifs.values()):
+                self.divergences += 1
+        else:
+            self.seeds += 1
+        entry = ServerNetworks(vifs, self.clock(), version, facts)
+        self.entries.set(key, entry)
+        return entry
+
+    def prefetch(self, project_id, server_id, vifs):
+        """Stores the VIFs nova listed for a server ahead of a check.
+
+        A fresh entry holding the same VIFs is kept as it is; otherwise the
+        entry is seeded again, keeping the facts already known. Returns
+        whether an entry was stored.
+        """
+        vifs = ids.pack_vifs(vifs)
+        held = self.entries.get((project_id, ids.pack(server_id)))
+        facts = None
+        if held is not None:
+            if (held.vifs == vifs and not held.pending and
+                    self.clock() - held.seeded_at < self.refresh_interval):
+                return False
+            facts = held.facts
+        entry = self.seed(project_id, server_id, vifs, facts)
+        entry.prefetched = True
+        self.prefetches += 1
+        return True
+
+    def _update(self, project_id, server_id, version):
+        entry = self.entries.get((project_id, ids.pack(server_id)))
+        if entry is None:
+            return None
+        if version is not None and entry.version != version:
+            self.conflicts += 1
+            self.invalidate(project_id, server_id)
+            return None
+        entry.version += 1
+        self.updates += 1
+        self._dirty = True
+        return entry
+
+    def apply_attach(self, project_id, server_id, network_id, vif_id=None,
+                     version=None):
+        """Records an attach nova accepted; False if the entry was stale."""
+        entry = self._update(project_id, server_id, version)
+        if entry is None:
+            return False
+        network_id = ids.pack_network(network_id)
+        if vif_id:
+            entry.vifs[ids.pack(vif_id)] = network_id
+        else:
+            entry.pending.append(network_id)
+        return True
+
+    def apply_detach(self, project_id, server_id, vif_id, version=None):
+        """Records a detach nova accepted; False if the entry was stale."""
+        entry = self._update(project_id, server_id, version)
+        if entry is None:
+            return False
+        if entry.vifs.pop(ids.pack(vif_id), None) is None:
+            # A VIF from an attach whose id we never learned; start over
+            self.invalidate(project_id, server_id)
+            return False
+        return True
+
+    def invalidate(self, project_id, server_id):
+        server_id = ids.pack(server_id)
+        if project_id:
+            self.entries.pop((project_id, server_id))
+        else:
+            self.entries.pop_matching(lambda key: key[1] == server_id)
+
+    def on_notification(self, event_type, project_id, server_id):
+        """Drops entries whose server changed outside of the waffles."""
+        self.invalidate(project_id, server_id)
+
+    def _lookup_mean(self):
+        lookups = self.seeds + self.refreshes
+        if self.lookup_seconds and lookups:
+            return self.lookup_seconds / lookups
+        return self._restored_lookup_mean
+
+    def _records(self):
+        now = self.clock()
+        # Snapshots keep IDs as strings, whatever the in-memory form
+        return [[key[0], ids.unpack(key[1]), expires, entry.seeded_at,
+                 ids.unpack_vifs(entry.vifs),
+                 [ids.unpack(net) for net in entry.pending], entry.facts]
+                for key, entry, expires in self.entries.items()
+                if now - entry.seeded_at < self.refresh_interval]
+
+    def _live(self, records):
+        """Drops records past their TTL or due for a refresh."""
+        now = self.clock()
+        live = []
+        expired = stale = 0
+        for record in records:
+            if record[2] <= now:
+                expired += 1
+            elif now - record[3] >= self.refresh_interval:
+                stale += 1
+            else:
+                live.append(record)
+        return live, expired, stale
+
+    def load_snapshot(self):
+        """Restores entries from the snapshot file; returns how many."""
+        start = time.time()
+        snapshot = cache_snapshot.load(self.snapshot_path)
+        if snapshot is None:
+            return 0
+        records, expired, stale = self._live(snapshot.records)
+        # Oldest first, so the LRU keeps the most recently seeded entries
+        records.sort(key=lambda record: record[3])
+        now = self.clock()
+        for project, server, expires, seeded_at, vifs, pending, facts in (
+                records):
+            entry = ServerNetworks(vifs, seeded_at, facts=facts)
+            entry.pending = [ids.pack_network(net) for net in pending]
+            entry.restored = True
+            self.entries.set((project, ids.pack(server)), entry,
+                             min(expires - now, self.entries.ttl))
+        self._restored_lookup_mean = snapshot.lookup_seconds
+        load_ms = (time.time() - start) * 1000.0
+        self.snapshot_stats.update(
+            restored=len(records), expired=expired, stale=stale,
+            load_ms=load_ms, age=now - snapshot.created,
+            refill_ms=len(records) * snapshot.lookup_seconds * 1000.0)
+        LOG.info('Restored %d instance network entries from %s in %.1f ms '
+                 '(%d expired, %d due for refresh); refilling them would '
+                 'take about %.1f ms of lookups', len(records),
+                 self.snapshot_path, load_ms, expired, stale,
+                 self.snapshot_stats['refill_ms'])
+        return len(records)
+
+    def save_snapshot(self):
+        """Writes the entries, merged with other workers', to the snapshot.
+
+        Only processes that changed the cache write, so a nova-api parent
+        that never served a request does not overwrite its workers.
+        """
+        if not self.snapshot_path or not self._dirty:
+            return False
+        with self._snapshot_lock:
+            self._dirty = False
+            records = self._records()
+            with cache_snapshot.SnapshotLock(self.snapshot_path):
+                merged = {}
+                snapshot = cache_snapshot.load(self.snapshot_path)
+                if snapshot is not None:
+                    for record in self._live(snapshot.records)[0]:
+                        merged[(record[0], record[1])] = record
+                for record in records:
+                    other = merged.get((record[0], record[1]))
+                    if other is None or other[3] <= record[3]:
+                        merged[(record[0], record[1])] = record
+                records = sorted(merged.values(), key=lambda r: r[3])
+                records = records[-self.entries.max_entries:]
+                size = cache_snapshot.dump(self.snapshot_path, records,
+                                           self._lookup_mean())
+        self.snapshot_stats.update(saved=len(records), bytes=size,
+                                   saved_at=time.time())
+        return True
+
+    def _ensure_snapshotter(self):
+        # Threads do not survive nova forking its workers, so each process
+        # starts its own, like the audit log writer.
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._snapshot_lock:
+            if self._pid == pid:
+                return
+            self._pid = pid
+            self._snapshotter = threading.Thread(
+                target=self._run, name='wafflehaus-snapshot')
+            self._snapshotter.daemon = True
+            self._snapshotter.start()
+
+    def _run(self):
+        while not self._stop.wait(self.snapshot_interval):
+            try:
+                self.save_snapshot()
+            except Exception:
+                LOG.exception('Unable to write snapshot %s',
+                              self.snapshot_path)
+
+    def close(self):
+        """Stops the periodic snapshots and writes a final one."""
+        self._stop.set()
+        try:
+            self.save_snapshot()
+        except Exception:
+            LOG.exception('Unable to write snapshot %s', self.snapshot_path)
+
+    def stats(self):
+        stats = self.entries.stats()
+        stats.update(seeds=self.seeds, refreshes=self.refreshes,
+                     divergences=self.divergences, updates=self.updates,
+                     conflicts=self.conflicts)
+        if self.snapshot_path:
+            snapshot = dict(self.snapshot_stats)
+            snapshot.update(
+                restored_hits=self.restored_hits,
+                saved_ms=self.restored_hits * self._lookup_mean() * 1000.0)
+            stats['snapshot'] = snapshot
+        if self.prefetches:
+            now = self.clock()
+            # Prefetched entries not used yet may still be; the others
+            # were replaced, refreshed, evicted or expired unused
+            waiting = len([entry for _, entry, _ in self.entries.items()
+                           if entry.prefetched and
+                           now - entry.seeded_at < self.refresh_interval])
+            stats['prefetch'] = {
+                'prefetches': self.prefetches, 'hits': self.prefetch_hits,
+                'hit_rate': self.prefetch_hits / float(self.prefetches),
+                'waiting': waiting,
+                'wasted': self.prefetches - self.prefetch_hits - waiting}
+        return stats
@@ -0,0 +1,384 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""A local catalog of networks: who owns them and who may use them.
+
+A background thread lists the networks of the networking API into an index
+of network id -> (owner, shared, class), so boot and attach checks can
+refuse networks that do not exist or belong to another project with a dict
+lookup. After the first, full, sync only networks changed since the last
+change marker are listed; deletions do not show up that way, so the whole
+catalog is listed again every network_catalog_full_sync seconds. A network
+missing from the catalog may just be newer than the last sync, so it is
+looked up on its own before a request is refused for it, and one that is
+not found is remembered for network_catalog_missing_ttl seconds.
+
+Networks shared with some projects through access_as_shared RBAC policies
+are not shared to the admin client listing them, so the policies are listed
+with every sync into an index of network id -> target projects. A network
+that still looks foreign is looked up as the requesting project before the
+request is refused, since the project may see it in ways the catalog does
+not know of.
+
+The network API is loaded from network_catalog_api, so a deployment or a
+test can use something other than nova's neutron client; FakeNetworkAPI
+serves networks given in the configuration.
+"""
+import logging
+import os
+import threading
+import time
+
+from wafflehaus.nova import cache
+from wafflehaus.nova import ids
+from wafflehaus.nova import memory_budget
+
+LOG = logging.getLogger(__name__)
+
+_FIELDS = ['id', 'tenant_id', 'project_id', 'shared', 'updated_at']
+_RBAC_FIELDS = ['object_id', 'target_tenant']
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+class NeutronNetworkAPI(object):
+    """Lists networks with nova's neutron client and an admin context."""
+
+    def __init__(self, conf):
+        self.conf = conf
+        self.class_field = conf.get('network_catalog_class_field')
+
+    def _get_neutron(self):
+        try:
+            from nova.network import neutron
+        except ImportError:
+            from nova.network.neutronv2 import api as neutron
+        return neutron
+
+    def _get_client(self):
+        from nova import context as nova_context
+        return self._get_neutron().get_client(
+            nova_context.get_admin_context(), admin=True)
+
+    def _fields(self):
+        if self.class_field:
+            return _FIELDS + [self.class_field]
+        return _FIELDS
+
+    def _entry(self, network):
+        owner = network.get('project_id') or network.get('tenant_id')
+        kind = network.get(self.class_field) if self.class_field else None
+        return network['id'], owner, bool(network.get('shared')), kind
+
+    def list_networks(self, changed_since=None):
+        """Returns ([(id, owner, shared, class)], change marker)."""
+        filters = {'fields': self._fields()}
+        if changed_since is not None:
+            filters['changed_since'] = changed_since
+        networks = self._get_client().list_networks(**filters)['networks']
+        marker = max([n.get('updated_at') or '' for n in networks] or [''])
+        return [self._entry(n) for n in networks], marker or changed_since
+
+    def get_network(self, network_id):
+        """Returns (id, owner, shared, class), or None if there is none."""
+        networks = self._get_client().list_networks(
+            id=network_id, fields=self._fields())['networks']
+        if not networks:
+            return None
+        return self._entry(networks[0])
+
+    def list_shared(self):
+        """Returns [(network id, project)] of access_as_shared policies.
+
+        The project is '*' for networks shared with every project.
+        """
+        policies = self._get_client().list_rbac_policies(
+            object_type='network', action='access_as_shared',
+            fields=_RBAC_FIELDS)['rbac_policies']
+        return [(p['object_id'], p['target_tenant']) for p in policies]
+
+    def visible(self, context, network_id):
+        """Returns whether the project of context can see the network."""
+        networks = self._get_neutron().get_client(context).list_networks(
+            id=network_id, fields=['id'])['networks']
+        return bool(networks)
+
+
+class FakeNetworkAPI(object):
+    """A network API serving fake_networks = ID:OWNER[:shared][:CLASS] ...
+
+    fake_rbac = ID:PROJECT ... shares networks with projects as RBAC
+    policies would. Networks can also be added, changed and deleted, each
+    bumping a change counter that serves as the change marker.
+    """
+
+    def __init__(self, conf=None):
+        self.networks = {}
+        self.changed = {}
+        self.rbac = []
+        self.counter = 0
+        self.calls = []
+        self.error = None
+        for spec in (conf or {}).get('fake_networks', '').split():
+            parts = spec.split(':')
+            self.set(parts[0], parts[1], 'shared' in parts[2:],
+                     next((p for p in parts[2:] if p != 'shared'), None))
+        for spec in (conf or {}).get('fake_rbac', '').split():
+            self.rbac.append(tuple(spec.split(':', 1)))
+
+    def set(self, network_id, owner, shared=False, kind=None):
+        self.counter += 1
+        self.networks[network_id] = (network_id, owner, shared, kind)
+        self.changed[network_id] = self.counter
+
+    def delete(self, network_id):
+        self.networks.pop(network_id, None)
+        self.changed.pop(network_id, None)
+
+    def list_networks(self, changed_since=None):
+        self.calls.append(('list', changed_since))
+        if self.error is not None:
+            raise self.error
+        since = changed_since or 0
+        return ([network for network_id, network in self.networks.items()
+                 if self.changed[network_id] >= since], self.counter)
+
+    def get_network(self, network_id):
+        self.calls.append(('get', network_id))
+        if self.error is not None:
+            raise self.error
+        return self.networks.get(network_id)
+
+    def list_shared(self):
+        self.calls.append(('rbac', None))
+        if self.error is not None:
+            raise self.error
+        return list(self.rbac)
+
+    def visible(self, context, network_id):
+        self.calls.append(('visible', network_id))
+        if self.error is not None:
+            raise self.error
+        network = self.networks.get(network_id)
+        if network is None:
+            return False
+        project_id = context.project_id
+        return (network[2] or network[1] == project_id or
+                (network_id, project_id) in self.rbac or
+                (network_id, '*') in self.rbac)
+
+
+def load_network_api(conf):
+    """Returns the API named by network_catalog_api, or the neutron one."""
+    path = conf.get('network_catalog_api')
+    if not path:
+        return NeutronNetworkAPI(conf)
+    from oslo_utils import importutils
+    return importutils.import_object(path, conf)
+
+
+class NetworkCatalog(object):
+    """Network ownership, synced from the network API in the background."""
+
+    def __init__(self, network_api, interval=60, full_interval=3600,
+                 missing_ttl=10, clock=time.time, budget=None):
+        self.network_api = network_api
+        self.interval = interval
+        self.full_interval = full_interval
+        self.clock = clock
+        # packed network id -> (owner, shared, class); replaced whole on a
+        # full sync, updated in place otherwise
+        self.index = {}
+        # packed network id -> frozenset of projects, '*' for all of them
+        self.shared_with = {}
+        # Networks not found, and (project, network) visibility, looked up
+        # on their own
+        self.lookups = cache.TTLCache('network_catalog_lookups', 10000,
+                                      missing_ttl, clock=clock,
+                                      budget=budget)
+        self.marker = None
+        self.synced_at = None
+        self.full_synced_at = None
+        self.syncs = 0
+        self.full_syncs = 0
+        self.errors = 0
+        self.fetched = 0
+        self.unknown = 0
+        self.foreign = 0
+        self.visible_lookups = 0
+        self._pid = None
+        self._worker = None
+        self._stop = threading.Event()
+        self._sync_lock = threading.Lock()
+
+    @classmethod
+    def from_conf(cls, conf):
+        """Returns the process-wide catalog, created on first use."""
+        global _shared
+        with _shared_lock:
+            if _shared is None:
+                _shared = cls(
+                    load_network_api(conf),
+                    interval=float(conf.get('network_catalog_interval', 60)),
+                    full_interval=float(conf.get(
+                        'network_catalog_full_sync', 3600)),
+                    missing_ttl=float(conf.get(
+                        'network_catalog_missing_ttl', 10)),
+                    budget=memory_budget.MemoryBudget.from_conf(conf))
+        return _shared
+
+    @property
+    def ready(self):
+        return self.full_synced_at is not None
+
+    def sync(self):
+        """Lists networks changed since the last sync, or all of them."""
+        with self._sync_lock:
+            now = self.clock()
+            full = (self.full_synced_at is None or
+                    now - self.full_synced_at >= self.full_interval)
+            networks, marker = self.network_api.list_networks(
+                None if full else self.marker)
+            index = {} if full else self.index
+            for network_id, owner, shared, kind in networks:
+                index[ids.pack_network(network_id)] = (owner, shared, kind)
+            shared_with = {}
+            for network_id, project_id in self.network_api.list_shared():
+                key = ids.pack_network(network_id)
+                shared_with.setdefault(key, set()).add(project_id)
+            self.shared_with = dict((key, frozenset(projects))
+                                    for key, projects in shared_with.items())
+            if full:
+                self.index = index
+                self.full_synced_at = now
+                self.full_syncs += 1
+            self.marker = marker
+            self.synced_at = now
+            self.syncs += 1
+        return full
+
+    def _ensure_worker(self):
+        # Threads do not survive nova forking its API workers
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._sync_lock:
+            if self._pid == pid:
+                return
+            self._pid = pid
+            self._worker = threading.Thread(target=self._run,
+                                            name='wafflehaus-catalog')
+            self._worker.daemon = True
+            self._worker.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.sync()
+            except Exception:
+                self.errors += 1
+                LOG.exception('Unable to sync the network catalog')
+            if self._stop.wait(self.interval):
+                return
+
+    def stop(self):
+        self._stop.set()
+
+    def _get(self, network_id):
+        """Returns the catalog entry of a network, fetching a missing one."""
+        key = ids.pack_network(network_id)
+        entry = self.index.get(key)
+        if entry is not None:
+            return entry
+        if self.lookups.get(key) is not None:
+            return False
+        self.fetched += 1
+        try:
+            network = self.network_api.get_network(network_id)
+        except Exception:
+            LOG.exception('Unable to look up network %s', network_id)
+            self.errors += 1
+            return None
+        if network is None:
+            self.lookups.set(key, True)
+            return False
+        _, owner, shared, kind = network
+        entry = self.index[key] = (owner, shared, kind)
+        return entry
+
+    def _visible(self, context, network_id, project_id):
+        """Returns whether the project sees the network, None if unknown."""
+        key = (project_id, ids.pack_network(network_id))
+        visible = self.lookups.get(key)
+        if visible is not None:
+            return visible
+        self.visible_lookups += 1
+        try:
+            visible = bool(self.network_api.visible(context, network_id))
+        except Exception:
+            LOG.exception('Unable to look up network %s for project %s',
+                          network_id, project_id)
+            self.errors += 1
+            return None
+        self.lookups.set(key, visible)
+        return visible
+
+    def check(self, context, networks):
+        """Returns why a network of networks cannot be used, or "".
+
+        Networks are usable by their owner, by everyone if shared, and by
+        the projects RBAC policies share them with; admins may use any
+        network that exists. A network that still looks foreign is only
+        refused if a lookup as the project does not find it. Until the
+        first full sync, and for networks that cannot be looked up, nothing
+        is refused.
+        """
+        self._ensure_worker()
+        if not self.ready:
+            return ""
+        project_id = getattr(context, 'project_id', None)
+        is_admin = getattr(context, 'is_admin', False)
+        for network_id in sorted(networks):
+            entry = self._get(network_id)
+            if entry is None:
+                continue
+            if entry is False:
+                self.unknown += 1
+                return "Network %s could not be found" % network_id
+            owner, shared = entry[0], entry[1]
+            if shared or is_admin or owner == project_id:
+                continue
+            projects = self.shared_with.get(ids.pack_network(network_id), ())
+            if project_id in projects or '*' in projects:
+                continue
+            if self._visible(context, network_id, project_id) is False:
+                self.foreign += 1
+                return ("Network %s is not available to project %s" %
+                        (network_id, project_id))
+        return ""
+
+    def stats(self):
+        now = self.clock()
+        classes = {}
+        for owner, shared, kind in list(self.index.values()):
+            if kind is not None:
+                classes[kind] = classes.get(kind, 0) + 1
+        return {'networks': len(self.index), 'classes': classes,
+                'rbac_shared': len(self.shared_with),
+                'visible_lookups': self.visible_lookups,
+                'syncs': self.syncs, 'full_syncs': self.full_syncs,
+                'errors': self.errors, 'fetched': self.fetched,
+                'unknown': self.unknown, 'foreign': self.foreign,
+                'age': now - self.synced_at if self.synced_at else None}
@@ -12,69 +12,112 @@
 #    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 #    License for the specific language governing permissions and limitations
 #    under the License.
+import functools
+import io
+import time
+
 import webob.dec
 from webob import exc
 
+from wafflehaus.nova import alloc_trace
+from wafflehaus.nova.networking import candidates
+from wafflehaus.nova.networking import capture
+from wafflehaus.nova.networking import instance_networks
+from wafflehaus.nova.networking import network_catalog
+from wafflehaus.nova.networking import network_policy
 from wafflehaus.nova.networking import networking_base as net_base
+from wafflehaus.nova.networking import policy_rules
+from wafflehaus.nova.networking import port_networks
 
-from oslo_serialization import jsonutils
 from oslo_utils import uuidutils
 
-from nova.compute import utils as compute_utils
-
-
-def _get_body(request, json_property):
-    """Returns body serialized from JSON."""
-    body = jsonutils.loads(request.body)
+# Same as nova's own osapi_max_request_body_size; nova refuses larger bodies
+DEFAULT_MAX_INSPECT_BYTES = 114688
+_READ_CHUNK_BYTES = 65536
+
+
+def _is_chunked(request):
+    encoding = request.environ.get('HTTP_TRANSFER_ENCODING', '')
+    return 'chunked' in encoding.lower()
+
+
+def _has_body(request):
+    return bool(request.content_length) or _is_chunked(request)
+
+
+def _too_large(max_bytes):
+    msg = "Request body is larger than %i bytes" % max_bytes
+    return exc.HTTPRequestEntityTooLarge(explanation=msg)
+
+
+def _read_body(request, max_bytes):
+    """Returns the body, reading at most max_bytes + 1 bytes of it.
+
+    Raises HTTPRequestEntityTooLarge as soon as the body is known to be too
+    big, which for a Content-Length is before anything is read. The buffer
+    the body was read into becomes wsgi.input, rewound, so nova reads the
+    same bytes rather than the socket.
+    """
+    length = request.content_length
+    if length is not None and length > max_bytes:
+        raise _too_large(max_bytes)
+    if request.is_body_seekable:
+        return request.body
+    if not _has_body(request):
+        return b''
+
+    stream = request.body_file_raw
+    buf = io.BytesIO()
+    remaining = length if length is not None else max_bytes + 1
+    while remaining > 0:
+        chunk = stream.read(min(remaining, _READ_CHUNK_BYTES))
+        if not chunk:
+            break
+        buf.write(chunk)
+        remaining -= len(chunk)
+    size = buf.tell()
+    if size > max_bytes:
+        raise _too_large(max_bytes)
+
+    buf.seek(0)
+    request.environ['wsgi.input'] = buf
+    request.environ.pop('HTTP_TRANSFER_ENCODING', None)
+    request.content_length = size
+    request.is_body_seekable = True
+    return buf.getvalue()
+
+
+def _get_body(request, json_property,
+              max_bytes=DEFAULT_MAX_INSPECT_BYTES):
+    """Returns body serialized from JSON, or None if there is no body."""
+    from oslo_serialization import jsonutils
+
+    data = _read_body(request, max_bytes)
+    if not data:
+        return None
+    body = jsonutils.loads(data)
     body = body[json_property]
     return body
 
 
 def check_required_networks(networks, required_networks):
     """Verifies required networks are present."""
-    if required_networks:
-        msg = "Networks (%s) required but missing"
-        msg_networks = ",".join(required_networks)
-        if required_networks.intersection(networks) != required_networks:
-            return msg % msg_networks
-    return ""
+    policy = network_policy.NetworkPolicy(required=required_networks)
+    return policy.check_required(networks)
 
 
 def check_banned_networks(networks, banned_networks):
     """Verifies banned networks are not present."""
-    if banned_networks:
-        msg = "Networks (%s) not allowed"
-        msg_networks = ",".join(banned_networks)
-        if banned_networks.intersection(networks) != set():
-            return msg % msg_networks
-    return ""
+    policy = network_policy.NetworkPolicy(banned=banned_networks)
+    return policy.check_banned(networks)
 
 
 def check_network_count(networks, min_nets, max_nets, existing_nets,
                         optional_nets, count_optional_nets):
     """Verifies correct number of isolated networks."""
-    if not min_nets:
-        msg = "At most %i isolated network(s) can be attached"
-        msg_network_count = (max_nets)
-    elif min_nets == max_nets:
-        msg = "Exactly %i isolated network(s) must be attached"
-        msg_network_count = (min_nets)
-    else:
-        msg = "Only %i to %i isolated network(s) can be attached"
-        msg_network_count = (min_nets, max_nets)
-
-    if existing_nets:
-        isolated_nets = networks | existing_nets
-    else:
-        isolated_nets = networks
-
-    if not count_optional_nets:
-        isolated_nets = isolated_nets - optional_nets
-
-    if ((min_nets and len(isolated_nets) < min_nets) or
-            len(isolated_nets) > max_nets):
-        return msg % msg_network_count
-    return ""
+    policy = network_policy.NetworkPolicy(optional=optional_nets,
+                                          count_optional=count_optional_nets)
+    return policy.check_count(networks, existing_nets, min_nets, max_nets)
 
 
 class NetworkCountConfig(object):
@@ -94,13 +137,38 @@ class NetworkCountConfig(object):
             "count_optional_nets", False))
         self.strict_boot_check = bool(local_config.get(
             "strict_boot_check", False))
+        self.max_inspect_bytes = int(local_config.get(
+            "max_inspect_bytes", DEFAULT_MAX_INSPECT_BYTES))
+        self.policy = network_policy.NetworkPolicy.from_config(
+            local_config, self.required_networks, self.banned_networks,
+            self.optional_networks, self.networks_min, self.networks_max,
+            self.count_optional_nets)
+        self.candidates = candidates.CandidatePolicies.from_conf(
+            local_config, lambda conf: NetworkCountConfig(conf).policy)
+
+    def needs_instance_facts(self):
+        """Whether the active or a candidate policy tests flavor or image."""
+        policies = [self.policy]
+        if self.candidates is not None:
+            policies.extend(policy for _, policy in self.candidates.policies)
+        for policy in policies:
+            if policy.rules and policy.rules.needs_instance_facts():
+                return True
+        return False
 
 
 class BootNetworkCountCheck(object):
     """Verifies networks on server boot."""
-    def __init__(self, check_config, log):
+    def __init__(self, check_config, log, resolve_ports=None, catalog=None):
         self.check_config = check_config
         self.log = log
+        self.resolve_ports = resolve_ports
+        self.catalog = catalog
+        self.body = None
+        self.networks = None
+        self.requested = None
+        self.facts = None
+        self.rule = None
 
     @staticmethod
     def _is_server_boot_request(pathparts, req, projectid):
@@ -109,9 +177,7 @@ class BootNetworkCountCheck(object):
         bootcheck = set([projectid, "servers"])
         if pathparts != bootcheck:
             return False
-        if not req.body or len(req.body) == 0:
-            return False
-        return True
+        return _has_body(req)
 
     @staticmethod
     def _get_networks(body):
@@ -121,44 +187,78 @@ class BootNetworkCountCheck(object):
             return None
         return [n["uuid"] for n in networks if "uuid" in n]
 
-    def _get_networks_from_request(self, req):
+    @staticmethod
+    def _get_ports(body):
+        """Extract ports given without a network from body."""
+        networks = body.get("networks")
+        if not isinstance(networks, list):
+            return []
+        return [n["port"] for n in networks
+                if isinstance(n, dict) and n.get("port") and "uuid" not in n]
+
+    def _get_networks_from_request(self, req, context=None):
         """Returns networks given in server boot request."""
-        networks = self._get_networks(_get_body(req, "server"))
+        body = _get_body(req, "server", self.check_config.max_inspect_bytes)
+        if body is None:
+            return None
+        self.body = body
+        networks = self._get_networks(body)
         if networks is None:
             return None
+        self.requested = set(networks)
+        ports = self._get_ports(body)
+        if ports and self.resolve_ports is not None:
+            networks.extend(self.resolve_ports(context, ports).values())
         if not networks:
             return set()
         return set(networks)
 
-    def check_networks(self, req):
+    def check_networks(self, req, context=None):
         """Checks required/banned/count of networks."""
         cfg = self.check_config
-        networks = self._get_networks_from_request(req)
+        with alloc_trace.phase('parse'):
+            networks = self._get_networks_from_request(req, context)
 
         if cfg.strict_boot_check and networks is None:
             networks = set()
 
+        self.networks = networks
         if networks is None:
             return ""
 
-        msg = check_required_networks(networks, cfg.required_networks)
-        if msg:
-            return msg
-        msg = check_banned_networks(networks, cfg.banned_networks)
-        if msg:
-            return msg
-        return check_network_count(networks, cfg.networks_min,
-                                   cfg.networks_max,
-                                   None, cfg.optional_networks,
-                                   cfg.count_optional_nets)
+        # Networks of the ports given are not looked up: the port is the
+        # project's, whoever owns its network
+        if self.catalog is not None and self.requested:
+            with alloc_trace.phase('catalog'):
+                msg = self.catalog.check(context, self.requested)
+            if msg:
+                self.rule = 'catalog'
+                return msg
+
+        with alloc_trace.phase('policy'):
+            if cfg.policy.rules or cfg.candidates is not None:
+                self.facts = policy_rules.request_facts(
+                    getattr(context, 'project_id', None), self.body)
+            self.rule, msg = cfg.policy.evaluate_boot(networks, self.facts)
+        return msg
 
 
 class AttachNetworkCountCheck(object):
     """Verifies networks on network/vif attach request."""
-    def __init__(self, check_config, log, get_instance):
+    def __init__(self, check_config, log, get_instance,
+                 get_cached_networks=None, catalog=None):
         self.check_config = check_config
         self.log = log
         self.get_instance = get_instance
+        self.get_cached_networks = get_cached_networks
+        self.catalog = catalog
+        self.networks = None
+        self.existing_networks = None
+        self.rule = None
+        self.version = None
+        self.facts = None
+        self.entry = None
+        self.lookup_seconds = 0.0
 
     @staticmethod
     def _is_attach_network_request(pathparts, projectid):
@@ -172,7 +272,21 @@ class AttachNetworkCountCheck(object):
 
     def _get_existing_networks(self, context, server_id):
         """Returns networks a server is already connected to."""
+        from nova.compute import utils as compute_utils
+
+        want_facts = self.check_config.needs_instance_facts()
+        if self.get_cached_networks is not None:
+            entry = self.get_cached_networks(context, server_id,
+                                             want_facts=want_facts)
+            self.entry = entry
+            self.version = entry.version
+            if want_facts:
+                self.facts.update(entry.facts)
+            return entry.networks()
+
         instance = self.get_instance(context, server_id)
+        if want_facts:
+            self.facts.update(instance_networks.get_instance_facts(instance))
         nw_info = compute_utils.get_nw_info_for_instance(instance)
 
         networks = []
@@ -185,9 +299,10 @@ class AttachNetworkCountCheck(object):
 
     def _get_attaching_network(self, request):
         """Extract network to be added from request."""
-        if not request.body or len(request.body) == 0:
+        if not _has_body(request):
             return None
-        body = _get_body(request, "virtual_interface")
+        body = _get_body(request, "virtual_interface",
+                         self.check_config.max_inspect_bytes)
         if not body or 'network_id' not in body:
             return None
         return body['network_id']
@@ -195,21 +310,35 @@ class AttachNetworkCountCheck(object):
     def check_networks(self, context, request, server_id):
         """Checks banned/count of networks."""
         cfg = self.check_config
-        networks = set([self._get_attaching_network(request)])
+        with alloc_trace.phase('parse'):
+            networks = set([self._get_attaching_network(request)])
         if None in networks:
             networks.remove(None)
         if not len(networks):
             return ''
-        existing_networks = self._get_existing_networks(context, server_id)
+        self.networks = networks
+        self.facts = {'project': context.project_id}
+        # Before the server's networks are looked up, which costs more
+        if self.catalog is not None:
+            with alloc_trace.phase('catalog'):
+                msg = self.catalog.check(context, networks)
+            if msg:
+                self.rule = 'catalog'
+                return msg
+        started = time.time()
+        with alloc_trace.phase('lookup'):
+            existing_networks = self._get_existing_networks(context,
+                                                            server_id)
+        self.lookup_seconds = time.time() - started
+        self.existing_networks = existing_networks
 
         # Note: don't need to check required nets on attach
         # Min as 0 since only attach 1 at a time; in case 2 or more under min
-        msg = check_banned_networks(networks, cfg.banned_networks)
-        if msg:
-            return msg
-        return check_network_count(networks, None, cfg.networks_max,
-                                   existing_networks, cfg.optional_networks,
-                                   cfg.count_optional_nets)
+        with alloc_trace.phase('policy'):
+            self.rule, msg = cfg.policy.evaluate_attach(networks,
+                                                        existing_networks,
+                                                        self.facts)
+        return msg
 
 
 class NetworkCountCheck(net_base.WafflehausNovaNetworking):
@@ -218,6 +347,104 @@ class NetworkCountCheck(net_base.WafflehausNovaNetworking):
         self.log.name = conf.get('log_name', __name__)
         self.log.info('Starting wafflehaus network count check middleware')
         self.check_config = NetworkCountConfig(conf)
+        self.port_resolver = None
+        if conf.get('resolve_ports') in self.truths:
+            self.port_resolver = port_networks.PortResolver.from_conf(conf)
+        self.network_catalog = None
+        if conf.get('network_catalog') in self.truths:
+            self.network_catalog = network_catalog.NetworkCatalog.from_conf(
+                conf)
+        self.pre_auth = conf.get('pre_auth') in self.truths
+        self.pre_auth_checked = 0
+        self.pre_auth_rejected = 0
+        self.write_through = (self.network_cache is not None and
+                              conf.get('write_through') in self.truths)
+        self.vifs_learned = 0
+        self.vifs_unlearned = 0
+
+    def _apply_attach(self, project_id, server_id, network_id, version,
+                      resp):
+        """Records an attach nova accepted in the instance network cache.
+
+        With write_through, the id of the VIF is taken from nova's response,
+        so a later detach of it needs no lookup; otherwise, or if the
+        response does not name one VIF on network_id, the network is kept
+        as an attach of unknown VIF.
+        """
+        vif_id = None
+        if self.write_through:
+            with alloc_trace.phase('write_through'):
+                vifs = net_base._response_vifs(
+                    resp, self.check_config.max_inspect_bytes)
+            if vifs and len(vifs) == 1 and network_id in vifs.values():
+                vif_id, = vifs
+                self.vifs_learned += 1
+            else:
+                self.vifs_unlearned += 1
+        self.network_cache.apply_attach(project_id, server_id, network_id,
+                                        vif_id=vif_id, version=version)
+
+    def _decide_attach(self, check, vifs):
+        """The attach decision for a server on the networks of vifs."""
+        return self.check_config.policy.evaluate_attach(
+            check.networks, set(vifs.values()), check.facts)[1]
+
+    def _stats(self):
+        stats = super(NetworkCountCheck, self)._stats()
+        if self.port_resolver is not None:
+            stats['port_networks'] = self.port_resolver.stats()
+        if self.check_config.policy.rules:
+            stats['policy_rules'] = self.check_config.policy.rules.stats()
+        if self.check_config.candidates is not None:
+            stats['candidates'] = self.check_config.candidates.report()
+        if self.network_catalog is not None:
+            stats['network_catalog'] = self.network_catalog.stats()
+        if self.write_through:
+            stats['write_through'] = {'learned': self.vifs_learned,
+                                      'unlearned': self.vifs_unlearned}
+        if self.pre_auth:
+            stats['pre_auth'] = {'checked': self.pre_auth_checked,
+                                 'rejected': self.pre_auth_rejected}
+        return stats
+
+    def _check_pre_auth(self, req):
+        """Rejects, before authentication, boots no tenant could make.
+
+        Only a POST to /{project}/servers whose body has a Content-Length
+        within max_inspect_bytes and parses is looked at. Everything else,
+        and every boot that might pass for some tenant, goes on untouched
+        to auth and the checks behind it.
+        """
+        path = req.environ.get("PATH_INFO") or ""
+        pathparts = [part for part in path.split("/") if part]
+        if not pathparts or pathparts[-1] != "servers" or len(pathparts) > 2:
+            return self.app
+        max_bytes = self.check_config.max_inspect_bytes
+        length = req.content_length
+        if not length or length > max_bytes:
+            return self.app
+        try:
+            with alloc_trace.phase('parse'):
+                body = _get_body(req, "server", max_bytes)
+                networks = BootNetworkCountCheck._get_networks(body)
+        except (ValueError, TypeError, KeyError, AttributeError):
+            return self.app
+        if not networks:
+            return self.app
+
+        alloc_trace.label('pre_auth_boot')
+        self.pre_auth_checked += 1
+        with alloc_trace.phase('policy'):
+            rule, msg = self.check_config.policy.evaluate_pre_auth(networks)
+        self._capture(capture.PRE_AUTH_BOOT, req, None, msg, networks)
+        if not msg:
+            return self.app
+        self.pre_auth_rejected += 1
+        self._audit('boot', None, msg, networks=sorted(networks),
+                    pre_auth=True)
+        if self._enforce(msg):
+            return exc.HTTPForbidden(msg)
+        return self.app
 
     @webob.dec.wsgify
     def __call__(self, req, **local_config):
@@ -225,10 +452,22 @@ class NetworkCountCheck(net_base.WafflehausNovaNetworking):
         if not self.enabled:
             return self.app
 
+        if self._is_stats_request(req):
+            return self._stats_response(req)
+
         verb = req.method
+        if verb == "GET" and self.prefetch_vif_lists:
+            return self._traced(self._prefetch_vif_list, req)
         if verb != "POST":
             return self.app
 
+        return self._traced(self._check_request, req)
+
+    def _check_request(self, req):
+        """Returns the response to a POST, or the app to pass it on to."""
+        if self.pre_auth:
+            return self._check_pre_auth(req)
+
         context = self._get_context(req)
         if not context:
             return self.app
@@ -240,18 +479,76 @@ class NetworkCountCheck(net_base.WafflehausNovaNetworking):
 
         pathparts = [part for part in path.split("/") if part]
         msg = ""
+        on_success = None
         if AttachNetworkCountCheck._is_attach_network_request(pathparts,
                                                               projectid):
+            get_cached = None
+            if self.network_cache is not None:
+                get_cached = self._get_cached_networks
+            alloc_trace.label('attach')
             check = AttachNetworkCountCheck(self.check_config, self.log,
-                                            self._get_instance)
-            msg = check.check_networks(context, req, pathparts[2])
+                                            self._lookup_instance, get_cached,
+                                            self.network_catalog)
+            started = time.time()
+            try:
+                msg = check.check_networks(context, req, pathparts[2])
+            except (exc.HTTPNotFound,
+                    exc.HTTPRequestEntityTooLarge) as http_exc:
+                return http_exc
+            if check.networks:
+                self._audit('attach', context, msg, server=pathparts[2],
+                            networks=sorted(check.networks))
+                self._capture(capture.ATTACH, req, context, msg,
+                              check.networks, server=pathparts[2],
+                              server_vifs=len(check.existing_networks or ()),
+                              lookup_seconds=check.lookup_seconds)
+                self._shadow_verify(
+                    'attach', context, pathparts[2], check.entry, msg,
+                    functools.partial(self._decide_attach, check), started,
+                    ignore_nets=check.networks)
+                if (self.check_config.candidates is not None and
+                        check.rule != 'catalog'):
+                    with alloc_trace.phase('candidates'):
+                        self.check_config.candidates.evaluate_attach(
+                            msg, check.networks, check.existing_networks,
+                            check.facts)
+            if (check.version is not None and check.networks and
+                    (not msg or self.report_only)):
+                network_id, = check.networks
+                on_success = functools.partial(
+                    self._apply_attach, projectid, pathparts[2], network_id,
+                    check.version)
         elif BootNetworkCountCheck._is_server_boot_request(pathparts, req,
                                                            projectid):
-            check = BootNetworkCountCheck(self.check_config, self.log)
-            msg = check.check_networks(req)
+            resolve_ports = None
+            if self.port_resolver is not None:
+                resolve_ports = self.port_resolver.resolve
+            alloc_trace.label('boot')
+            check = BootNetworkCountCheck(self.check_config, self.log,
+                                          resolve_ports, self.network_catalog)
+            try:
+                msg = check.check_networks(req, context)
+            except (exc.HTTPBadRequest,
+                    exc.HTTPRequestEntityTooLarge,
+                    exc.HTTPServiceUnavailable) as http_exc:
+                return http_exc
+            if check.networks is not None:
+                self._audit('boot', context, msg,
+                            networks=sorted(check.networks))
+                self._capture(capture.BOOT, req, context, msg,
+                              check.networks)
+                if (self.check_config.candidates is not None and
+                        check.rule != 'catalog'):
+                    with alloc_trace.phase('candidates'):
+                        self.check_config.candidates.evaluate_boot(
+                            msg, check.networks, check.facts)
         if msg:
+            self._record_rejection(context, check.rule, check.networks)
+        if self._enforce(msg):
             return exc.HTTPForbidden(msg)
 
+        if on_success is not None:
+            return self._forward(req, on_success)
         return self.app
 
 
@@ -0,0 +1,298 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""Bitmask evaluation of network policies.
+
+Every network UUID named in the policy is given a bit position once, when
+the policy is built. A request's networks then become an integer mask plus
+the (usually empty) set of networks the policy does not know about, and
+every rule is a couple of bit operations on that mask.
+"""
+from wafflehaus.nova import ids
+from wafflehaus.nova.networking import policy_rules
+
+
+def _popcount(bits):
+    return bin(bits).count('1')
+
+
+def _split(value):
+    return [n.strip() for n in (value or '').split() if n.strip()]
+
+
+class NetworkSet(object):
+    """A set of networks as policy bits plus networks unknown to the policy.
+
+    Unknown networks never match a required, banned, optional, class or
+    exclusion rule, but they still count as isolated networks.
+    """
+    __slots__ = ('bits', 'extra')
+
+    def __init__(self, bits=0, extra=frozenset()):
+        self.bits = bits
+        self.extra = extra
+
+    def __or__(self, other):
+        if other is None:
+            return self
+        return NetworkSet(self.bits | other.bits, self.extra | other.extra)
+
+    def __len__(self):
+        return _popcount(self.bits) + len(self.extra)
+
+    def count(self, exclude_bits=0):
+        return _popcount(self.bits & ~exclude_bits) + len(self.extra)
+
+
+class NetworkClass(object):
+    """A named group of networks with its own count limits."""
+
+    def __init__(self, name, bits, min_nets=None, max_nets=None):
+        self.name = name
+        self.bits = bits
+        self.min_nets = min_nets
+        self.max_nets = max_nets
+
+
+class NetworkPolicy(object):
+    """Required, banned, count, class and exclusion rules as bitmasks."""
+
+    def __init__(self, required=(), banned=(), optional=(), classes=None,
+                 exclusive=(), networks_min=None, networks_max=None,
+                 count_optional=False, rules=None):
+        self.index = {}
+        self.names = []
+        self.required_networks = set(required)
+        self.banned_networks = set(banned)
+        self.optional_networks = set(optional)
+        self.required_bits = self.bits_for(self.required_networks)
+        self.banned_bits = self.bits_for(self.banned_networks)
+        self.optional_bits = self.bits_for(self.optional_networks)
+        self.classes = []
+        for name, spec in sorted((classes or {}).items()):
+            networks, min_nets, max_nets = spec
+            self.classes.append(NetworkClass(name, self.bits_for(networks),
+                                             min_nets, max_nets))
+        self.exclusive = [(self.bits_for(group), sorted(group))
+                          for group in exclusive if len(group) > 1]
+        self.networks_min = networks_min
+        self.networks_max = networks_max
+        self.count_optional = count_optional
+        self.rules = None
+        if rules:
+            self.rules = policy_rules.RuleSet.compile(rules, self)
+
+    @classmethod
+    def from_config(cls, local_config, required, banned, optional,
+                    networks_min, networks_max, count_optional):
+        """Adds the class, exclusion and rule settings from paste."""
+        classes = {}
+        for name in _split(local_config.get('network_classes')):
+            key = 'network_class_%s' % name
+            min_nets = local_config.get('%s_min' % key)
+            max_nets = local_config.get('%s_max' % key)
+            classes[name] = (
+                _split(local_config.get(key)),
+                int(min_nets) if min_nets is not None else None,
+                int(max_nets) if max_nets is not None else None)
+        exclusive = [group.split(',') for group in
+                     _split(local_config.get('exclusive_nets'))]
+        return cls(required=required, banned=banned, optional=optional,
+                   classes=classes, exclusive=exclusive,
+                   networks_min=networks_min, networks_max=networks_max,
+                   count_optional=count_optional,
+                   rules=local_config.get('policy_rules'))
+
+    def bits_for(self, networks):
+        """Returns the bits of networks, giving new networks a bit."""
+        bits = 0
+        for net in networks:
+            key = ids.pack_network(net)
+            bit = self.index.get(key)
+            if bit is None:
+                bit = 1 << len(self.names)
+                self.index[key] = bit
+                self.names.append(net)
+            bits |= bit
+        return bits
+
+    def names_for(self, bits):
+        return [name for i, name in enumerate(self.names) if bits & (1 << i)]
+
+    def mask(self, networks):
+        """Returns the NetworkSet for network UUIDs, packed or not."""
+        if networks is None:
+            return None
+        if isinstance(networks, NetworkSet):
+            return networks
+        index = self.index
+        pack = ids.pack
+        bits = 0
+        extra = None
+        for net in networks:
+            net = pack(net)
+            bit = index.get(net)
+            if bit is None:
+                if extra is None:
+                    extra = set()
+                extra.add(net)
+            else:
+                bits |= bit
+        return NetworkSet(bits, frozenset(extra) if extra else frozenset())
+
+    def check_required(self, networks):
+        """Verifies required networks are present."""
+        required = self.required_bits
+        if required and self.mask(networks).bits & required != required:
+            msg = "Networks (%s) required but missing"
+            return msg % ",".join(self.required_networks)
+        return ""
+
+    def check_banned(self, networks):
+        """Verifies banned networks are not present."""
+        if self.banned_bits and self.mask(networks).bits & self.banned_bits:
+            msg = "Networks (%s) not allowed"
+            return msg % ",".join(self.banned_networks)
+        return ""
+
+    def check_count(self, networks, existing_nets=None, min_nets=None,
+                    max_nets=None):
+        """Verifies correct number of isolated networks."""
+        if max_nets is None:
+            max_nets = self.networks_max
+        if not min_nets:
+            msg = "At most %i isolated network(s) can be attached"
+            msg_network_count = (max_nets)
+        elif min_nets == max_nets:
+            msg = "Exactly %i isolated network(s) must be attached"
+            msg_network_count = (min_nets)
+        else:
+            msg = "Only %i to %i isolated network(s) can be attached"
+            msg_network_count = (min_nets, max_nets)
+
+        isolated = self.mask(networks) | self.mask(existing_nets)
+        if self.count_optional:
+            count = len(isolated)
+        else:
+            count = isolated.count(self.optional_bits)
+
+        if (min_nets and count < min_nets) or count > max_nets:
+            return msg % msg_network_count
+        return ""
+
+    def check_classes(self, networks, existing_nets=None, enforce_min=True):
+        """Verifies per-class network count limits."""
+        bits = (self.mask(networks) | self.mask(existing_nets)).bits
+        for net_class in self.classes:
+            count = _popcount(bits & net_class.bits)
+            if net_class.max_nets is not None and count > net_class.max_nets:
+                msg = "At most %i network(s) of class %s can be attached"
+                return msg % (net_class.max_nets, net_class.name)
+            if (enforce_min and net_class.min_nets and
+                    count < net_class.min_nets):
+                msg = "At least %i network(s) of class %s must be attached"
+                return msg % (net_class.min_nets, net_class.name)
+        return ""
+
+    def check_exclusive(self, networks, existing_nets=None):
+        """Verifies mutually exclusive networks are not used together."""
+        bits = (self.mask(networks) | self.mask(existing_nets)).bits
+        for group_bits, group in self.exclusive:
+            if _popcount(bits & group_bits) > 1:
+                msg = "Networks (%s) cannot be attached together"
+                return msg % ",".join(group)
+        return ""
+
+    def evaluate_boot(self, networks, facts=None):
+        """Returns (rule, msg) for the first rule a server boot fails.
+
+        facts are what policy_rules conditions are tested against.
+        """
+        networks = self.mask(networks)
+        msg = self.check_required(networks)
+        if msg:
+            return 'required', msg
+        msg = self.check_banned(networks)
+        if msg:
+            return 'banned', msg
+        msg = self.check_count(networks, None, self.networks_min)
+        if msg:
+            return 'count', msg
+        msg = self.check_classes(networks)
+        if msg:
+            return 'class', msg
+        msg = self.check_exclusive(networks)
+        if msg:
+            return 'exclusive', msg
+        if self.rules:
+            return self.rules.evaluate(networks, facts or {})
+        return None, ""
+
+    def evaluate_attach(self, networks, existing_nets, facts=None):
+        """Returns (rule, msg) for the first rule an attach fails.
+
+        Required networks are not checked, and neither are minimums since
+        only one network is attached at a time.
+        """
+        networks = self.mask(networks)
+        existing_nets = self.mask(existing_nets)
+        msg = self.check_banned(networks)
+        if msg:
+            return 'banned', msg
+        msg = self.check_count(networks, existing_nets)
+        if msg:
+            return 'count', msg
+        msg = self.check_classes(networks, existing_nets, enforce_min=False)
+        if msg:
+            return 'class', msg
+        msg = self.check_exclusive(networks, existing_nets)
+        if msg:
+            return 'exclusive', msg
+        if self.rules:
+            return self.rules.evaluate(networks, facts or {}, existing_nets)
+        return None, ""
+
+    def evaluate_pre_auth(self, networks):
+        """Returns (rule, msg) if a server boot fails for every tenant.
+
+        Only the rules more networks cannot satisfy are run: banned
+        networks, maximums, exclusions and rules without conditions. A boot
+        failing them fails whatever its project and whatever networks its
+        ports turn out to be on.
+        """
+        networks = self.mask(networks)
+        empty = NetworkSet()
+        msg = self.check_banned(networks)
+        if msg:
+            return 'banned', msg
+        msg = self.check_count(networks, empty)
+        if msg:
+            return 'count', msg
+        msg = self.check_classes(networks, empty, enforce_min=False)
+        if msg:
+            return 'class', msg
+        msg = self.check_exclusive(networks, empty)
+        if msg:
+            return 'exclusive', msg
+        if self.rules:
+            return self.rules.evaluate_unconditional(networks, empty)
+        return None, ""
+
+    def check_boot(self, networks):
+        """Runs every rule against the networks of a server boot."""
+        return self.evaluate_boot(networks)[1]
+
+    def check_attach(self, networks, existing_nets):
+        """Runs the attach rules against the networks of a server."""
+        return self.evaluate_attach(networks, existing_nets)[1]
@@ -12,11 +12,262 @@
 #    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 #    License for the specific language governing permissions and limitations
 #    under the License.
+import functools
+import os
+import time
 
+import webob
+import webob.exc
+
+from wafflehaus.nova import alloc_trace
+from wafflehaus.nova import audit
+from wafflehaus.nova import ids
+from wafflehaus.nova.networking import capture
+from wafflehaus.nova.networking import heavy_hitters
+from wafflehaus.nova.networking import instance_networks
+from wafflehaus.nova.networking import shadow
+from wafflehaus.nova import notifications
 import wafflehaus.nova.nova_base as nova_base
 
+from oslo_utils import uuidutils
+
+DEFAULT_PREFETCH_MAX_BYTES = 65536
+
+
+def _response_vifs(resp, max_bytes):
+    """Returns {vif id: network id} of the VIFs in a response, or None.
+
+    The response may list VIFs, or hold the one VIF an attach created. Only
+    a successful JSON response of known length within max_bytes is read, and
+    only if every VIF in it has an address on a network.
+    """
+    length = resp.content_length
+    if (not 200 <= resp.status_int < 300 or not length or
+            length > max_bytes or resp.content_type != 'application/json'):
+        return None
+    try:
+        body = resp.json_body
+        listed = body.get('virtual_interfaces')
+        if listed is None:
+            listed = [body['virtual_interface']]
+        vifs = {}
+        for vif in listed:
+            vifs[vif['id']] = vif['ip_addresses'][0]['network_id']
+    except (ValueError, TypeError, KeyError, IndexError, AttributeError):
+        return None
+    return vifs
+
 
 class WafflehausNovaNetworking(nova_base.WafflehausNova):
 
     def __init__(self, application, conf):
         super(WafflehausNovaNetworking, self).__init__(application, conf)
+        self.audit = audit.AuditLog.from_conf(conf)
+        self.alloc_tracer = alloc_trace.AllocationTracer.from_conf(conf)
+        self.capture = capture.TrafficCapture.from_conf(conf)
+        self.rejection_stats = None
+        if conf.get('rejection_stats') in self.truths:
+            self.rejection_stats = heavy_hitters.RejectionStats.from_conf(
+                conf)
+        self.network_cache = instance_networks.InstanceNetworkCache.from_conf(
+            conf)
+        self.shadow = None
+        if self.network_cache is not None:
+            notifications.subscribe(conf, self.network_cache.on_notification)
+            self.shadow = shadow.ShadowVerifier.from_conf(conf)
+        self.prefetch_vif_lists = (
+            self.network_cache is not None and
+            conf.get('prefetch_vif_lists') in self.truths)
+        self.prefetch_max_bytes = int(conf.get('prefetch_max_bytes',
+                                               DEFAULT_PREFETCH_MAX_BYTES))
+        self.report_only = conf.get('report_only') in self.truths
+        self.would_reject = 0
+        self.stats_path = conf.get('stats_path')
+        if self.stats_path:
+            self.stats_path = '/' + self.stats_path.strip('/')
+
+    def _audit(self, action, context, msg, **fields):
+        """Queues an audit record of an accept or reject decision."""
+        if self.audit is None:
+            return
+        decision = 'accept'
+        if msg:
+            decision = 'would_reject' if self.report_only else 'reject'
+        with alloc_trace.phase('audit'):
+            self.audit.record(waffle=self.__class__.__name__, action=action,
+                              project=getattr(context, 'project_id', None),
+                              decision=decision, reason=msg or None,
+                              **fields)
+
+    def _capture(self, kind, req, context, msg, networks=(), server=None,
+                 vif=None, server_vifs=0, lookup_seconds=0.0):
+        """Summarizes a checked request into the capture ring, if sampled.
+        """
+        if self.capture is None or not self.capture.should_sample():
+            return
+        decision = capture.ACCEPT
+        if msg:
+            decision = (capture.WOULD_REJECT if self.report_only
+                        else capture.REJECT)
+        self.capture.record(kind, decision, req.content_length,
+                            lookup_seconds, server_vifs,
+                            getattr(context, 'project_id', None), server, vif,
+                            sorted(networks))
+
+    def _traced(self, check, req):
+        """Returns check(req), tracing its allocations when sampled."""
+        if self.alloc_tracer is None:
+            return check(req)
+        with self.alloc_tracer.request():
+            return check(req)
+
+    def _enforce(self, msg):
+        """Whether a rejection msg blocks the request.
+
+        In report_only mode it is logged and counted and the request goes on.
+        """
+        if not msg:
+            return False
+        if not self.report_only:
+            return True
+        self.would_reject += 1
+        self.log.info("report only, would reject: %s" % msg)
+        return False
+
+    def _get_cached_networks(self, context, server_id, vif_id=None,
+                             want_facts=False):
+        """Returns the server's ServerNetworks, looking it up if needed.
+
+        With vif_id, an entry that does not know that VIF is looked up
+        again: the VIF may be one of its attaches of unknown VIF id, or have
+        been attached through another worker or a missed notification.
+        With want_facts, an entry seeded without the instance's flavor and
+        image is looked up again to learn them.
+        """
+        notifications.ensure_listening()
+        cache = self.network_cache
+        entry = cache.get(context.project_id, server_id)
+        if (entry is not None and vif_id is not None and
+                ids.pack(vif_id) not in entry.vifs):
+            entry = None
+        if entry is not None and want_facts and entry.facts is None:
+            entry = None
+        if entry is None:
+            start = time.time()
+            instance = self._lookup_instance(context, server_id)
+            facts = None
+            if want_facts:
+                facts = instance_networks.get_instance_facts(instance)
+            vifs = instance_networks.get_vif_networks(instance)
+            entry = cache.seed(context.project_id, server_id, vifs, facts,
+                               lookup_seconds=time.time() - start)
+        return entry
+
+    def _lookup_vif_networks(self, context, server_id):
+        """Returns {vif id: network id} of a server, bypassing all caches."""
+        instance = self._get_instance(context, server_id)
+        return instance_networks.get_vif_networks(instance)
+
+    def _shadow_verify(self, kind, context, server_id, entry, msg, decide,
+                       started, ignore_vifs=(), ignore_nets=()):
+        """Samples a decision made from a cached entry for verification.
+
+        decide(vifs) returns a rejection message for the server's actual
+        VIFs. Entries seeded since started were just looked up, not cached,
+        and are not sampled.
+        """
+        if (self.shadow is None or entry is None or
+                entry.seeded_at >= started or
+                not self.shadow.should_sample()):
+            return
+        lookup = functools.partial(self._lookup_vif_networks, context,
+                                   server_id)
+        age = self.network_cache.clock() - entry.seeded_at
+        self.shadow.submit(shadow.ShadowCheck(
+            kind, lookup, decide, entry, bool(msg), age,
+            ignore_vifs=ignore_vifs, ignore_nets=ignore_nets))
+
+    def _prefetch_vif_list(self, req):
+        """Passes a GET of a server's VIFs on, caching the VIFs listed.
+
+        Clients list a server's VIFs right before detaching one, so the
+        detach check that follows is answered from the cache.
+        """
+        path = req.environ.get("PATH_INFO") or ""
+        pathparts = [part for part in path.split("/") if part]
+        if (len(pathparts) != 4 or pathparts[1] != "servers" or
+                pathparts[3] != "os-virtual-interfacesv2" or
+                not uuidutils.is_uuid_like(pathparts[2])):
+            return self.app
+        context = self._get_context(req)
+        if not context or pathparts[0] != context.project_id:
+            return self.app
+        alloc_trace.label('vif_list')
+        resp = req.get_response(self.app)
+        with alloc_trace.phase('parse'):
+            vifs = _response_vifs(resp, self.prefetch_max_bytes)
+        if vifs is not None:
+            self.network_cache.prefetch(context.project_id, pathparts[2],
+                                        vifs)
+            self._capture(capture.VIF_LIST, req, context, "",
+                          set(vifs.values()), server=pathparts[2],
+                          server_vifs=len(vifs))
+        return resp
+
+    def _forward(self, req, on_success):
+        """Calls the app and runs on_success(resp) if nova accepted it."""
+        resp = req.get_response(self.app)
+        if 200 <= resp.status_int < 300:
+            on_success(resp)
+        return resp
+
+    def _record_rejection(self, context, rule, networks):
+        """Counts a rejection toward the heavy-hitter statistics."""
+        if self.rejection_stats is None or not rule:
+            return
+        self.rejection_stats.record(getattr(context, 'project_id', None),
+                                    rule, networks)
+
+    def _stats(self):
+        """Returns the counters this worker exposes on stats_path."""
+        stats = {'pid': os.getpid()}
+        if self.report_only:
+            stats['report_only'] = {'would_reject': self.would_reject}
+        if self.audit is not None:
+            stats['audit'] = self.audit.stats()
+        if self.negative_cache is not None:
+            stats['negative_cache'] = self.negative_cache.stats()
+        if self.network_cache is not None:
+            stats['instance_networks'] = self.network_cache.stats()
+        if self.memory_budget is not None:
+            stats['memory_budget'] = self.memory_budget.stats()
+        if self.cell_cache is not None:
+            stats['cell_cache'] = self.cell_cache.stats()
+            stats['cell_cache'].update(stale=self.cell_stale,
+                                       fallbacks=self.cell_fallbacks)
+        if self.hedging is not None:
+            stats['hedging'] = self.hedging.stats()
+        if self.replica is not None:
+            stats['replica'] = self.replica.stats()
+        if self.rejection_stats is not None:
+            stats['rejections'] = self.rejection_stats.report()
+        if self.shadow is not None:
+            stats['shadow'] = self.shadow.report()
+        if self.alloc_tracer is not None:
+            stats['allocations'] = self.alloc_tracer.report()
+        if self.capture is not None:
+            stats['capture'] = self.capture.stats()
+        return stats
+
+    def _is_stats_request(self, req):
+        return (self.stats_path is not None and req.method == "GET" and
+                req.path_info.rstrip("/") == self.stats_path)
+
+    def _stats_response(self, req):
+        """Returns the statistics as JSON, to admins only."""
+        context = self._get_context(req)
+        if not context or not getattr(context, 'is_admin', False):
+            return webob.exc.HTTPForbidden()
+        resp = webob.Response(content_type='application/json')
+        resp.json_body = self._stats()
+        return resp
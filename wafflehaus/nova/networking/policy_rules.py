@@ -0,0 +1,351 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""Declarative network policy rules.
+
+One rule per line, optionally labelled, optionally conditional::
+
+    [label:] require NET [NET ...]            [when CONDITION]
+    [label:] ban NET [NET ...]                [when CONDITION]
+    [label:] count [MIN]..[MAX]               [when CONDITION]
+    [label:] if NET [NET ...] then NET [...]  [when CONDITION]
+    [label:] exclusive NET NET [NET ...]      [when CONDITION]
+    [label:] report RULE
+
+    CONDITION := FIELD OP VALUE[,VALUE ...] [and CONDITION]
+    FIELD     := project | flavor | image
+    OP        := = | != | in | not in
+
+Rules are parsed once, when the filter is loaded, into closures over the
+bitmasks of the NetworkPolicy they belong to, and are run cheapest first so
+a request stops at the first rule it fails. Each rule keeps its own
+evaluation count, rejection count and time spent. A rule prefixed with
+'report' never rejects: its failures are only counted, so a new rule can be
+watched against live traffic before it is enforced.
+"""
+import re
+import timeit
+
+FIELDS = ('project', 'flavor', 'image')
+
+_LABEL = re.compile(r'^\s*([A-Za-z_][\w-]*)\s*:\s*(.*)$')
+_RANGE = re.compile(r'^(\d*)\.\.(\d*)$')
+
+# Rough relative cost of the parts of a rule, to order them
+_CONDITION_COST = 1
+_BITS_COST = 1
+_COUNT_COST = 3
+
+
+def _popcount(bits):
+    return bin(bits).count('1')
+
+
+def _last_segment(ref):
+    """flavorRef and imageRef may be given as links; keep the id."""
+    if ref is None:
+        return None
+    return str(ref).rstrip('/').rsplit('/', 1)[-1]
+
+
+def request_facts(project_id, body=None):
+    """Returns the facts conditions are tested against for a server boot."""
+    body = body or {}
+    return {'project': project_id,
+            'flavor': _last_segment(body.get('flavorRef')),
+            'image': _last_segment(body.get('imageRef'))}
+
+
+def _compile_condition(tokens, line):
+    """Returns (test(facts), fields, cost) for the tokens after 'when'."""
+    tests = []
+    fields = set()
+    while tokens:
+        field = tokens.pop(0)
+        if field not in FIELDS:
+            raise ValueError("Unknown field %r in rule %r" % (field, line))
+        if tokens[:2] == ['not', 'in']:
+            op = 'not in'
+            del tokens[:2]
+        elif tokens and tokens[0] in ('=', '==', '!=', 'in'):
+            op = tokens.pop(0)
+        else:
+            raise ValueError("Expected an operator after %r in rule %r" %
+                             (field, line))
+        values = []
+        while tokens and tokens[0] != 'and':
+            values.append(tokens.pop(0))
+        if not values:
+            raise ValueError("Expected a value after %r in rule %r" %
+                             (op, line))
+        if tokens:
+            tokens.pop(0)
+        fields.add(field)
+        tests.append(_compile_test(field, op, frozenset(values)))
+
+    if len(tests) == 1:
+        test = tests[0]
+    else:
+        def test(facts):
+            for one in tests:
+                if not one(facts):
+                    return False
+            return True
+    return test, fields, len(tests) * _CONDITION_COST
+
+
+def _compile_test(field, op, values):
+    if op == '!=' or op == 'not in':
+        return lambda facts: facts.get(field) not in values
+    return lambda facts: facts.get(field) in values
+
+
+class Rule(object):
+    """One compiled rule with its evaluation statistics."""
+
+    def __init__(self, name, text, check, cost, on_attach, fields,
+                 report_only=False):
+        self.name = name
+        self.text = text
+        self.check = check
+        self.cost = cost
+        self.on_attach = on_attach
+        self.fields = fields
+        self.report_only = report_only
+        self.evaluations = 0
+        self.rejections = 0
+        self.seconds = 0.0
+
+    def stats(self):
+        mean = self.seconds / self.evaluations if self.evaluations else 0.0
+        return {'name': self.name, 'rule': self.text, 'cost': self.cost,
+                'evaluations': self.evaluations,
+                'rejections': self.rejections,
+                'report_only': self.report_only,
+                'total_ms': self.seconds * 1000.0,
+                'mean_us': mean * 1000000.0}
+
+
+class RuleSet(object):
+    """Compiled rules in evaluation order."""
+
+    def __init__(self, rules, timer=timeit.default_timer):
+        # sorted() is stable, so equal costs keep their configured order
+        self.rules = sorted(rules, key=lambda rule: rule.cost)
+        self.boot_rules = self.rules
+        self.attach_rules = [rule for rule in self.rules if rule.on_attach]
+        # Attach rules hold however many networks are added; without a
+        # condition they hold for every tenant too
+        self.unconditional_rules = [rule for rule in self.attach_rules
+                                    if not rule.fields]
+        self.fields = set()
+        for rule in self.rules:
+            self.fields.update(rule.fields)
+        self.timer = timer
+
+    @classmethod
+    def compile(cls, text, policy):
+        """Parses rule lines, registering their networks with policy."""
+        rules = []
+        for number, line in enumerate((text or '').splitlines(), 1):
+            line = line.split('#', 1)[0].strip()
+            if line:
+                rules.append(_compile_rule(line, number, policy))
+        return cls(rules)
+
+    def __len__(self):
+        return len(self.rules)
+
+    def needs_instance_facts(self):
+        """Whether conditions test anything beyond the project."""
+        return bool(self.fields - set(['project']))
+
+    def evaluate(self, networks, facts, existing_nets=None):
+        """Returns (name, msg) of the first rule failed, or (None, "").
+
+        With existing_nets the request is an attach of networks to a server
+        already on existing_nets, and only the attach rules run.
+        """
+        rules = self.boot_rules
+        if existing_nets is not None:
+            rules = self.attach_rules
+        return self._run(rules, networks, facts, existing_nets)
+
+    def evaluate_unconditional(self, networks, existing_nets):
+        """Runs only the rules no project, flavor, image or added network
+        can satisfy once they fail.
+        """
+        return self._run(self.unconditional_rules, networks, {},
+                         existing_nets)
+
+    def _run(self, rules, networks, facts, existing_nets):
+        timer = self.timer
+        for rule in rules:
+            # Counters are updated without a lock; a lost increment under
+            # concurrency only skews the statistics slightly.
+            start = timer()
+            msg = rule.check(facts, networks, existing_nets)
+            rule.seconds += timer() - start
+            rule.evaluations += 1
+            if msg:
+                rule.rejections += 1
+                if not rule.report_only:
+                    return rule.name, msg
+        return None, ""
+
+    def stats(self):
+        return [rule.stats() for rule in self.rules]
+
+
+def _compile_rule(line, number, policy):
+    name = 'rule%d' % number
+    text = line
+    match = _LABEL.match(line)
+    if match:
+        name, line = match.groups()
+    tokens = line.replace(',', ' ').split()
+    condition = None
+    fields = set()
+    cost = 0
+    if 'when' in tokens:
+        at = tokens.index('when')
+        condition, fields, cost = _compile_condition(tokens[at + 1:], text)
+        tokens = tokens[:at]
+    if not tokens:
+        raise ValueError("Empty rule %r" % text)
+
+    kind = tokens.pop(0)
+    report_only = kind == 'report'
+    if report_only:
+        if not tokens:
+            raise ValueError("Rule %r reports nothing" % text)
+        kind = tokens.pop(0)
+    compiler = _ACTIONS.get(kind)
+    if compiler is None:
+        raise ValueError("Unknown rule %r in %r" % (kind, text))
+    action, action_cost, on_attach = compiler(tokens, policy, text)
+    cost += action_cost
+
+    if condition is None:
+        check = action
+    else:
+        def check(facts, networks, existing_nets):
+            if not condition(facts):
+                return ""
+            return action(facts, networks, existing_nets)
+    return Rule(name, text, check, cost, on_attach, fields, report_only)
+
+
+def _networks(tokens, text, minimum=1):
+    if len(tokens) < minimum:
+        raise ValueError("Rule %r needs at least %d network(s)" %
+                         (text, minimum))
+    return tokens
+
+
+def _require(tokens, policy, text):
+    networks = _networks(tokens, text)
+    bits = policy.bits_for(networks)
+    msg = "Networks (%s) required but missing" % ",".join(networks)
+
+    def check(facts, nets, existing_nets):
+        if nets.bits & bits != bits:
+            return msg
+        return ""
+    return check, _BITS_COST, False
+
+
+def _ban(tokens, policy, text):
+    networks = _networks(tokens, text)
+    bits = policy.bits_for(networks)
+    msg = "Networks (%s) not allowed" % ",".join(networks)
+
+    def check(facts, nets, existing_nets):
+        if nets.bits & bits:
+            return msg
+        return ""
+    return check, _BITS_COST, True
+
+
+def _count(tokens, policy, text):
+    match = _RANGE.match(tokens[0]) if len(tokens) == 1 else None
+    if len(tokens) == 1 and tokens[0].isdigit():
+        min_nets = max_nets = int(tokens[0])
+    elif match and any(match.groups()):
+        min_nets = int(match.group(1)) if match.group(1) else None
+        max_nets = int(match.group(2)) if match.group(2) else None
+    else:
+        raise ValueError("Rule %r needs a count like 2, 1..3 or ..4" % text)
+    if min_nets is not None and max_nets is not None:
+        if min_nets == max_nets:
+            msg = "Exactly %i isolated network(s) must be attached" % min_nets
+        else:
+            msg = ("Only %i to %i isolated network(s) can be attached" %
+                   (min_nets, max_nets))
+    elif max_nets is not None:
+        msg = "At most %i isolated network(s) can be attached" % max_nets
+    else:
+        msg = "At least %i isolated network(s) must be attached" % min_nets
+    exclude = 0 if policy.count_optional else policy.optional_bits
+
+    def check(facts, nets, existing_nets):
+        nets = nets | existing_nets
+        count = _popcount(nets.bits & ~exclude) + len(nets.extra)
+        if max_nets is not None and count > max_nets:
+            return msg
+        # Minimums are not enforced on attach, one network comes at a time
+        if (existing_nets is None and min_nets is not None and
+                count < min_nets):
+            return msg
+        return ""
+    return check, _COUNT_COST, True
+
+
+def _implies(tokens, policy, text):
+    if 'then' not in tokens:
+        raise ValueError("Rule %r needs 'then'" % text)
+    at = tokens.index('then')
+    trigger = _networks(tokens[:at], text)
+    implied = _networks(tokens[at + 1:], text)
+    trigger_bits = policy.bits_for(trigger)
+    implied_bits = policy.bits_for(implied)
+    msg = "Networks (%s) required with (%s)" % (",".join(implied),
+                                                ",".join(trigger))
+
+    def check(facts, nets, existing_nets):
+        bits = nets.bits
+        if bits & trigger_bits and bits & implied_bits != implied_bits:
+            return msg
+        return ""
+    return check, _BITS_COST, False
+
+
+def _exclusive(tokens, policy, text):
+    networks = _networks(tokens, text, minimum=2)
+    bits = policy.bits_for(networks)
+    msg = "Networks (%s) cannot be attached together" % ",".join(networks)
+
+    def check(facts, nets, existing_nets):
+        both = (nets | existing_nets).bits & bits
+        if both & (both - 1):
+            return msg
+        return ""
+    return check, _BITS_COST, True
+
+
+_ACTIONS = {'require': _require,
+            'ban': _ban,
+            'count': _count,
+            'if': _implies,
+            'exclusive': _exclusive}
@@ -0,0 +1,128 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""Resolution of pre-created ports to the networks they are on.
+
+All ports of a request that are not cached are looked up in one filtered
+list call. A port never moves to another network, so mappings are cached
+for port_cache_ttl seconds. The port API is loaded from port_api, so a
+deployment or a test can use something other than nova's neutron client.
+"""
+import logging
+
+import webob.exc
+
+from wafflehaus.nova import cache
+from wafflehaus.nova import ids
+from wafflehaus.nova import memory_budget
+
+LOG = logging.getLogger(__name__)
+
+
+class NeutronPortAPI(object):
+    """Looks ports up with nova's neutron client and the request context."""
+
+    def __init__(self, conf):
+        self.conf = conf
+
+    @staticmethod
+    def _get_client(context):
+        try:
+            from nova.network import neutron
+        except ImportError:
+            from nova.network.neutronv2 import api as neutron
+        return neutron.get_client(context)
+
+    def list_ports(self, context, port_ids):
+        """Returns {port id: network id} for the ports that exist."""
+        client = self._get_client(context)
+        ports = client.list_ports(id=list(port_ids),
+                                  fields=['id', 'network_id'])
+        return dict((port['id'], port['network_id'])
+                    for port in ports.get('ports', []))
+
+
+def load_port_api(conf):
+    """Returns the port API named by port_api, or the neutron one."""
+    path = conf.get('port_api')
+    if not path:
+        return NeutronPortAPI(conf)
+    from oslo_utils import importutils
+    return importutils.import_object(path, conf)
+
+
+class PortResolver(object):
+    """Maps port ids to network ids, one batched lookup per request."""
+
+    def __init__(self, port_api, max_entries=10000, ttl=3600, budget=None):
+        self.port_api = port_api
+        self.cache = None
+        if ttl > 0:
+            self.cache = cache.TTLCache('port_networks', max_entries, ttl,
+                                        budget=budget)
+        self.lookups = 0
+        self.ports_looked_up = 0
+
+    @classmethod
+    def from_conf(cls, conf):
+        return cls(load_port_api(conf),
+                   max_entries=int(conf.get('port_cache_size', 10000)),
+                   ttl=float(conf.get('port_cache_ttl', 3600)),
+                   budget=memory_budget.MemoryBudget.from_conf(conf))
+
+    def resolve(self, context, port_ids):
+        """Returns {port id: network id} for all of port_ids.
+
+        Raises HTTPBadRequest for a port that does not exist, as nova would,
+        and HTTPServiceUnavailable if the ports cannot be looked up, so a
+        boot is never let through unchecked.
+        """
+        resolved = {}
+        missing = []
+        for port_id in port_ids:
+            network_id = None
+            if self.cache is not None:
+                network_id = ids.unpack(self.cache.get(ids.pack(port_id)))
+            if network_id is None:
+                missing.append(port_id)
+            else:
+                resolved[port_id] = network_id
+        if not missing:
+            return resolved
+
+        self.lookups += 1
+        self.ports_looked_up += len(missing)
+        try:
+            found = self.port_api.list_ports(context, missing)
+        except Exception:
+            LOG.exception('Unable to look up ports %s', ','.join(missing))
+            msg = "Unable to verify the networks of the requested ports"
+            raise webob.exc.HTTPServiceUnavailable(explanation=msg)
+        for port_id in missing:
+            network_id = found.get(port_id)
+            if network_id is None:
+                msg = "Port %s could not be found." % port_id
+                raise webob.exc.HTTPBadRequest(explanation=msg)
+            resolved[port_id] = network_id
+            if self.cache is not None:
+                self.cache.set(ids.pack(port_id),
+                               ids.pack_network(network_id))
+        return resolved
+
+    def stats(self):
+        stats = {'lookups': self.lookups,
+                 'ports_looked_up': self.ports_looked_up}
+        if self.cache is not None:
+            stats['cache'] = self.cache.stats()
+        return stats
@@ -0,0 +1,198 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""Shadow verification of decisions made from the instance network cache.
+
+A sample of cached attach and detach decisions is queued, together with
+what the cache held, for a background worker that looks the server up
+without any cache and compares. The request thread only draws a random
+number and appends to a bounded deque; when the deque is full the sample
+is dropped and counted. Networks and VIFs of the checked request itself are
+left out of the comparison, since nova may already have applied it by the
+time the worker looks.
+"""
+import collections
+import logging
+import os
+import random
+import threading
+
+from wafflehaus.nova import ids
+
+LOG = logging.getLogger(__name__)
+
+# Upper bounds, in seconds, of the cache entry age buckets
+AGE_BUCKETS = (10, 60, 300, 900, 3600)
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def _age_bucket(age):
+    for bound in AGE_BUCKETS:
+        if age < bound:
+            return '<%ds' % bound
+    return '>=%ds' % AGE_BUCKETS[-1]
+
+
+class ShadowCheck(object):
+    """A cached decision waiting to be verified."""
+    __slots__ = ('kind', 'lookup', 'decide', 'cached_vifs', 'cached_pending',
+                 'ignore_vifs', 'ignore_nets', 'rejected', 'age')
+
+    def __init__(self, kind, lookup, decide, entry, rejected, age,
+                 ignore_vifs=(), ignore_nets=()):
+        self.kind = kind
+        self.lookup = lookup
+        self.decide = decide
+        self.cached_vifs = dict(entry.vifs)
+        self.cached_pending = tuple(entry.pending)
+        self.ignore_vifs = frozenset(ids.pack(vif) for vif in ignore_vifs)
+        self.ignore_nets = frozenset(ids.pack(net) for net in ignore_nets)
+        self.rejected = rejected
+        self.age = age
+
+
+class ShadowStats(object):
+    """Verification counters for one kind of check."""
+
+    def __init__(self):
+        self.verified = 0
+        self.mismatches = 0
+        self.flipped_to_reject = 0
+        self.flipped_to_accept = 0
+        self.errors = 0
+        self.ages = collections.defaultdict(lambda: [0, 0])
+
+    def report(self):
+        ages = {}
+        for bucket, (verified, mismatches) in self.ages.items():
+            ages[bucket] = {'verified': verified, 'mismatches': mismatches}
+        rate = self.mismatches / float(self.verified) if self.verified else 0
+        return {'verified': self.verified, 'mismatches': self.mismatches,
+                'mismatch_rate': rate,
+                'flipped_to_reject': self.flipped_to_reject,
+                'flipped_to_accept': self.flipped_to_accept,
+                'errors': self.errors, 'ages': ages}
+
+
+class ShadowVerifier(object):
+    """Samples cached decisions and verifies them in the background."""
+
+    def __init__(self, sample_rate, queue_size=1000, rng=random.random):
+        self.sample_rate = sample_rate
+        self.queue_size = queue_size
+        self.rng = rng
+        self.sampled = 0
+        self.dropped = 0
+        self.stats = collections.defaultdict(ShadowStats)
+        self._queue = collections.deque()
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._pid = None
+        self._worker = None
+
+    @classmethod
+    def from_conf(cls, conf):
+        """Returns the process-wide verifier if shadow_sample_rate is set."""
+        global _shared
+        rate = float(conf.get('shadow_sample_rate', 0))
+        if rate <= 0:
+            return None
+        with _shared_lock:
+            if _shared is None:
+                _shared = cls(min(rate, 1.0), queue_size=int(
+                    conf.get('shadow_queue_size', 1000)))
+        return _shared
+
+    def should_sample(self):
+        return self.rng() < self.sample_rate
+
+    def submit(self, check):
+        """Queues a check without blocking; returns False if dropped."""
+        if len(self._queue) >= self.queue_size:
+            self.dropped += 1
+            return False
+        self.sampled += 1
+        self._queue.append(check)
+        self._ensure_worker()
+        self._wakeup.set()
+        return True
+
+    def _ensure_worker(self):
+        # Threads do not survive nova forking its API workers
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            if self._pid == pid:
+                return
+            self._worker = threading.Thread(target=self._run,
+                                            name='wafflehaus-shadow')
+            self._worker.daemon = True
+            self._pid = pid
+            self._worker.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            self.drain()
+
+    def drain(self):
+        """Verifies every queued check."""
+        while True:
+            try:
+                check = self._queue.popleft()
+            except IndexError:
+                return
+            self.verify(check)
+
+    def verify(self, check):
+        stats = self.stats[check.kind]
+        try:
+            fresh_vifs = ids.pack_vifs(check.lookup())
+            rejected = bool(check.decide(fresh_vifs))
+        except Exception:
+            LOG.exception('Shadow %s lookup failed', check.kind)
+            stats.errors += 1
+            return
+        cached = self._networks(check, check.cached_vifs,
+                                check.cached_pending)
+        mismatch = self._networks(check, fresh_vifs) != cached
+        stats.verified += 1
+        bucket = stats.ages[_age_bucket(check.age)]
+        bucket[0] += 1
+        if mismatch:
+            stats.mismatches += 1
+            bucket[1] += 1
+        if rejected and not check.rejected:
+            stats.flipped_to_reject += 1
+        elif check.rejected and not rejected:
+            stats.flipped_to_accept += 1
+
+    @staticmethod
+    def _networks(check, vifs, pending=()):
+        """Networks of vifs and pending attaches, less the request's own."""
+        networks = set(net for vif, net in vifs.items()
+                       if vif not in check.ignore_vifs)
+        networks.update(pending)
+        return networks - check.ignore_nets
+
+    def report(self):
+        report = {'sample_rate': self.sample_rate, 'sampled': self.sampled,
+                  'dropped': self.dropped, 'queued': len(self._queue)}
+        for kind, stats in list(self.stats.items()):
+            report[kind] = stats.report()
+        return report
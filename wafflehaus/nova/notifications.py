@@ -0,0 +1,110 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""Instance notifications for the waffle caches.
+
+When notification_topics is set, each API worker listens for nova instance
+notifications in its own pool (so every worker sees every message without
+taking them from other consumers) and hands (event_type, project_id,
+instance_uuid) to the registered handlers. Listening is optional: without
+oslo.messaging or configuration the caches simply rely on their TTLs.
+"""
+import logging
+import os
+import socket
+import threading
+
+LOG = logging.getLogger(__name__)
+
+INSTANCE_EVENTS = ('compute.instance.create.end',
+                   'compute.instance.delete.end',
+                   'compute.instance.interface_attach',
+                   'compute.instance.interface_detach',
+                   'instance.create.end',
+                   'instance.delete.end',
+                   'instance.interface_attach.end',
+                   'instance.interface_detach.end')
+
+_handlers = []
+_topics = None
+_listener = None
+_pid = None
+_lock = threading.Lock()
+
+
+def subscribe(conf, handler):
+    """Registers handler(event_type, project_id, instance_uuid)."""
+    global _topics
+    topics = conf.get('notification_topics')
+    if not topics:
+        return False
+    with _lock:
+        _topics = topics.replace(',', ' ').split()
+        if handler not in _handlers:
+            _handlers.append(handler)
+    return True
+
+
+def dispatch(event_type, payload):
+    """Parses a legacy or versioned instance payload and calls handlers."""
+    if event_type not in INSTANCE_EVENTS or not isinstance(payload, dict):
+        return
+    data = payload.get('nova_object.data', payload)
+    instance_uuid = data.get('uuid') or data.get('instance_id')
+    project_id = data.get('tenant_id') or data.get('project_id')
+    if not instance_uuid:
+        return
+    for handler in list(_handlers):
+        try:
+            handler(event_type, project_id, instance_uuid)
+        except Exception:
+            LOG.exception('Notification handler failed for %s', event_type)
+
+
+class _Endpoint(object):
+    filter_rule = None
+
+    def info(self, ctxt, publisher_id, event_type, payload, metadata):
+        dispatch(event_type, payload)
+
+
+def ensure_listening():
+    """Starts this process's listener once, after nova forks its workers."""
+    global _listener, _pid
+    pid = os.getpid()
+    if _topics is None or _pid == pid:
+        return
+    with _lock:
+        if _pid == pid:
+            return
+        _pid = pid
+        try:
+            from oslo_config import cfg
+            import oslo_messaging
+            from oslo_utils import eventletutils
+
+            transport = oslo_messaging.get_notification_transport(cfg.CONF)
+            targets = [oslo_messaging.Target(topic=t) for t in _topics]
+            pool = 'wafflehaus-%s-%d' % (socket.gethostname(), pid)
+            executor = 'threading'
+            if eventletutils.is_monkey_patched('thread'):
+                executor = 'eventlet'
+            _listener = oslo_messaging.get_notification_listener(
+                transport, targets, [_Endpoint()], executor=executor,
+                pool=pool)
+            _listener.start()
+        except Exception:
+            LOG.exception('Unable to listen for instance notifications; '
+                          'waffle caches will rely on their TTLs')
+            _listener = None
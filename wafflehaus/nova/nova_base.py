@@ -12,20 +12,60 @@
 #    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 #    License for the specific language governing permissions and limitations
 #    under the License.
+import functools
 
-from nova import compute
+import webob.exc
 
 from wafflehaus.base import WafflehausBase
+from wafflehaus.nova import cache
+from wafflehaus.nova import hedging
+from wafflehaus.nova import ids
+from wafflehaus.nova import memory_budget
+from wafflehaus.nova import notifications
+from wafflehaus.nova import replica
 
 
 class WafflehausNova(WafflehausBase):
 
     def _get_compute(self):
+        """Imports nova.compute on first use; mock target for testing."""
+        from nova import compute
         return compute
 
     def __init__(self, application, conf):
         super(WafflehausNova, self).__init__(application, conf)
-        self.compute = self._get_compute()
+        self._compute = None
+        self.memory_budget = memory_budget.MemoryBudget.from_conf(conf)
+        self.negative_cache = None
+        negative_ttl = float(conf.get('negative_cache_ttl', 0))
+        if negative_ttl > 0:
+            self.negative_cache = cache.TTLCache(
+                'negative_lookups',
+                int(conf.get('negative_cache_size', 10000)), negative_ttl,
+                budget=self.memory_budget)
+            notifications.subscribe(conf, self._on_instance_notification)
+        self.cell_cache = None
+        self.cell_stale = 0
+        self.cell_fallbacks = 0
+        cell_ttl = float(conf.get('cell_cache_ttl', 0))
+        if cell_ttl > 0:
+            self.cell_cache = cache.TTLCache(
+                'cell_mappings', int(conf.get('cell_cache_size', 10000)),
+                cell_ttl, budget=self.memory_budget)
+            notifications.subscribe(conf, self._on_cell_notification)
+        self.hedging = hedging.HedgedLookups.from_conf(conf)
+        self.hedge_to_replica = conf.get('hedge_to_replica') in self.truths
+        self.replica = replica.ReplicaRouter.from_conf(conf)
+        if self.hedge_to_replica and self.replica is None:
+            # Without a lag bound nothing keeps hedges off a stale replica
+            raise ValueError("hedge_to_replica needs replica_max_lag")
+
+    @property
+    def compute(self):
+        """nova.compute, imported lazily so paste loading stays cheap."""
+        if self._compute is None:
+            self._compute = self._get_compute()
+        return self._compute
 
     def _get_context(self, request):
         """Mock target for testing."""
@@ -37,3 +77,136 @@ class WafflehausNova(WafflehausBase):
         compute_api = self.compute.API()
         instance = compute_api.get(context, server_id, want_objects=True)
         return instance
+
+    def _get_cell_mapping(self, context, server_id):
+        """Mock target for testing."""
+        from nova import objects
+        mapping = objects.InstanceMapping.get_by_instance_uuid(context,
+                                                               server_id)
+        return mapping.cell_mapping
+
+    def _get_instance_from_cell(self, context, cell_mapping, server_id):
+        """Mock target for testing."""
+        from nova import context as nova_context
+        from nova import objects
+        with nova_context.target_cell(context, cell_mapping) as cell_context:
+            # Older nova targets context itself and yields nothing
+            return objects.Instance.get_by_uuid(
+                cell_context or context, server_id,
+                expected_attrs=['info_cache'])
+
+    def _get_instance_from_replica(self, context, server_id):
+        """Mock target for testing."""
+        from nova import context as nova_context
+        from nova import objects
+        cell_mapping = None
+        if self.cell_cache is not None:
+            cell_mapping = self.cell_cache.get(ids.pack(server_id))
+        if cell_mapping is None:
+            cell_mapping = self._get_cell_mapping(context, server_id)
+        with nova_context.target_cell(context, cell_mapping) as cell_context:
+            return objects.Instance.get_by_uuid(
+                cell_context or context, server_id,
+                expected_attrs=['info_cache'], use_slave=True)
+
+    def _get_instance_via_cell_cache(self, context, server_id):
+        """Returns the instance with one cell query when its cell is known.
+
+        A mapping the cell no longer agrees with is dropped and the
+        instance resolved in full, through the API database, again.
+        """
+        from nova import exception as nova_exc
+
+        key = ids.pack(server_id)
+        cell_mapping = self.cell_cache.get(key)
+        if cell_mapping is not None:
+            try:
+                return self._get_instance_from_cell(context, cell_mapping,
+                                                    server_id)
+            except nova_exc.InstanceNotFound:
+                self.cell_cache.pop(key)
+                self.cell_stale += 1
+        try:
+            cell_mapping = self._get_cell_mapping(context, server_id)
+        except nova_exc.NotFound:
+            cell_mapping = None
+        if cell_mapping is None:
+            # Not mapped yet, or not at all; let compute decide
+            self.cell_fallbacks += 1
+            return self._get_instance(context, server_id)
+        instance = self._get_instance_from_cell(context, cell_mapping,
+                                                server_id)
+        self.cell_cache.set(key, cell_mapping)
+        return instance
+
+    def _get_instance_routed(self, context, server_id):
+        """Returns the instance, from a replica or hedged as configured.
+
+        Within the replica lag bound the replica is read, and the primary
+        when it is not or the read fails. A hedged lookup that is slow is
+        sent again. With hedge_to_replica the first lookup reads the
+        primary and only the second is routed, so the replica answers slow
+        lookups within the lag bound and the primary is asked twice beyond.
+        """
+        from nova import exception as nova_exc
+
+        lookup = functools.partial(self._get_instance, context, server_id)
+        if self.cell_cache is not None:
+            lookup = functools.partial(self._get_instance_via_cell_cache,
+                                       context, server_id)
+        hedge = None
+        if self.replica is not None:
+            from_replica = functools.partial(
+                self._get_instance_from_replica, context, server_id)
+            routed = functools.partial(self.replica.call, from_replica,
+                                       lookup,
+                                       missing=(nova_exc.InstanceNotFound,))
+            if self.hedge_to_replica and self.hedging is not None:
+                hedge = routed
+            else:
+                lookup = routed
+        if self.hedging is None:
+            return lookup()
+        return self.hedging.call(lookup, hedge)
+
+    def _instance_not_found(self, server_id):
+        msg = "Instance %s could not be found." % server_id
+        return webob.exc.HTTPNotFound(explanation=msg)
+
+    def _lookup_instance(self, context, server_id):
+        """Returns the instance, or raises HTTPNotFound if it is missing.
+
+        Missing or foreign instances are remembered per (project, server)
+        in the negative cache, when configured, and answered from there.
+        """
+        from nova import exception as nova_exc
+
+        notifications.ensure_listening()
+        negative_cache = self.negative_cache
+        key = (context.project_id, ids.pack(server_id))
+        if negative_cache is not None:
+            if negative_cache.get(key):
+                raise self._instance_not_found(server_id)
+        try:
+            if self.hedging is not None or self.replica is not None:
+                return self._get_instance_routed(context, server_id)
+            if self.cell_cache is not None:
+                return self._get_instance_via_cell_cache(context, server_id)
+            return self._get_instance(context, server_id)
+        except nova_exc.InstanceNotFound:
+            if negative_cache is not None:
+                negative_cache.set(key, True)
+            raise self._instance_not_found(server_id)
+
+    def _on_instance_notification(self, event_type, project_id, server_id):
+        """Forgets cached misses for instances that were created/deleted."""
+        server_id = ids.pack(server_id)
+        if project_id:
+            self.negative_cache.pop((project_id, server_id))
+        else:
+            self.negative_cache.pop_matching(lambda key: key[1] == server_id)
+
+    def _on_cell_notification(self, event_type, project_id, server_id):
+        """Forgets the cell of deleted instances."""
+        if event_type.endswith('delete.end'):
+            self.cell_cache.pop(ids.pack(server_id))
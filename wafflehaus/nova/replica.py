@@ -0,0 +1,208 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""Instance lookups routed to a read replica within a lag bound.
+
+Attach and detach checks only read an instance's network info, which a
+replica a few seconds behind serves as well as the primary. A background
+thread measures the replica's lag every replica_lag_interval seconds, and
+while the last measurement is recent and within replica_max_lag, lookups
+read nova's slave_connection. Otherwise lookups read the primary: while the
+lag is over the bound or unknown, and after a replica read fails, until a
+measurement says the replica is usable again.
+
+A replica read that does not find the instance is repeated on the primary,
+since the instance may just be newer than the replica.
+
+The lag is measured by the class named by replica_lag_api, constructed with
+the filter configuration; MySQLReplicaLag by default.
+"""
+import logging
+import os
+import threading
+import time
+
+LOG = logging.getLogger(__name__)
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+class MySQLReplicaLag(object):
+    """Measures a MySQL replica's lag with SHOW SLAVE STATUS.
+
+    replica_lag_connection is the replica's URL, nova's
+    [database]/slave_connection by default. replica_lag_query, if given, is
+    run instead and returns the lag in seconds, as with a heartbeat table.
+    """
+
+    def __init__(self, conf):
+        self.url = conf.get('replica_lag_connection')
+        self.query = conf.get('replica_lag_query')
+        self._engine = None
+
+    def _get_engine(self):
+        if self._engine is None:
+            import sqlalchemy
+
+            url = self.url
+            if not url:
+                from oslo_config import cfg
+                url = cfg.CONF.database.slave_connection
+            self._engine = sqlalchemy.create_engine(url, pool_size=1)
+        return self._engine
+
+    def lag_seconds(self):
+        """Returns how many seconds the replica is behind, or None."""
+        import sqlalchemy
+
+        with self._get_engine().connect() as connection:
+            row = connection.execute(sqlalchemy.text(
+                self.query or 'SHOW SLAVE STATUS')).fetchone()
+        if row is None:
+            return None
+        if self.query:
+            value = row[0]
+        else:
+            status = dict(getattr(row, '_mapping', row))
+            value = status.get('Seconds_Behind_Master',
+                               status.get('Seconds_Behind_Source'))
+        return float(value) if value is not None else None
+
+
+def load_lag_api(conf):
+    """Returns the lag API named by replica_lag_api, or the MySQL one."""
+    path = conf.get('replica_lag_api')
+    if not path:
+        return MySQLReplicaLag(conf)
+    from oslo_utils import importutils
+    return importutils.import_object(path, conf)
+
+
+class ReplicaRouter(object):
+    """Reads from the replica while its measured lag is within bound."""
+
+    def __init__(self, lag_api, max_lag=5.0, interval=5.0, clock=time.time):
+        self.lag_api = lag_api
+        self.max_lag = max_lag
+        self.interval = interval
+        self.clock = clock
+        self.lag = None
+        self.measured_at = None
+        self.usable = False
+        self.replica_reads = 0
+        self.primary_reads = 0
+        self.lagging = 0
+        self.missing = 0
+        self.failures = 0
+        self.probe_errors = 0
+        self._pid = None
+        self._worker = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_conf(cls, conf):
+        """Returns the process-wide router if replica_max_lag is set."""
+        global _shared
+        max_lag = float(conf.get('replica_max_lag', 0))
+        if max_lag <= 0:
+            return None
+        with _shared_lock:
+            if _shared is None:
+                _shared = cls(
+                    load_lag_api(conf), max_lag=max_lag,
+                    interval=float(conf.get('replica_lag_interval', 5)))
+        return _shared
+
+    def measure(self):
+        """Measures the replica's lag and decides whether to read it."""
+        try:
+            lag = self.lag_api.lag_seconds()
+        except Exception:
+            LOG.exception('Unable to measure the replica lag')
+            self.probe_errors += 1
+            lag = None
+        self.lag = lag
+        self.measured_at = self.clock()
+        self.usable = lag is not None and lag <= self.max_lag
+        return self.usable
+
+    def _ensure_worker(self):
+        # Threads do not survive nova forking its API workers
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            if self._pid == pid:
+                return
+            self._pid = pid
+            self._worker = threading.Thread(target=self._run,
+                                            name='wafflehaus-replica')
+            self._worker.daemon = True
+            self._worker.start()
+
+    def _run(self):
+        while True:
+            self.measure()
+            if self._stop.wait(self.interval):
+                return
+
+    def stop(self):
+        self._stop.set()
+
+    def _fresh(self):
+        # A measurement the worker failed to renew says nothing of now
+        return (self.usable and
+                self.clock() - self.measured_at <= 3 * self.interval)
+
+    def call(self, replica_lookup, primary_lookup, missing=()):
+        """Returns replica_lookup() if the replica is usable, else primary.
+
+        A replica read raising one of missing is repeated on the primary;
+        one raising anything else is too, and stops replica reads until the
+        next measurement.
+        """
+        self._ensure_worker()
+        if not self._fresh():
+            self.lagging += 1
+            self.primary_reads += 1
+            return primary_lookup()
+        try:
+            result = replica_lookup()
+        except missing:
+            self.missing += 1
+        except Exception:
+            LOG.exception('Replica read failed, reading the primary')
+            self.failures += 1
+            self.usable = False
+        else:
+            self.replica_reads += 1
+            return result
+        self.primary_reads += 1
+        return primary_lookup()
+
+    def stats(self):
+        reads = self.replica_reads + self.primary_reads
+        return {'replica_reads': self.replica_reads,
+                'primary_reads': self.primary_reads,
+                'replica_share': (float(self.replica_reads) / reads
+                                  if reads else 0.0),
+                'lagging': self.lagging, 'missing': self.missing,
+                'failures': self.failures,
+                'probe_errors': self.probe_errors,
+                'lag': self.lag, 'max_lag': self.max_lag,
+                'usable': self.usable,
+                'age': (self.clock() - self.measured_at
+                        if self.measured_at is not None else None)}